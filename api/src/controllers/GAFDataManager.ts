@@ -8,6 +8,7 @@ interface GAFData
 {
   date:Date;
   size:number;
+  format:string;
   midpoint:number;
   png1:string;
   png2:string;
@@ -40,9 +41,10 @@ export default class GAFManager extends ControllerBase
       let midpointImages = g.getMidpointImages();
       let sellImage = g.getSellImage();
       let size = g.getSize();
+      let format = g.getImageFormat();
 
-      return { midpoint:midpoint, png1:orderbookImage, png2:buyImage, png3:sellImage, png4:midpointImages[1], size:size, date:new Date() };
+      return { midpoint:midpoint, png1:orderbookImage, png2:buyImage, png3:sellImage, png4:midpointImages != null ? midpointImages[1] : null, size:size, format:format, date:new Date() };
     }
-    return { midpoint:null, png1:null, png2:null, png3:null, png4:null, size:0, date:new Date() };
+    return { midpoint:null, png1:null, png2:null, png3:null, png4:null, size:0, format:null, date:new Date() };
   }
 }
\ No newline at end of file
@@ -1,4 +1,5 @@
 import { Pool, Connection } from './db';
+import { toBase64 } from './images';
 
 export class GAF
 {
@@ -7,12 +8,14 @@ export class GAF
 
   protected orderbookImage:string;
   protected buyImage:string;
+  protected imageFormat:string;
   protected maxSize:number;
   protected midpoint:number;
   protected midpointImages:string[];
   protected product:string;
   protected sellImage:string;
   protected size:number;
+  protected version:string;
 
   constructor(product:string)
   {
@@ -22,27 +25,52 @@ export class GAF
   protected async load() {
     let connection = await GAF.pool.getConnection();
     
+    // calculate bumps version on every write, so an unchanged row is not read again
+    if(this.version != null) {
+      let versions = await connection.query(`SELECT version FROM crypto_gaf.gafs WHERE product = $1`,[this.product]);
+
+      if(versions != null && versions.length != 0 && versions[0].version == this.version) {
+        connection.free();
+        return;
+      }
+    }
+
+    // IMAGE_STORAGE=binary leaves the text columns NULL and writes the bytea ones, in the codec named by image_format
     let rows = await connection.query(`
       SELECT
         orderbook_image,
+        orderbook_image_data,
         buy_image,
+        buy_image_data,
+        image_format,
         max_size,
         midpoint,
         midpoint_images,
+        midpoint_image_data,
         sell_image,
-        size
+        sell_image_data,
+        size,
+        version
       FROM 
         crypto_gaf.gafs 
       WHERE product = $1
       `,[this.product]);
     if(rows != null && rows.length != 0) {
-      this.orderbookImage = rows[0].orderbook_image;
-      this.buyImage = rows[0].buy_image;
+      let format = (rows[0].image_format || 'png').split(':')[0];
+      let midpointText:string[] = rows[0].midpoint_images;
+      let midpointData:Buffer[] = rows[0].midpoint_image_data;
+
+      this.orderbookImage = toBase64(rows[0].orderbook_image,rows[0].orderbook_image_data,format);
+      this.buyImage = toBase64(rows[0].buy_image,rows[0].buy_image_data,format);
+      this.imageFormat = format == 'raw' ? 'png' : format;
       this.midpoint = rows[0].midpoint;
-      this.midpointImages = rows[0].midpoint_images;
+      if(midpointText != null) this.midpointImages = midpointText.map((x:string) => toBase64(x,null,format));
+      else if(midpointData != null) this.midpointImages = midpointData.map((x:Buffer) => toBase64(null,x,format));
+      else this.midpointImages = null;
       this.maxSize = rows[0].max_size;
-      this.sellImage = rows[0].sell_image;
+      this.sellImage = toBase64(rows[0].sell_image,rows[0].sell_image_data,format);
       this.size = rows[0].size;
+      this.version = rows[0].version;
     }
     connection.free();
   }
@@ -94,6 +122,12 @@ export class GAF
     return this.buyImage;
   }
 
+  // png or webp; raw images are served as png
+  getImageFormat():string
+  {
+    return this.imageFormat;
+  }
+
   getMidpoint():number
   {
     return this.midpoint;
@@ -0,0 +1,69 @@
+import * as zlib from 'zlib';
+
+// calculate's raw codec: big-endian uint16 height, width and channels, then row-major uint8 pixels
+const RAW_HEADER_SIZE = 6;
+const PNG_SIGNATURE = Buffer.from([0x89,0x50,0x4e,0x47,0x0d,0x0a,0x1a,0x0a]);
+const COLOR_TYPES:{ [channels:number]:number } = { 1:0, 2:4, 3:2, 4:6 };
+
+let crcTable:number[] = null;
+
+function crc32(data:Buffer):number
+{
+  if(crcTable == null) {
+    crcTable = [];
+    for(let n = 0;n < 256;n++) {
+      let c = n;
+
+      for(let k = 0;k < 8;k++) c = (c & 1) ? (0xedb88320 ^ (c >>> 1)) : (c >>> 1);
+      crcTable.push(c >>> 0);
+    }
+  }
+
+  let crc = 0xffffffff;
+
+  for(let i = 0;i < data.length;i++) crc = crcTable[(crc ^ data[i]) & 0xff] ^ (crc >>> 8);
+  return (crc ^ 0xffffffff) >>> 0;
+}
+
+function chunk(type:string,data:Buffer):Buffer
+{
+  let length = Buffer.alloc(4);
+  let body = Buffer.concat([Buffer.from(type,'ascii'),data]);
+  let crc = Buffer.alloc(4);
+
+  length.writeUInt32BE(data.length,0);
+  crc.writeUInt32BE(crc32(body),0);
+  return Buffer.concat([length,body,crc]);
+}
+
+// browsers cannot show raw pixels, so the API serves them as PNG
+export function rawToPng(raw:Buffer):Buffer
+{
+  let height = raw.readUInt16BE(0);
+  let width = raw.readUInt16BE(2);
+  let channels = raw.readUInt16BE(4);
+  let stride = width*channels;
+  let header = Buffer.alloc(13);
+  let scanlines = Buffer.alloc(height*(stride + 1));
+
+  if(COLOR_TYPES[channels] == null || raw.length < RAW_HEADER_SIZE + height*stride) throw new Error(`not a raw image: ${height}x${width}x${channels}, ${raw.length} bytes`);
+  header.writeUInt32BE(width,0);
+  header.writeUInt32BE(height,4);
+  header[8] = 8;
+  header[9] = COLOR_TYPES[channels];
+  // each scanline starts with filter type 0 (none)
+  for(let row = 0;row < height;row++) raw.copy(scanlines,row*(stride + 1) + 1,RAW_HEADER_SIZE + row*stride,RAW_HEADER_SIZE + (row + 1)*stride);
+  return Buffer.concat([PNG_SIGNATURE,chunk('IHDR',header),chunk('IDAT',zlib.deflateSync(scanlines)),chunk('IEND',Buffer.alloc(0))]);
+}
+
+// an image as base64, from its text column or else its bytea column; format is gafs.image_format without its option
+export function toBase64(text:string,data:Buffer,format:string):string
+{
+  if(format == 'raw') {
+    let raw = data != null ? data : (text != null ? Buffer.from(text,'base64') : null);
+
+    return raw != null ? rawToPng(raw).toString('base64') : null;
+  }
+  if(text != null) return text;
+  return data != null ? data.toString('base64') : null;
+}
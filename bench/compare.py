@@ -0,0 +1,49 @@
+"""Compare two bench/run.py result files.
+
+   python bench/compare.py before.json after.json [--threshold 0.05]
+
+Prints the median of every benchmark in both runs and the change; changes
+beyond the threshold are marked as faster or slower.  The exit status is 1
+when anything got slower, so the comparison can gate a CI step.
+"""
+import argparse
+import json
+
+def load(path):
+   with open(path) as f:
+      return json.load(f)
+
+def main(args):
+   before = load(args.before)
+   after = load(args.after)
+   print(f"before {before.get('commit')}{' (dirty)' if before.get('dirty') else ''}")
+   print(f"after  {after.get('commit')}{' (dirty)' if after.get('dirty') else ''}")
+   ignored = ('only','repeat')
+   if { k: v for k,v in before.get('config',{}).items() if k not in ignored } != { k: v for k,v in after.get('config',{}).items() if k not in ignored }:
+      print("warning: the runs used different configurations")
+   slower = 0
+   names = list(before['results']) + [ x for x in after['results'] if x not in before['results'] ]
+   for name in names:
+      old = before['results'].get(name,None)
+      new = after['results'].get(name,None)
+      if old is None or new is None:
+         print(f"{name:32s} {'only in ' + ('after' if old is None else 'before'):>36s}")
+         continue
+      change = new['median']/old['median'] - 1 if old['median'] > 0 else 0.0
+      mark = ''
+      if change > args.threshold:
+         mark = 'slower'
+         slower += 1
+      elif change < -args.threshold:
+         mark = 'faster'
+      print(f"{name:32s} {old['median']*1000:10.3f} ms {new['median']*1000:10.3f} ms {change*100:+8.1f}%  {mark}")
+   return 1 if slower > 0 else 0
+
+parser = argparse.ArgumentParser()
+parser.add_argument('before', help="results of the baseline run")
+parser.add_argument('after', help="results of the run to compare")
+parser.add_argument('--threshold', type=float, default=0.05, help="relative change reported as faster/slower")
+
+if __name__ == '__main__':
+   args = parser.parse_args()
+   raise SystemExit(main(args))
@@ -0,0 +1,277 @@
+"""Benchmarks for the collect and calculate hot paths.
+
+Runs micro-benchmarks over synthetic samples (bench/synthetic.py) and writes
+the timings to a JSON file, so runs on two commits can be set side by side
+with bench/compare.py:
+
+   python bench/run.py --output before.json
+   python bench/run.py --output after.json
+   python bench/compare.py before.json after.json
+
+The db.* and end_to_end benchmarks create a throwaway database next to
+--db (POSTGRES_* variables as for the workers), load the chart's schema
+into it and drop it afterwards; --no_db skips them.  Each benchmark is run
+once to warm up and then --repeat times, and every timing is one pass over
+all products.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import numpy as np
+import psycopg
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ os.path.join(ROOT,'calculate'),os.path.join(ROOT,'collect') ]
+
+from synthetic import SampleGenerator
+
+def measure(fn,repeat,setup=None,items=1):
+   # fn(setup()) once to warm up, then repeat timed calls; setup is not timed
+   times = []
+   for k in range(repeat + 1):
+      arg = setup() if setup is not None else None
+      start = time.perf_counter()
+      fn(arg)
+      if k > 0: times.append(time.perf_counter() - start)
+   median = statistics.median(times)
+   return {
+      'unit': 's',
+      'repeat': repeat,
+      'items': items,
+      'min': min(times),
+      'median': median,
+      'mean': statistics.fmean(times),
+      'per_second': items/median if median > 0 else None
+   }
+
+def gitCommit():
+   try:
+      commit = subprocess.run(['git','rev-parse','HEAD'],cwd=ROOT,capture_output=True,text=True,check=True).stdout.strip()
+      dirty = subprocess.run(['git','status','--porcelain','--untracked-files=no'],cwd=ROOT,capture_output=True,text=True,check=True).stdout.strip() != ''
+      return commit,dirty
+   except (OSError, subprocess.CalledProcessError):
+      return None,None
+
+def schemaSql():
+   # the chart's schema.sql, without the templated seed rows
+   with open(os.path.join(ROOT,'chart','templates','schema-configmap.yaml')) as f:
+      body = f.read().split('schema.sql: |-',1)[1].split('{{- range',1)[0]
+   return '\n'.join(line[4:] for line in body.splitlines() if '{{' not in line)
+
+def benchCollect(gen,results,repeat):
+   from ingest import sampleRow,packSample
+   book = [ [str(100 + 0.01*k),str(1.0 + k),1] for k in range(gen.depth) ]
+   trade = { 'price': '100.0', 'size': '0.5', 'numOrders': 3 }
+   rows = gen.rows(gen.maxSize)
+   results['collect.sample_row'] = measure(lambda _: [ sampleRow(book,book,trade,'100.0',product,trade) for product in gen.products for _ in range(gen.maxSize) ],repeat,items=len(rows))
+   results['collect.pack_sample'] = measure(lambda _: [ packSample(x,gen.depth) for x in rows ],repeat,items=len(rows))
+
+def benchCalculate(gen,results,repeat,groups,backend,imageFormats,sizes):
+   import app
+   from sanitize import sanitize_midpoints,sanitize_orderbook,sanitize_trades,fit_length
+   from gaf import BatchGAF,LeanGAF
+   from mtf import MarkovTransition
+   from images import getCodec,ImageEncoder
+   # the newest max_size samples, and the window one sample earlier for the incremental benchmark
+   full = gen.windows(gen.maxSize + 1)
+   windows = { product: { key: values[:-1] for key,values in window.items() } for product,window in full.items() }
+   previous = { product: { key: values[1:] for key,values in window.items() } for product,window in full.items() }
+   products = len(windows)
+   jobs = [ x for x in (app.prepareSamples(product,window,*sizes) for product,window in windows.items()) if x is not None ]
+   if len(jobs) == 0:
+      print("bench: no product survived prepareSamples, lower the null/garbage rates")
+      return
+   if wanted(groups,'sanitize'):
+      results['sanitize.midpoints'] = measure(lambda _: [ sanitize_midpoints(x['midpoint']) for x in windows.values() ],repeat,items=products)
+      results['sanitize.orderbook'] = measure(lambda _: [ (sanitize_orderbook(x['askPrices'],x['askSizes']),sanitize_orderbook(x['bidPrices'],x['bidSizes'])) for x in windows.values() ],repeat,items=products)
+      results['sanitize.trades'] = measure(lambda _: [ (sanitize_trades(x['buys']),sanitize_trades(x['sells'])) for x in windows.values() ],repeat,items=products)
+      results['sanitize.fit_length'] = measure(lambda _: [ fit_length(x['askPrices'],gen.maxSize + 1,x['askPrices'].shape[1]) for x in jobs ],repeat,items=len(jobs))
+      results['sanitize.prepare_samples'] = measure(lambda _: [ app.prepareSamples(product,window,*sizes) for product,window in windows.items() ],repeat,items=products)
+   if wanted(groups,'fields'):
+      results['fields.midpoint'] = measure(lambda _: [ app.getMidpointFields(x['midpoint'],x['imageSize']) for x in jobs ],repeat,items=len(jobs))
+      results['fields.ask_price'] = measure(lambda _: [ app.getAskPriceFields(x['askPrices'],x['imageSize']) for x in jobs ],repeat,items=len(jobs))
+      results['fields.bid_price'] = measure(lambda _: [ app.getBidPriceFields(x['bidPrices'],x['imageSize']) for x in jobs ],repeat,items=len(jobs))
+      results['fields.orderbook'] = measure(lambda _: [ app.getOrderbookField(x['askPrices'],x['askSizes'],x['bidPrices'],x['bidSizes'],x['imageSize']) for x in jobs ],repeat,items=len(jobs))
+      results['fields.buy'] = measure(lambda _: [ app.getBuyField(x['buys'],x['imageSize']) for x in jobs ],repeat,items=len(jobs))
+      results['fields.sell'] = measure(lambda _: [ app.getSellField(x['sells'],x['imageSize']) for x in jobs ],repeat,items=len(jobs))
+      # one new sample per product against warm incremental state
+      def warmStates():
+         states = {}
+         for job in jobs:
+            earlier = app.prepareSamples(job['product'],previous[job['product']],*sizes)
+            if earlier is not None: app.getProductFields(earlier,app.getFieldState(states,job['product']))
+         return states
+      results['fields.incremental'] = measure(lambda states: [ app.getProductFields(x,app.getFieldState(states,x['product'])) for x in jobs ],repeat,warmStates,items=len(jobs))
+      # the MTF is opt in, timed when --mtf_bins is set
+      if sizes[2] > 0: results['fields.mtf'] = measure(lambda _: [ MarkovTransition(x['midpoint'],sizes[2]).field(x['imageSize']) for x in jobs ],repeat,items=len(jobs))
+      batch = BatchGAF()
+      results['fields.batch'] = measure(lambda _: [ fields for fields in app.getBatchFields(jobs,batch) ],repeat,items=len(jobs))
+      # float32 fields straight to the uint8 pixels, so this one includes what images.field_to_rgb times
+      lean = LeanGAF()
+      results['fields.lean'] = measure(lambda _: [ app.getLeanPixels(x,x['imageSize'],lean) for x in jobs ],repeat,items=len(jobs))
+   if wanted(groups,'images'):
+      fields = [ app.getProductFields(x) for x in jobs ]
+      results['images.field_to_rgb'] = measure(lambda _: [ (app.fieldToRGB(x[1]),app.fieldToRGB(x[2],permutation=[1,0,2]),app.fieldToRGB(x[3])) for x in fields ],repeat,items=len(jobs))
+      pixels = [ app.getMidpointImages(x[0]) + [ app.fieldToRGB(x[1]),app.fieldToRGB(x[2],permutation=[1,0,2]),app.fieldToRGB(x[3]) ] for x in fields ]
+      for imageFormat in imageFormats:
+         encoder = ImageEncoder(getCodec(imageFormat))
+         results[f"images.encode.{imageFormat}"] = measure(lambda _: [ encoder.encode(x) for x in pixels ],repeat,items=len(jobs))
+         encoder.shutdown()
+
+def benchDatabase(gen,results,repeat,groups,backend,flushRows,params,sizes):
+   from ingest import SampleBuffer
+   from retention import Pruner
+   from samples import getSampleWindows
+   name = f"crypto_gaf_bench_{os.getpid()}"
+   with psycopg.connect(**params,autocommit=True) as admin:
+      admin.execute(f"CREATE DATABASE {name}")
+   try:
+      with psycopg.connect(**dict(params,dbname=name)) as conn:
+         conn.execute(schemaSql())
+         for product in gen.products:
+            conn.execute("INSERT INTO crypto_gaf.gafs (product,max_size) VALUES (%s,%s)",(product,gen.maxSize))
+         conn.commit()
+         def insert(mode,rows,sampleFormat='both'):
+            buffer = SampleBuffer(mode,len(rows),0,sampleFormat,gen.depth)
+            for row in rows:
+               buffer.add(row)
+            with conn.cursor() as cur:
+               buffer.flush(conn,cur)
+            conn.commit()
+         insert('copy',gen.rows(gen.maxSize))
+         if wanted(groups,'db.fetch'):
+            for sampleFormat in ('numeric','packed'):
+               results[f"db.fetch.{sampleFormat}"] = measure(lambda _: getSampleWindows(conn,sampleFormat=sampleFormat),repeat,items=len(gen.products))
+               conn.commit()
+         if wanted(groups,'db.update') or wanted(groups,'end_to_end'):
+            import app
+            from gaf import BatchGAF,LeanGAF
+            from images import PngCodec,ImageEncoder
+            encoder = ImageEncoder(PngCodec())
+            batch = LeanGAF() if backend == 'lean' else BatchGAF()
+            def calculatePass(fieldStates):
+               jobs = [ x for x in (app.prepareSamples(product,window,*sizes) for product,window in getSampleWindows(conn).items()) if x is not None ]
+               with conn.cursor() as cur:
+                  for result in app.renderProducts(jobs,backend,fieldStates,batch,encoder):
+                     app.doUpdate(conn,cur,*result)
+               conn.commit()
+            if wanted(groups,'db.update'):
+               rendered = list(app.renderProducts([ x for x in (app.prepareSamples(p,w,*sizes) for p,w in getSampleWindows(conn).items()) if x is not None ],'pyts',{},batch,encoder))
+               conn.commit()
+               def update(_):
+                  with conn.cursor() as cur:
+                     for result in rendered:
+                        app.doUpdate(conn,cur,*result)
+                  conn.commit()
+               results['db.update'] = measure(update,repeat,items=len(rendered))
+               def batchUpdate(writer):
+                  with conn.cursor() as cur:
+                     for result in rendered:
+                        writer.add(*result)
+                     writer.flush(conn,cur)
+                  conn.commit()
+               # a fresh writer hashes and writes every product in one pipeline; a warm one finds nothing changed
+               results['db.update.batch'] = measure(batchUpdate,repeat,lambda: app.OutputWriter(),items=len(rendered))
+               warm = app.OutputWriter()
+               batchUpdate(warm)
+               results['db.update.unchanged'] = measure(batchUpdate,repeat,lambda: warm,items=len(rendered))
+            if wanted(groups,'end_to_end'):
+               # one new sample per product, then a full calculate pass: fetch, sanitize, fields, encode, update
+               fieldStates = {}
+               def tick():
+                  insert('copy',gen.rows(1))
+                  return fieldStates
+               results['end_to_end'] = measure(calculatePass,repeat,tick,items=len(gen.products))
+               results['end_to_end']['backend'] = backend
+            encoder.shutdown()
+         if wanted(groups,'db.insert'):
+            for mode in ('row','pipeline','copy'):
+               results[f"db.insert.{mode}"] = measure(lambda rows: insert(mode,rows,'numeric'),repeat,lambda: gen.rows(flushRows),items=flushRows*len(gen.products))
+         if wanted(groups,'db.prune'):
+            # the warm-up run clears the backlog, then every run prunes the flushRows samples per product it added
+            pruner = Pruner(0,flushRows,10**6)
+            results['db.prune'] = measure(lambda _: pruner.run(conn),repeat,lambda: insert('copy',gen.rows(flushRows)),items=flushRows*len(gen.products))
+   finally:
+      with psycopg.connect(**params,autocommit=True) as admin:
+         admin.execute(f"DROP DATABASE IF EXISTS {name}")
+
+def wanted(groups,name):
+   return groups is None or any(name == x or name.startswith(x + '.') or x.startswith(name + '.') for x in groups)
+
+def main(args):
+   postgresUser = "postgres"
+   postgresPw = None
+   postgresHost = "localhost"
+   postgresPort = 5432
+   postgresDb = "postgres"
+   if os.environ.get('POSTGRES_USER') != None: postgresUser = os.environ.get('POSTGRES_USER')
+   if os.environ.get('POSTGRES_PW') != None: postgresPw = os.environ.get('POSTGRES_PW')
+   if os.environ.get('POSTGRES_HOST') != None: postgresHost = os.environ.get('POSTGRES_HOST')
+   if os.environ.get('POSTGRES_PORT') != None: postgresPort = int(os.environ.get('POSTGRES_PORT'))
+   if os.environ.get('POSTGRES_DB') != None: postgresDb = os.environ.get('POSTGRES_DB')
+   if args.pg_user != None: postgresUser = args.pg_user
+   if args.pg_pw != None: postgresPw = args.pg_pw
+   if args.pg_host != None: postgresHost = args.pg_host
+   if args.pg_port != None: postgresPort = int(args.pg_port)
+   if args.db != None: postgresDb = args.db
+   groups = args.only.split(',') if args.only != None else None
+   imageFormats = args.image_formats.split(',')
+   sizes = (args.image_size,args.pyramid_levels,args.mtf_bins)
+   gen = SampleGenerator(args.products,args.depth,args.max_size,args.null_rate,args.garbage_rate,args.seed)
+   results = {}
+   if wanted(groups,'collect'):
+      benchCollect(gen,results,args.repeat)
+   if any(wanted(groups,x) for x in ('sanitize','fields','images')):
+      benchCalculate(gen,results,args.repeat,groups,args.gaf_backend,imageFormats,sizes)
+   if not args.no_db and any(wanted(groups,x) for x in ('db','end_to_end')):
+      params = dict(host=postgresHost,port=postgresPort,dbname=postgresDb,user=postgresUser,password=postgresPw)
+      benchDatabase(gen,results,args.repeat,groups,args.gaf_backend,args.flush_rows,params,sizes)
+   commit,dirty = gitCommit()
+   report = {
+      'commit': commit,
+      'dirty': dirty,
+      'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ',time.gmtime()),
+      'python': platform.python_version(),
+      'numpy': np.__version__,
+      'machine': platform.machine(),
+      'cpus': os.cpu_count(),
+      'config': { key: value for key,value in vars(args).items() if key not in ('pg_pw','output') },
+      'results': results
+   }
+   with open(args.output,'w') as f:
+      json.dump(report,f,indent=2)
+   for name,result in results.items():
+      print(f"{name:32s} {result['median']*1000:10.3f} ms  {result['per_second'] or 0:12.1f} /s")
+   print(f"bench: wrote {len(results)} results to {args.output}")
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--pg_user', help="postgres user")
+parser.add_argument('--pg_pw', help="postgres password")
+parser.add_argument('--pg_host', help="postgres host")
+parser.add_argument('--pg_port', help="postgres port")
+parser.add_argument('--db', help="postgres db the throwaway benchmark database is created from")
+parser.add_argument('--no_db', action='store_true', help="skip the db.* and end_to_end benchmarks")
+parser.add_argument('--only', help="comma separated benchmark groups or names, e.g. sanitize,fields.batch,db.insert")
+parser.add_argument('--products', type=int, default=3, help="synthetic products")
+parser.add_argument('--depth', type=int, default=5, help="order book levels per side")
+parser.add_argument('--max_size', type=int, default=600, help="samples per product window")
+parser.add_argument('--null_rate', type=float, default=0.01, help="probability that a column is NULL")
+parser.add_argument('--garbage_rate', type=float, default=0.01, help="probability that a cell is NaN, zero, negative or a book side is cut short")
+parser.add_argument('--seed', type=int, default=0, help="random seed for the sample generator")
+parser.add_argument('--repeat', type=int, default=5, help="timed runs per benchmark")
+parser.add_argument('--flush_rows', type=int, default=50, help="samples per product in each db.insert/db.prune run")
+parser.add_argument('--gaf_backend', default='incremental', help="GAF backend for end_to_end: incremental, batch, pyts or lean")
+parser.add_argument('--image_size', type=int, default=0, help="image side passed to prepareSamples (0 keeps one pixel per sample)")
+parser.add_argument('--pyramid_levels', type=int, default=0, help="pyramid levels passed to prepareSamples")
+parser.add_argument('--mtf_bins', type=int, default=0, help="MTF bins passed to prepareSamples (0 leaves the MTF out)")
+parser.add_argument('--image_formats', default='png,webp,raw', help="codecs for images.encode")
+parser.add_argument('--output', default='bench.json', help="JSON file for the results")
+
+if __name__ == '__main__':
+   args = parser.parse_args()
+   main(args)
@@ -0,0 +1,202 @@
+"""coinbase-local stand-in for running collect without a network.
+
+Serves /api/orderBook/interval and /api/orderBook/marketOrders for any
+product asked for, at --speed times real time (1 to 100), either from logs
+recorded with collect's RECORD_PATH or from synthetic random walk books:
+
+   python bench/standin.py --port 4201 --replay btc.log.gz --speed 10
+   python bench/standin.py --port 4201 --speed 100
+   COINBASE_URL=http://localhost:4201 python collect/app.py
+
+A replayed product answers with the latest response recorded at or before
+the replay clock, which starts at the first recorded response and loops
+back to it when the log runs out.  Products missing from the log are mapped
+onto a recorded one, so a log of three markets can feed two hundred.
+
+collect polls the products in crypto_gaf.gafs, so seed as many as the test
+needs, e.g. INSERT INTO crypto_gaf.gafs (product,max_size) SELECT 'SYN' || g || '-USD',600 FROM generate_series(1,200) g.
+"""
+import argparse
+import bisect
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+from urllib.parse import urlparse,parse_qs
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'collect'))
+
+from record import readLog
+
+ORDERBOOK_PATH = '/api/orderBook/interval'
+MARKET_ORDERS_PATH = '/api/orderBook/marketOrders'
+
+class Clock:
+   def __init__(self,speed):
+      self.speed = speed
+      self.start = time.monotonic()
+
+   def elapsed(self):
+      # simulated seconds since the server started
+      return (time.monotonic() - self.start)*self.speed
+
+class ReplaySource:
+   def __init__(self,paths,clock):
+      self.clock = clock
+      timelines = {}
+      for path in paths:
+         for entry in readLog(path):
+            if entry.get('product',None) is None:
+               continue
+            timelines.setdefault((entry['path'],entry['product']),[]).append((entry['t'],entry['status'],entry['body']))
+      if len(timelines) == 0:
+         raise ValueError("no responses in the replay logs")
+      self.timelines = {}
+      for key,entries in timelines.items():
+         entries.sort(key=lambda x: x[0])
+         self.timelines[key] = ([ x[0] for x in entries ],[ (x[1],x[2]) for x in entries ])
+      self.products = sorted({ product for path,product in self.timelines })
+      self.first = min(x[0][0] for x in self.timelines.values())
+      # the loop starts over one second after the last recorded response
+      self.duration = max(x[0][-1] for x in self.timelines.values()) - self.first + 1
+
+   def recorded(self,product):
+      if product in self.products:
+         return product
+      return self.products[zlib.crc32(product.encode()) % len(self.products)]
+
+   def answer(self,path,product,params):
+      timeline = self.timelines.get((path,self.recorded(product)),None)
+      if timeline is None:
+         return 404,json.dumps({ 'error': f"nothing recorded for {product}" })
+      times,answers = timeline
+      now = self.first + self.clock.elapsed() % self.duration
+      return answers[max(bisect.bisect_right(times,now) - 1,0)]
+
+def poisson(rng,mean):
+   if mean > 30:
+      return max(int(round(rng.gauss(mean,math.sqrt(mean)))),0)
+   limit = math.exp(-mean)
+   count = 0
+   product = rng.random()
+   while product > limit:
+      count += 1
+      product *= rng.random()
+   return count
+
+class SyntheticSource:
+   """Random walk books, advanced in simulated time on every request."""
+
+   def __init__(self,clock,volatility=0.0005,tradeRate=5.0,seed=None):
+      self.clock = clock
+      self.volatility = volatility
+      self.tradeRate = tradeRate
+      self.random = random.Random(seed)
+      self.lock = threading.Lock()
+      self.markets = {}
+
+   def market(self,product):
+      now = self.clock.elapsed()
+      market = self.markets.get(product,None)
+      if market is None:
+         market = { 'midpoint': 10**self.random.uniform(0,5), 'sequence': 0, 'time': now, 'buy': None, 'sell': None }
+         self.markets[product] = market
+      dt = now - market['time']
+      if dt > 0:
+         # dt seconds of a geometric random walk, and the trades that arrived meanwhile
+         market['midpoint'] *= math.exp(self.volatility*math.sqrt(dt)*self.random.gauss(0,1))
+         trades = poisson(self.random,self.tradeRate*dt)
+         if trades > 0:
+            market['sequence'] += trades
+            market['buy'] = self.trade(market['midpoint'],1,trades)
+            market['sell'] = self.trade(market['midpoint'],-1,trades)
+         market['time'] = now
+      return market
+
+   def trade(self,midpoint,sign,trades):
+      return { 'price': midpoint*(1 + sign*0.0002*self.random.random()), 'size': self.random.expovariate(1.0)*trades, 'numOrders': trades }
+
+   def answer(self,path,product,params):
+      with self.lock:
+         market = self.market(product)
+         midpoint = market['midpoint']
+         if path == ORDERBOOK_PATH:
+            depth = int(params.get('depth','3'))
+            step = midpoint*0.0001*float(params.get('aggregation','10'))
+            body = {
+               'midpoint': midpoint,
+               'asks': [ [midpoint + step*(k + 0.5),self.random.expovariate(1.0)] for k in range(depth) ],
+               'bids': [ [midpoint - step*(k + 0.5),self.random.expovariate(1.0)] for k in range(depth) ]
+            }
+         else:
+            empty = { 'price': midpoint, 'size': 0, 'numOrders': 0 }
+            body = { 'sequence': market['sequence'], 'buy': market['buy'] or empty, 'sell': market['sell'] or empty }
+      return 200,json.dumps(body)
+
+def handler(source,latency):
+   class Handler(BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+
+      def log_message(self,format,*args):
+         pass
+
+      def do_GET(self):
+         url = urlparse(self.path)
+         params = { key: values[0] for key,values in parse_qs(url.query).items() }
+         if url.path not in (ORDERBOOK_PATH,MARKET_ORDERS_PATH) or 'product' not in params:
+            status,body = 404,json.dumps({ 'error': 'not found' })
+         else:
+            status,body = source.answer(url.path,params['product'],params)
+         if latency > 0: time.sleep(latency)
+         data = body.encode()
+         self.send_response(status)
+         self.send_header('Content-Type','application/json')
+         self.send_header('Content-Length',str(len(data)))
+         self.end_headers()
+         self.wfile.write(data)
+   return Handler
+
+class StandinServer(ThreadingHTTPServer):
+   daemon_threads = True
+   # a concurrent collect opens a connection per request in flight
+   request_queue_size = 256
+
+   def handle_error(self,request,clientAddress):
+      # collect dropping a connection (request timeout, cycle deadline, shutdown) is not an error here
+      if not isinstance(sys.exc_info()[1],ConnectionError):
+         super().handle_error(request,clientAddress)
+
+def main(args):
+   if not 1 <= args.speed <= 100:
+      print(f"speed {args.speed} is outside 1-100")
+      return
+   clock = Clock(args.speed)
+   source = ReplaySource(args.replay,clock) if args.replay else SyntheticSource(clock,seed=args.seed)
+   server = StandinServer((args.host,args.port),handler(source,args.latency))
+   if args.replay:
+      print(f"standin: replaying {len(source.products)} products ({source.duration:.0f}s of responses) at {args.speed}x on port {args.port}")
+   else:
+      print(f"standin: synthetic books at {args.speed}x on port {args.port}")
+   try:
+      server.serve_forever()
+   except KeyboardInterrupt:
+      pass
+   finally:
+      server.server_close()
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--host', default='127.0.0.1', help="address to listen on")
+parser.add_argument('--port', type=int, default=4201, help="port to listen on (coinbase-local uses 4201)")
+parser.add_argument('--replay', nargs='*', help="logs recorded with collect's RECORD_PATH; synthetic books when omitted")
+parser.add_argument('--speed', type=float, default=1, help="simulated seconds per second, 1 to 100")
+parser.add_argument('--latency', type=float, default=0, help="seconds added to every answer")
+parser.add_argument('--seed', type=int, help="random seed for synthetic books")
+
+if __name__ == '__main__':
+   args = parser.parse_args()
+   main(args)
@@ -0,0 +1,84 @@
+"""Synthetic order book samples for the benchmarks.
+
+Samples follow a random walk per product and come in two shapes: the rows
+collect writes (sampleRow order, oldest first) and the newest first windows
+calculate reads back (getSampleWindows form).  With null_rate a column is
+NULL, with garbage_rate a cell is NaN, a size is zero, a price is negative
+or an order book side is cut short, which is what the sanitize stage exists
+to absorb.
+"""
+import numpy as np
+
+class SampleGenerator:
+   def __init__(self,products=3,depth=5,maxSize=600,nullRate=0.0,garbageRate=0.0,seed=0):
+      self.products = [ f"BENCH{k}-USD" for k in range(products) ]
+      self.depth = depth
+      self.maxSize = maxSize
+      self.nullRate = nullRate
+      self.garbageRate = garbageRate
+      self.random = np.random.default_rng(seed)
+      self.midpoints = { product: 100.0*(k + 1) for k,product in enumerate(self.products) }
+
+   def nulled(self,value):
+      return None if self.random.random() < self.nullRate else value
+
+   def garbled(self,values,kind):
+      values = values.copy()
+      bad = self.random.random(len(values)) < self.garbageRate
+      if kind == 'price': values[bad] = np.where(self.random.random(bad.sum()) < 0.5,np.nan,-values[bad])
+      else: values[bad] = np.where(self.random.random(bad.sum()) < 0.5,np.nan,0.0)
+      return values
+
+   def side(self,midpoint,sign):
+      prices = midpoint + sign*0.01*midpoint*np.arange(1,self.depth + 1)
+      sizes = self.random.exponential(1.0,self.depth)
+      prices,sizes = self.garbled(prices,'price'),self.garbled(sizes,'size')
+      if self.random.random() < self.garbageRate:
+         cut = int(self.random.integers(0,self.depth))
+         prices,sizes = prices[:cut],sizes[:cut]
+      return self.nulled(prices.tolist()),self.nulled(sizes.tolist())
+
+   def trade(self,midpoint):
+      trade = self.garbled(np.array([midpoint*(1 + 0.001*self.random.normal()),self.random.exponential(1.0),float(self.random.integers(1,10))]),'size')
+      return self.nulled(trade.tolist())
+
+   def row(self,product):
+      midpoint = self.midpoints[product]*(1 + 0.001*self.random.normal())
+      self.midpoints[product] = midpoint
+      askPrices,askSizes = self.side(midpoint,1)
+      bidPrices,bidSizes = self.side(midpoint,-1)
+      return (askPrices,askSizes,bidPrices,bidSizes,self.trade(midpoint),self.nulled(midpoint),product,self.trade(midpoint))
+
+   def rows(self,count):
+      # count samples of every product, oldest first, interleaved the way collect polls them
+      return [ self.row(product) for _ in range(count) for product in self.products ]
+
+   def windows(self,count=None):
+      # product -> window of count (default maxSize) samples, newest first
+      count = self.maxSize if count is None else count
+      rows = self.rows(count)
+      return { product: toWindow([ x for x in rows if x[6] == product ]) for product in self.products }
+
+def column(values,width):
+   out = np.full((len(values),width),np.nan)
+   for i,value in enumerate(values):
+      if value is not None: out[i,:len(value)] = value
+   return out
+
+def toWindow(rows):
+   # sampleRow tuples, oldest first -> getSampleWindows form
+   rows = rows[::-1]
+   book = [ [ x[k] for x in rows ] for k in range(4) ]
+   depths = np.array([ [ len(x[k]) if x[k] is not None else 0 for k in range(4) ] for x in rows ],dtype=np.int64).reshape(len(rows),4)
+   widths = depths.max(axis=0) if len(rows) > 0 else np.zeros(4,dtype=np.int64)
+   return {
+      'sampleIds': np.arange(len(rows),0,-1,dtype=np.int64),
+      'midpoint': np.array([ np.nan if x[5] is None else x[5] for x in rows ],dtype=np.float64),
+      'askPrices': column(book[0],widths[0]),
+      'askSizes': column(book[1],widths[1]),
+      'bidPrices': column(book[2],widths[2]),
+      'bidSizes': column(book[3],widths[3]),
+      'buys': column([ x[4] for x in rows ],3),
+      'sells': column([ x[7] for x in rows ],3),
+      'depths': depths
+   }
@@ -1,271 +1,427 @@
+import time
+# taken before the other imports, so the time to first image includes loading them
+STARTED = time.monotonic()
 import argparse
-import json
 import os
-import io
 import psycopg
-import time
-import pickle
-import PIL.Image
+import signal
+import socket
+import threading
 import numpy as np
-import base64
-from pyts.image import GramianAngularField
-from pyts.image import MarkovTransitionField
-
-
-def sanitize_midpoints(midpoints):
-   cleaned = []
-   last = 0.0
-   if midpoints is None:
-      return cleaned
-   for value in midpoints:
-      if value is None:
-         cleaned.append(last)
-         continue
-      try:
-         last = float(value)
-      except (TypeError, ValueError):
-         cleaned.append(last)
-         continue
-      cleaned.append(last)
-   return cleaned
-
-def sanitize_orderbook(price_samples,size_samples,expected_depth=None):
-   price_samples = price_samples or []
-   size_samples = size_samples or []
-   depth = expected_depth or 0
-   for row in price_samples:
-      if row:
-         depth = max(depth,len(row))
-   for row in size_samples:
-      if row:
-         depth = max(depth,len(row))
-   if depth == 0:
-      return [],[],0
-   total = max(len(price_samples),len(size_samples))
-   cleaned_price = []
-   cleaned_size = []
-   last_price = [0.0]*depth
-   last_size = [0.0]*depth
-   for idx in range(total):
-      price_row = price_samples[idx] if idx < len(price_samples) else None
-      size_row = size_samples[idx] if idx < len(size_samples) else None
-      price_values = []
-      size_values = []
-      for depth_index in range(depth):
-         value = last_price[depth_index]
-         if price_row and depth_index < len(price_row) and price_row[depth_index] is not None:
-            try:
-               value = float(price_row[depth_index])
-            except (TypeError, ValueError):
-               value = last_price[depth_index]
-         price_values.append(value)
-         value = last_size[depth_index]
-         if size_row and depth_index < len(size_row) and size_row[depth_index] is not None:
-            try:
-               value = float(size_row[depth_index])
-            except (TypeError, ValueError):
-               value = last_size[depth_index]
-         size_values.append(value)
-      cleaned_price.append(price_values)
-      cleaned_size.append(size_values)
-      last_price = price_values
-      last_size = size_values
-   return cleaned_price,cleaned_size,depth
-
-def sanitize_trades(trade_samples,expected_len=3):
-   trade_samples = trade_samples or []
-   cleaned = []
-   last = [0.0]*expected_len
-   for row in trade_samples:
-      values = []
-      for idx in range(expected_len):
-         value = last[idx]
-         if row and idx < len(row) and row[idx] is not None:
-            try:
-               value = float(row[idx])
-            except (TypeError, ValueError):
-               value = last[idx]
-         values.append(value)
-      cleaned.append(values)
-      last = values
-   if len(cleaned) == 0:
-      cleaned.append(last)
-   return cleaned
-
-def ensure_length(series,target,template):
-   series = series or []
-   result = []
-   for item in series:
-      if isinstance(item,(list,tuple)):
-         result.append(list(item))
-      else:
-         result.append(item)
-   if len(result) == 0:
-      result.append(template())
-   last = result[-1]
-   while len(result) < target:
-      result.append(list(last) if isinstance(last,list) else last)
-   if len(result) > target:
-      result = result[:target]
-   return result
-
-def trim_depth(series,depth):
-   trimmed = []
-   for row in series:
-      trimmed.append([ float(x) for x in row[:depth] ])
-   return trimmed
+from gaf import IncrementalGAF,BatchGAF,LeanGAF,Polar,reference,paa
+from mtf import MarkovTransition
+from samples import getSampleWindows
+from ringbuffer import getRingWindows
+from shmring import getSharedWindows,waitForRings
+from notify import listen,waitForSamples
+from leases import LeaseManager
+from output import OutputWriter,textImage
+from parallel import ProductPool,unpack
+from sanitize import sanitize_midpoints,sanitize_orderbook,sanitize_trades,fit_length
+from images import quantize,toRGB,PngCodec,getCodec,ImageEncoder
+from smoothing import getKernel
+import checkpoint
+from metrics import UPDATES,UNCHANGED,SKIPPED,DRIFT,LEASED,SHARED,FIRST_IMAGE,StageTimer,serve,stage,observeLag,recordLag
+
 
 def getGafInfo(conn,cur):
    cur.execute( """
-      SELECT product,max_size FROM crypto_gaf.gafs
+      SELECT product,max_size,smoothing,image_size,pyramid_levels FROM crypto_gaf.gafs
       """)
    rows = cur.fetchall()
-   return [ [x[0],x[1]] for x in rows ]
+   return [ [x[0],x[1],x[2],x[3],x[4]] for x in rows ]
 
-def getMidpointSamples(conn,cur,product,maxSize):
-   cur.execute( """
-      SELECT midpoint FROM crypto_gaf.samples WHERE product = %s ORDER BY sample_id desc LIMIT %s
-      """,(product,maxSize))
-   rows = cur.fetchall()
-   return [ x[0] for x in rows ]
+def getKernels(gafInfo,smoothing,invalid):
+   # product -> smoothing kernel; a bad gafs.smoothing falls back to the default and is reported once
+   kernels = {}
+   for product,maxSize,spec,imageSize,pyramidLevels in gafInfo:
+      kernels[product] = getKernel(smoothing)
+      if spec is None:
+         continue
+      try:
+         kernels[product] = getKernel(spec)
+      except ValueError as e:
+         if (product,spec) not in invalid: print(f"{product}: {e}, using {smoothing}")
+         invalid.add((product,spec))
+   return kernels
 
-def getMidpointFields(samples,size):
+def getFieldState(states,product):
+   state = states.get(product,None)
+   if state is None:
+      state = {
+         'lastSampleId': None,
+         'midpointSummation': IncrementalGAF('summation'),
+         'midpointDifference': IncrementalGAF('difference'),
+         'orderbook': IncrementalGAF('summation'),
+         'buy': IncrementalGAF('summation'),
+         'sell': IncrementalGAF('summation')
+      }
+      states[product] = state
+   return state
+
+def getShift(state,sampleIds):
+   lastSampleId = state['lastSampleId']
+   if lastSampleId is None or len(sampleIds) == 0:
+      return None
+   return int(np.count_nonzero(sampleIds > lastSampleId))
+
+def getOutputSizes(size,imageSize,pyramidLevels):
+   # PAA only shrinks: an image_size of 0 or not below the window keeps one pixel per sample;
+   # each pyramid level halves the previous one, down to 2 pixels
+   top = imageSize if 2 <= imageSize < size else size
+   levels = tuple(x for x in (top >> k for k in range(1,pyramidLevels + 1)) if x >= 2)
+   return top,levels
+
+def getMidpointFields(samples,size,state=None,shift=None):
+   if state is not None:
+      # summation and difference share one rescale of the series
+      prepared = Polar(paa(samples,size))
+      return [ state['midpointSummation'].update(prepared,shift)[0],state['midpointDifference'].update(prepared,shift)[0] ]
    fields = []
+   # pyts takes seconds to import and only these reference paths use it, so it loads on first use
+   from pyts.image import GramianAngularField
    g = GramianAngularField(image_size=size,method='summation')
-   S = np.array(samples).reshape(1,size)
+   S = np.array(samples).reshape(1,-1)
    T = g.fit_transform(S)
    fields.append(T[0])
    g = GramianAngularField(image_size=size,method='difference')
-   S = np.array(samples).reshape(1,size)
+   S = np.array(samples).reshape(1,-1)
    T = g.fit_transform(S)
    fields.append(T[0])
    return fields
 
+def getMarkov(job):
+   # quantile bins and transitions of the midpoint, once per window for every image size
+   markov = job.get('markov',None)
+   if markov is None:
+      markov = MarkovTransition(job['midpoint'],job['mtfBins'])
+      job['markov'] = markov
+   return markov
+
+def getMtfField(job,size,native=True):
+   if native:
+      return getMarkov(job).field(size)
+   from pyts.image import MarkovTransitionField
+   M = MarkovTransitionField(image_size=size,n_bins=job['mtfBins'])
+   return M.fit_transform(np.array(job['midpoint']).reshape(1,-1))[0]
+
 def getMidpointImages(midpointFields):
-   images = []
-   for i in range(len(midpointFields)):
-      scaled = ((midpointFields[i] + 1)/2)*255
-      formatted = scaled.astype(np.uint8)
-      image = io.BytesIO()
-      PIL.Image.fromarray(formatted).save(image,'png')
-      images.append(base64.b64encode(image.getvalue()).decode())
-   return images
-
-def getAskSamples(conn,cur,product,maxSize):
-   cur.execute( """
-      SELECT ask_prices,ask_sizes FROM crypto_gaf.samples WHERE product = %s ORDER BY sample_id desc LIMIT %s
-      """,(product,maxSize))
-   rows = cur.fetchall()
-   return [ x[0] for x in rows ],[ x[1] for x in rows ]
+   # GASF and GADF span [-1,1]; an MTF, when present, holds probabilities in [0,1]
+   return [ quantize(x) for x in midpointFields[:2] ] + [ quantize(2*x - 1) for x in midpointFields[2:] ]
 
 def getAskPriceFields(samples,size):
+   from pyts.image import GramianAngularField
    G = GramianAngularField(image_size=size,method='summation')
    S = np.transpose(np.array(samples))
    T = G.fit_transform(S)
    return T
 
-def getAskPriceImages(askPriceFields):
-   images = []
-   #for i in range(askPriceFields.shape[0]):
-   #   scaled = ((askPriceFields[i] + 1)/2)*255
-   #   formatted = scaled.astype(np.uint8)
-   #   image = io.BytesIO()
-   #   PIL.Image.fromarray(formatted).save(image,'png')
-   #   images.append(base64.b64encode(image.getvalue()).decode())
-   stack = []
-   for i in range(3):
-      scaled = ((askPriceFields[i] + 1)/2)*255
-      formatted = scaled.astype(np.uint8)
-      stack.append(formatted)
-   rgb = np.stack(stack,axis=2)
-   image = io.BytesIO()
-   PIL.Image.fromarray(rgb).save(image,'png')
-   images.append(base64.b64encode(image.getvalue()).decode())
-   return images
-
-def getBidSamples(conn,cur,product,maxSize):
-   cur.execute( """
-      SELECT bid_prices,bid_sizes FROM crypto_gaf.samples WHERE product = %s ORDER BY sample_id desc LIMIT %s
-      """,(product,maxSize))
-   rows = cur.fetchall()
-   return [ x[0] for x in rows ],[ x[1] for x in rows ]
+def getAskPriceImages(askPriceFields,codec=None):
+   if codec is None: codec = PngCodec()
+   return [ textImage(codec.encode(toRGB(askPriceFields))) ]
 
 def getBidPriceFields(samples,size):
+   from pyts.image import GramianAngularField
    G = GramianAngularField(image_size=size,method='summation')
    S = np.transpose(np.array(samples))
    T = G.fit_transform(S)
    return T
 
-def getBidPriceImages(bidPriceFields):
-   images = []
-   stack = []
-   for i in range(3):
-      scaled = ((bidPriceFields[i] + 1)/2)*255
-      formatted = scaled.astype(np.uint8)
-      stack.append(formatted)
-   rgb = np.stack(stack,axis=2)
-   image = io.BytesIO()
-   PIL.Image.fromarray(rgb).save(image,'png')
-   images.append(base64.b64encode(image.getvalue()).decode())
-   return images
-
-def getOrderbookField(askPriceSamples,askSizeSamples,bidPriceSamples,bidSizeSamples,size):
-   numSamples = len(askPriceSamples)
-   depth = len(askPriceSamples[0])
-   samples = []
-   for i in range(numSamples):
-      samples.append([])
-      for j in range(depth): 
-         samples[i].append((askPriceSamples[i][j]*askSizeSamples[i][j] - bidPriceSamples[i][j]*bidSizeSamples[i][j])/(askSizeSamples[i][j] + bidSizeSamples[i][j]))
+def getBidPriceImages(bidPriceFields,codec=None):
+   if codec is None: codec = PngCodec()
+   return [ textImage(codec.encode(toRGB(bidPriceFields))) ]
+
+def getOrderbookSeries(askPriceSamples,askSizeSamples,bidPriceSamples,bidSizeSamples):
+   askPrices = np.asarray(askPriceSamples,dtype=np.float64)
+   askSizes = np.asarray(askSizeSamples,dtype=np.float64)
+   bidPrices = np.asarray(bidPriceSamples,dtype=np.float64)
+   bidSizes = np.asarray(bidSizeSamples,dtype=np.float64)
+   volume = askSizes + bidSizes
+   if not volume.all():
+      raise ZeroDivisionError("float division by zero")
+   samples = (askPrices*askSizes - bidPrices*bidSizes)/volume
+   return np.transpose(samples)
+
+def getOrderbookField(askPriceSamples,askSizeSamples,bidPriceSamples,bidSizeSamples,size,state=None,shift=None):
+   S = getOrderbookSeries(askPriceSamples,askSizeSamples,bidPriceSamples,bidSizeSamples)
+   if state is not None:
+      return state['orderbook'].update(paa(S,size),shift)
+   from pyts.image import GramianAngularField
    G = GramianAngularField(image_size=size,method='summation')
-   S = np.transpose(np.array(samples))
    T = G.fit_transform(S)
    return T
    
 def fieldToRGB(field,permutation=None):
-   stack = []
-   for i in range(3):
-      if permutation != None: index = permutation[i]
-      else: index = i
-      scaled = ((field[index] + 1)/2)*255
-      formatted = scaled.astype(np.uint8)
-      stack.append(formatted)
-   rgb = np.stack(stack,axis=2)
-   image = io.BytesIO()
-   PIL.Image.fromarray(rgb).save(image,'png')
-   return base64.b64encode(image.getvalue()).decode()
-
-def getBuyAndSellSamples(conn,cur,product,maxSize):
-   cur.execute( """
-      SELECT 
-         avg(buys[1]) over (order by sample_id desc rows between 5 preceding and 5 following),
-         avg(buys[2]) over (order by sample_id desc rows between 5 preceding and 5 following),
-         avg(buys[3]) over (order by sample_id desc rows between 5 preceding and 5 following),
-         avg(sells[1]) over (order by sample_id desc rows between 5 preceding and 5 following),
-         avg(sells[2]) over (order by sample_id desc rows between 5 preceding and 5 following),
-         avg(sells[3]) over (order by sample_id desc rows between 5 preceding and 5 following)
-      FROM crypto_gaf.samples WHERE product = %s ORDER BY sample_id desc LIMIT %s
-      """,(product,maxSize))
-   rows = cur.fetchall()
-   return [ [x[0],x[1],x[2]] for x in rows ],[ [x[3],x[4],x[5]] for x in rows ]
+   return toRGB(field,permutation)
 
-def getBuyField(samples,size):
+def getBuyField(samples,size,state=None,shift=None):
+   if state is not None:
+      return state['buy'].update(paa(np.transpose(np.array(samples)),size),shift)
+   from pyts.image import GramianAngularField
    G = GramianAngularField(image_size=size,method='summation')
    S = np.transpose(np.array(samples))
    T = G.fit_transform(S)
    return T
 
-def getSellField(samples,size):
+def getSellField(samples,size,state=None,shift=None):
+   if state is not None:
+      return state['sell'].update(paa(np.transpose(np.array(samples)),size),shift)
+   from pyts.image import GramianAngularField
    G = GramianAngularField(image_size=size,method='summation')
    S = np.transpose(np.array(samples))
    T = G.fit_transform(S)
    return T
 
-def doUpdate(conn,cur,product,size,midpoint,midpointImages,orderbookImage,buyImage,sellImage):
-   sql = """
-      UPDATE crypto_gaf.gafs SET midpoint = %s,midpoint_images = %s,orderbook_image = %s,buy_image = %s,sell_image = %s,size = %s WHERE product = %s 
-   """
-   cur.execute(sql,(midpoint,midpointImages,orderbookImage,buyImage,sellImage,size,product))
+def prepareSamples(product,window,imageSize=0,pyramidLevels=0,mtfBins=0):
+   midpointSamples = sanitize_midpoints(window['midpoint'])
+   size = len(midpointSamples)
+   if size < 21:
+      return None
+   askPriceSamples,askSizeSamples,askDepth = sanitize_orderbook(window['askPrices'],window['askSizes'])
+   bidPriceSamples,bidSizeSamples,bidDepth = sanitize_orderbook(window['bidPrices'],window['bidSizes'])
+   depth = min(askDepth,bidDepth)
+   if depth == 0:
+      return None
+   imageSize,levels = getOutputSizes(size,imageSize,pyramidLevels)
+   return {
+      'product': product,
+      'size': size,
+      'imageSize': imageSize,
+      'levels': levels,
+      'mtfBins': mtfBins,
+      'sampleIds': window['sampleIds'],
+      'midpoint': midpointSamples,
+      'askPrices': fit_length(askPriceSamples,size,depth)[:,:depth],
+      'askSizes': fit_length(askSizeSamples,size,depth)[:,:depth],
+      'bidPrices': fit_length(bidPriceSamples,size,depth)[:,:depth],
+      'bidSizes': fit_length(bidSizeSamples,size,depth)[:,:depth],
+      'buys': fit_length(sanitize_trades(window['buys']),size,3),
+      'sells': fit_length(sanitize_trades(window['sells']),size,3)
+   }
+
+def getProductFields(job,state=None):
+   size = job['imageSize']
+   # PAA windows move with every new sample, so a reduced field cannot be shifted
+   shift = getShift(state,job['sampleIds']) if state is not None and size == job['size'] else None
+   midpointFields = getMidpointFields(job['midpoint'],size,state,shift)
+   if job['mtfBins'] > 0: midpointFields.append(getMtfField(job,size,state is not None))
+   orderbookField = getOrderbookField(job['askPrices'],job['askSizes'],job['bidPrices'],job['bidSizes'],size,state,shift)
+   buyField = getBuyField(job['buys'],size,state,shift)
+   sellField = getSellField(job['sells'],size,state,shift)
+   if state is not None:
+      state['lastSampleId'] = job['sampleIds'][0]
+   return midpointFields,orderbookField,buyField,sellField
+
+def getStack(job):
+   # every series of a product as one (channels,samples) array: midpoint, orderbook depth, buys, sells
+   orderbook = getOrderbookSeries(job['askPrices'],job['askSizes'],job['bidPrices'],job['bidSizes'])
+   return np.concatenate([job['midpoint'].reshape(1,-1),orderbook,np.transpose(job['buys']),np.transpose(job['sells'])])
+
+def splitFields(job,size,summation,difference):
+   depth = summation.shape[0] - 7
+   midpointFields = [summation[0],difference[0]]
+   if job['mtfBins'] > 0: midpointFields.append(getMtfField(job,size))
+   return midpointFields,summation[1:1 + depth],summation[1 + depth:4 + depth],summation[4 + depth:]
+
+def getBatchFields(jobs,batch):
+   groups = {}
+   for job in jobs:
+      try:
+         stack = paa(getStack(job),job['imageSize'])
+      except ZeroDivisionError as err:
+         print(f"calculate: skipping {job['product']} due to data shape error: {err}")
+         SKIPPED.labels(job['product']).inc()
+         continue
+      groups.setdefault(stack.shape,[]).append((job,stack))
+   for shape,members in groups.items():
+      for start in range(0,len(members),batch.maxProducts):
+         chunk = members[start:start + batch.maxProducts]
+         result = batch.transform(np.stack([ x[1] for x in chunk ]),differenceChannels=1)
+         for k in range(len(chunk)):
+            job = chunk[k][0]
+            yield job,splitFields(job,job['imageSize'],result['summation'][k],result['difference'][k])
+
+def getPyramidFields(job,pyramid):
+   # full rebuilds at each level; pyramid's buffers are reused, so consume each level before the next
+   if len(job['levels']) == 0:
+      return
+   stack = getStack(job)
+   for size in job['levels']:
+      result = pyramid.transform(paa(stack,size)[None],differenceChannels=1)
+      yield splitFields(job,size,result['summation'][0],result['difference'][0])
+
+def computeFields(jobs,backend,fieldStates,batch):
+   # yields (job,fields); batch buffers are reused, so consume each item before the next
+   if backend == 'batch':
+      yield from getBatchFields(jobs,batch)
+      return
+   for job in jobs:
+      product = job['product']
+      state = getFieldState(fieldStates,product) if backend == 'incremental' else None
+      try:
+         fields = getProductFields(job,state)
+      except (IndexError, ZeroDivisionError) as err:
+         print(f"calculate: skipping {product} due to data shape error: {err}")
+         SKIPPED.labels(product).inc()
+         fieldStates.pop(product,None)
+         continue
+      yield job,fields
+
+def checkFields(job,fields):
+   midpointFields,orderbookField,buyField,sellField = fields
+   midpoint = job['midpoint'].reshape(1,-1)
+   orderbook = getOrderbookSeries(job['askPrices'],job['askSizes'],job['bidPrices'],job['bidSizes'])
+   size = job['imageSize']
+   expected = [
+      (midpointFields[0],reference(midpoint,'summation',size)[0]),
+      (midpointFields[1],reference(midpoint,'difference',size)[0]),
+      (orderbookField,reference(orderbook,'summation',size)),
+      (buyField,reference(np.transpose(job['buys']),'summation',size)),
+      (sellField,reference(np.transpose(job['sells']),'summation',size))
+   ]
+   # the native MTF sums block means in another order than pyts
+   if job['mtfBins'] > 0 and not np.allclose(midpointFields[2],getMtfField(job,size,False),rtol=0,atol=1e-9):
+      print(f"calculate: MTF output for {job['product']} differs from the pyts reference")
+   if not all(np.array_equal(x,y) for x,y in expected):
+      print(f"calculate: GAF output for {job['product']} differs from the pyts reference")
+
+def getPixels(fields):
+   midpointFields,orderbookField,buyField,sellField = fields
+   return getMidpointImages(midpointFields) + [ fieldToRGB(orderbookField),fieldToRGB(buyField,permutation=[1,0,2]),fieldToRGB(sellField) ]
+
+def getPyramidPixels(job,pyramid):
+   pixels = []
+   for fields in getPyramidFields(job,pyramid):
+      pixels += getPixels(fields)
+   return pixels
+
+def getLeanPixels(job,size,lean):
+   # what getPixels(fields) gives, computed in float32 into the uint8 buffers of lean, which are reused for the next product
+   stack = paa(getStack(job),size)
+   depth = stack.shape[0] - 7
+   if depth < 3:
+      raise IndexError(f"orderbook depth {depth} is below the 3 image channels")
+   prepared = Polar(stack)
+   gray = [ lean.buffer(('gray',size,k),(size,size),np.uint8) for k in range(3) ]
+   pixels = [ lean.pixels(prepared,0,'summation',gray[0]),lean.pixels(prepared,0,'difference',gray[1]) ]
+   if job['mtfBins'] > 0: pixels.append(getMarkov(job).pixels(size,gray[2],lean.scratch(size)))
+   # orderbook, buy (price and size swapped, as in getPixels) and sell channels of the stack
+   for k,channels in enumerate([ (1,2,3),(2 + depth,1 + depth,3 + depth),(4 + depth,5 + depth,6 + depth) ]):
+      rgb = lean.buffer(('rgb',size,k),(size,size,3),np.uint8)
+      for c,channel in enumerate(channels):
+         lean.pixels(prepared,channel,'summation',rgb[:,:,c])
+      pixels.append(rgb)
+   return pixels
+
+def checkPixels(job,pixels,batch):
+   for _,fields in getBatchFields([job],batch):
+      worst = max(int(np.abs(x.astype(np.int16) - y).max()) for x,y in zip(pixels,getPixels(fields)))
+      if worst > 1: print(f"calculate: lean pixels for {job['product']} differ from the float64 path by {worst} levels")
+
+def encodeProduct(job,pixels,levelPixels,encoder):
+   # images come back encoded with the encoder's codec, as bytes; pyramid levels follow in one flat list,
+   # the midpoint images (summation, difference, MTF), orderbook, buy and sell per level
+   count = len(pixels)
+   images = encoder.encode(pixels + levelPixels)
+   return job['product'],job['imageSize'],float(job['midpoint'][0]),images[:count - 3],images[count - 3],images[count - 2],images[count - 1],images[count:]
+
+def renderProduct(job,fields,encoder,check=False,levelPixels=[]):
+   if check: checkFields(job,fields)
+   return encodeProduct(job,getPixels(fields),levelPixels,encoder)
+
+def renderLean(jobs,lean,encoder,check=False):
+   compute,encode = StageTimer('compute'),StageTimer('encode')
+   batch = BatchGAF(1) if check else None
+   try:
+      for job in jobs:
+         with compute:
+            try:
+               pixels = getLeanPixels(job,job['imageSize'],lean)
+               levelPixels = [ x for size in job['levels'] for x in getLeanPixels(job,size,lean) ]
+            except (IndexError, ZeroDivisionError) as err:
+               print(f"calculate: skipping {job['product']} due to data shape error: {err}")
+               SKIPPED.labels(job['product']).inc()
+               continue
+            if check: checkPixels(job,pixels,batch)
+         with encode:
+            result = encodeProduct(job,pixels,levelPixels,encoder)
+         yield result
+   finally:
+      compute.observe()
+      encode.observe()
+
+def renderProducts(jobs,backend,fieldStates,batch,encoder,check=False):
+   # compute and encode time is observed per pass, leaving out the time the caller spends between results;
+   # batch is a LeanGAF with the lean backend
+   if backend == 'lean':
+      yield from renderLean(jobs,batch,encoder,check)
+      return
+   compute,encode = StageTimer('compute'),StageTimer('encode')
+   fields = computeFields(jobs,backend,fieldStates,batch)
+   pyramid = BatchGAF(1)
+   try:
+      while True:
+         with compute:
+            item = next(fields,None)
+            if item is not None: levelPixels = getPyramidPixels(item[0],pyramid)
+         if item is None:
+            return
+         with encode:
+            result = renderProduct(*item,encoder,check,levelPixels)
+         yield result
+   finally:
+      compute.observe()
+      encode.observe()
+
+workerState = {}
+
+def initWorker(backend,batchProducts,check,imageFormat,encodeThreads):
+   workerState['backend'] = backend
+   workerState['check'] = check
+   workerState['fieldStates'] = {}
+   workerState['batch'] = LeanGAF() if backend == 'lean' else BatchGAF(batchProducts)
+   workerState['encoder'] = ImageEncoder(getCodec(imageFormat),encodeThreads)
+
+def processProduct(name,packed):
+   job = unpack(name,packed)
+   for result in renderProducts([job],workerState['backend'],workerState['fieldStates'],workerState['batch'],workerState['encoder'],workerState['check']):
+      return result
+   return None
+
+def doUpdate(conn,cur,product,size,midpoint,midpointImages,orderbookImage,buyImage,sellImage,pyramidImages=None,storage='text',imageFormat='png',owner=None):
+   # writes one product unconditionally (see OutputWriter for the batched, hashed path the worker uses);
+   # with an owner the row is only written while that owner holds a valid lease on it; returns whether it was
+   writer = OutputWriter(storage,imageFormat)
+   writer.add(product,size,midpoint,midpointImages,orderbookImage,buyImage,sellImage,pyramidImages)
+   return len(writer.flush(conn,cur,owner)) > 0
+
+def restoreCheckpoint(cur,path,settings,writer,rendered,rings=None,fieldStates=None):
+   # maps the last checkpoint back in; rings and field states are only restored when passed
+   loaded = checkpoint.load(path)
+   if loaded is None:
+      return
+   stamp,files,state = loaded
+   if rings is not None:
+      for product,saved in state['rings'].items():
+         ring = checkpoint.loadRing(files,saved)
+         if ring is not None: rings[product] = ring
+   if fieldStates is not None:
+      for product,saved in state['fields'].items():
+         checkpoint.loadFieldState(files,saved,getFieldState(fieldStates,product))
+   # images written under other settings are rendered again
+   if state['settings'] == settings:
+      cur.execute("SELECT product,etag FROM crypto_gaf.gafs")
+      current = dict(cur.fetchall())
+      for product,(written,windowKey) in checkpoint.writtenStates(state).items():
+         if writer.restore(product,written,current.get(product,None)): rendered[product] = windowKey
+   print(f"calculate: restored checkpoint {stamp}, {len(rings or {})} windows, {len(fieldStates or {})} field states, {len(rendered)} current products")
+
+def saveCheckpoint(path,settings,writer,rendered,rings,fieldStates):
+   try:
+      with stage('checkpoint'):
+         checkpoint.save(path,settings,rings,fieldStates,rendered,writer.written)
+   except OSError as e:
+      print(f"calculate: checkpoint to {path} failed, {e}")
 
 def main(args):
    postgresUser = "postgres"
@@ -276,74 +432,254 @@ def main(args):
    sleepInterval = 1
    aggregation = 10
    depth = 5
+   gafBackend = 'incremental'
+   gafBatchProducts = 8
+   gafCheck = False
+   workers = 0
+   pool = None
+   trigger = 'poll'
+   fallbackInterval = 5
+   coalesceWindow = 0.05
+   listenConn = None
+   fetchMode = 'window'
+   transport = 'db'
+   shmStale = 10
+   sampleFormat = 'numeric'
+   smoothing = 'box:5'
+   imageSize = 0
+   pyramidLevels = 0
+   mtfBins = 0
+   shardMode = 'none'
+   leaseTtl = 15
+   leases = None
+   imageFormat = 'png'
+   imageStorage = 'text'
+   encodeThreads = 0
+   encoder = None
+   metricsPort = 0
+   checkpointPath = ''
+   checkpointInterval = 60
    if os.environ.get('POSTGRES_USER') != None: postgresUser = os.environ.get('POSTGRES_USER')
    if os.environ.get('POSTGRES_PW') != None: postgresPw = os.environ.get('POSTGRES_PW')
    if os.environ.get('POSTGRES_HOST') != None: postgresHost = os.environ.get('POSTGRES_HOST')
    if os.environ.get('POSTGRES_PORT') != None: postgresPort = int(os.environ.get('POSTGRES_PORT'))
    if os.environ.get('POSTGRES_DB') != None: postgresDb = os.environ.get('POSTGRES_DB')
    if os.environ.get('SLEEP_INTERVAL') != None: sleepInterval = float(os.environ.get('SLEEP_INTERVAL'))
+   if os.environ.get('GAF_BACKEND') != None: gafBackend = os.environ.get('GAF_BACKEND')
+   if os.environ.get('GAF_BATCH_PRODUCTS') != None: gafBatchProducts = int(os.environ.get('GAF_BATCH_PRODUCTS'))
+   if os.environ.get('GAF_CHECK') != None: gafCheck = os.environ.get('GAF_CHECK').lower() in ('1','true','yes')
+   if os.environ.get('WORKERS') != None: workers = int(os.environ.get('WORKERS'))
+   if os.environ.get('TRIGGER') != None: trigger = os.environ.get('TRIGGER')
+   if os.environ.get('FALLBACK_INTERVAL') != None: fallbackInterval = float(os.environ.get('FALLBACK_INTERVAL'))
+   if os.environ.get('COALESCE_WINDOW') != None: coalesceWindow = float(os.environ.get('COALESCE_WINDOW'))
+   if os.environ.get('FETCH_MODE') != None: fetchMode = os.environ.get('FETCH_MODE')
+   if os.environ.get('TRANSPORT') != None: transport = os.environ.get('TRANSPORT')
+   if os.environ.get('SHM_STALE') != None: shmStale = float(os.environ.get('SHM_STALE'))
+   if os.environ.get('SAMPLE_FORMAT') != None: sampleFormat = os.environ.get('SAMPLE_FORMAT')
+   if os.environ.get('SMOOTHING') != None: smoothing = os.environ.get('SMOOTHING')
+   if os.environ.get('IMAGE_SIZE') != None: imageSize = int(os.environ.get('IMAGE_SIZE'))
+   if os.environ.get('PYRAMID_LEVELS') != None: pyramidLevels = int(os.environ.get('PYRAMID_LEVELS'))
+   if os.environ.get('MTF_BINS') != None: mtfBins = int(os.environ.get('MTF_BINS'))
+   if os.environ.get('SHARD_MODE') != None: shardMode = os.environ.get('SHARD_MODE')
+   if os.environ.get('LEASE_TTL') != None: leaseTtl = float(os.environ.get('LEASE_TTL'))
+   if os.environ.get('IMAGE_FORMAT') != None: imageFormat = os.environ.get('IMAGE_FORMAT')
+   if os.environ.get('IMAGE_STORAGE') != None: imageStorage = os.environ.get('IMAGE_STORAGE')
+   if os.environ.get('ENCODE_THREADS') != None: encodeThreads = int(os.environ.get('ENCODE_THREADS'))
+   if os.environ.get('METRICS_PORT') != None: metricsPort = int(os.environ.get('METRICS_PORT'))
+   if os.environ.get('CHECKPOINT_PATH') != None: checkpointPath = os.environ.get('CHECKPOINT_PATH')
+   if os.environ.get('CHECKPOINT_INTERVAL') != None: checkpointInterval = float(os.environ.get('CHECKPOINT_INTERVAL'))
    if args.pg_user != None: postgresUser = args.pg_user
    if args.pg_pw != None: postgresPw = args.pg_pw
    if args.pg_host != None: postgresHost = args.pg_host
    if args.pg_port != None: postgresPort = int(args.pg_port)
    if args.db != None: postgresDb = args.db
    if args.sleep != None: sleepInterval = float(args.sleep)
+   if args.gaf_backend != None: gafBackend = args.gaf_backend
+   if args.gaf_batch != None: gafBatchProducts = int(args.gaf_batch)
+   if args.gaf_check: gafCheck = True
+   if args.workers != None: workers = int(args.workers)
+   if args.trigger != None: trigger = args.trigger
+   if args.fallback != None: fallbackInterval = float(args.fallback)
+   if args.fetch_mode != None: fetchMode = args.fetch_mode
+   if args.transport != None: transport = args.transport
+   if args.shm_stale != None: shmStale = float(args.shm_stale)
+   if args.sample_format != None: sampleFormat = args.sample_format
+   if args.smoothing != None: smoothing = args.smoothing
+   if args.image_size != None: imageSize = int(args.image_size)
+   if args.pyramid_levels != None: pyramidLevels = int(args.pyramid_levels)
+   if args.mtf_bins != None: mtfBins = int(args.mtf_bins)
+   if args.shard_mode != None: shardMode = args.shard_mode
+   if args.lease_ttl != None: leaseTtl = float(args.lease_ttl)
+   if args.image_format != None: imageFormat = args.image_format
+   if args.image_storage != None: imageStorage = args.image_storage
+   if args.encode_threads != None: encodeThreads = int(args.encode_threads)
+   if args.metrics_port != None: metricsPort = int(args.metrics_port)
+   if args.checkpoint_path != None: checkpointPath = args.checkpoint_path
+   if args.checkpoint_interval != None: checkpointInterval = float(args.checkpoint_interval)
    if postgresPw is None and os.path.exists('/run/secrets/pg_pw'):
       with open('/run/secrets/pg_pw') as secret:
          postgresPw = secret.read().strip()
    try:
+      if gafBackend not in ('incremental','batch','pyts','lean'):
+         raise ValueError(f"unknown GAF backend {gafBackend}")
+      if trigger not in ('poll','notify','ring'):
+         raise ValueError(f"unknown trigger {trigger}")
+      if transport not in ('db','shm'):
+         raise ValueError(f"unknown transport {transport}")
+      if trigger == 'ring' and transport != 'shm':
+         raise ValueError("the ring trigger needs TRANSPORT=shm")
+      if fetchMode not in ('window','delta'):
+         raise ValueError(f"unknown fetch mode {fetchMode}")
+      if sampleFormat not in ('numeric','packed'):
+         raise ValueError(f"unknown sample format {sampleFormat}")
+      getKernel(smoothing)
+      if imageSize < 0 or pyramidLevels < 0:
+         raise ValueError(f"image size {imageSize} and pyramid levels {pyramidLevels} must not be negative")
+      if mtfBins < 0 or mtfBins == 1:
+         raise ValueError(f"MTF bins must be 0 (no MTF) or at least 2, got {mtfBins}")
+      if shardMode not in ('none','lease'):
+         raise ValueError(f"unknown shard mode {shardMode}")
+      encoder = ImageEncoder(getCodec(imageFormat),encodeThreads)
+      writer = OutputWriter(imageStorage,encoder.codec.name)
+      batch = LeanGAF() if gafBackend == 'lean' else BatchGAF(gafBatchProducts)
+      # the pool is created before connecting so workers never share the connection
+      if workers > 0: pool = ProductPool(workers,initWorker,(gafBackend,gafBatchProducts,gafCheck,imageFormat,encodeThreads))
+      serve(metricsPort)
       startTime = time.time()
       iterations = 0
       conn = psycopg.connect(host=postgresHost, port=postgresPort, dbname=postgresDb, user=postgresUser, password=postgresPw)
+      if trigger == 'notify':
+         listenConn = listen(host=postgresHost, port=postgresPort, dbname=postgresDb, user=postgresUser, password=postgresPw)
+      # pod shutdown sends SIGTERM; the pass in flight finishes, then finally releases leases and stops the pool
+      stopping = threading.Event()
+      signal.signal(signal.SIGTERM,lambda signum,frame: stopping.set())
+      if shardMode == 'lease':
+         leases = LeaseManager(f"{socket.gethostname()}:{os.getpid()}",leaseTtl)
+         print(f"calculate: sharding products by lease as {leases.owner}")
       summaryWindow = 60
       summaryLast = time.time()
       summaryUpdates = 0
-      while True:
+      fieldStates = {}
+      rendered = {}
+      rings = {}
+      readers = {}
+      heads = {}
+      invalidSmoothing = set()
+      lastFullPass = 0
+      firstPass = True
+      # written images are only trusted from a checkpoint made with the same output settings
+      checkpointSettings = { 'backend': gafBackend, 'mtfBins': mtfBins, 'imageFormat': writer.imageFormat, 'imageStorage': imageStorage }
+      if checkpointPath != '':
+         os.makedirs(checkpointPath,exist_ok=True)
+         cur = conn.cursor()
+         restoreCheckpoint(cur,checkpointPath,checkpointSettings,writer,rendered,
+            rings if fetchMode == 'delta' else None,fieldStates if gafBackend == 'incremental' and pool is None else None)
+         cur.close()
+         conn.commit()
+      lastCheckpoint = time.monotonic()
+      while not stopping.is_set():
+         cycleStart = time.time()
+         products = None
+         if listenConn is not None and time.monotonic() - lastFullPass < fallbackInterval:
+            notified = waitForSamples(listenConn,lastFullPass + fallbackInterval - time.monotonic(),coalesceWindow)
+            if len(notified) > 0: products = list(notified)
+         elif trigger == 'ring' and time.monotonic() - lastFullPass < fallbackInterval:
+            moved = waitForRings(readers,heads,lastFullPass + fallbackInterval - time.monotonic(),coalesceWindow)
+            if len(moved) > 0: products = list(moved)
+         # a full pass also catches anything a missed notification left behind
+         if products is None: lastFullPass = time.monotonic()
+         if leases is not None and leases.due():
+            leases.refresh(conn)
+            LEASED.set(len(leases.owned))
          cur = conn.cursor()
          gafInfo = getGafInfo(conn,cur)
+         if leases is not None:
+            # the rest of the pass, resident state included, only sees this replica's products
+            gafInfo = [ x for x in gafInfo if x[0] in leases.owned ]
+            products = [ x for x in (products if products is not None else leases.owned) if x in leases.owned ]
+         kernels = getKernels(gafInfo,smoothing,invalidSmoothing)
+         with stage('fetch'):
+            published = {}
+            dbProducts = products
+            if transport == 'shm':
+               sampleWindows,published = getSharedWindows(readers,{ x[0]: x[1] for x in gafInfo },products,kernels,shmStale)
+               SHARED.set(len(sampleWindows))
+               # products without a live ring holding a whole window yet are read from the database
+               dbProducts = [ x[0] for x in gafInfo if (products is None or x[0] in products) and x[0] not in sampleWindows ]
+            else:
+               sampleWindows = {}
+            if dbProducts is None or len(dbProducts) > 0:
+               if fetchMode == 'delta':
+                  sampleWindows.update(getRingWindows(conn,rings,{ x[0]: x[1] for x in gafInfo },dbProducts,sampleFormat,kernels))
+               else:
+                  sampleWindows.update(getSampleWindows(conn,dbProducts,kernels,sampleFormat=sampleFormat))
+         for product in [ x for x in fieldStates if x not in [ y[0] for y in gafInfo ] ]:
+            del fieldStates[product]
+         for product in [ x for x in rendered if x not in [ y[0] for y in gafInfo ] ]:
+            del rendered[product]
+            writer.forget(product)
+         jobs = []
+         sanitize = StageTimer('sanitize')
          for i in range(len(gafInfo)):
             product = gafInfo[i][0]
-            maxSize = gafInfo[i][1]
-            midpointSamples = sanitize_midpoints(getMidpointSamples(conn,cur,product,maxSize))
-            if len(midpointSamples) < 21:
-               continue
-            askPriceSamples,askSizeSamples,askDepth = sanitize_orderbook(*getAskSamples(conn,cur,product,maxSize))
-            bidPriceSamples,bidSizeSamples,bidDepth = sanitize_orderbook(*getBidSamples(conn,cur,product,maxSize))
-            buySamples,sellSamples = getBuyAndSellSamples(conn,cur,product,maxSize)
-            buySamples = sanitize_trades(buySamples)
-            sellSamples = sanitize_trades(sellSamples)
-            if not askPriceSamples or not bidPriceSamples:
+            window = sampleWindows.get(product,None)
+            if window is None:
                continue
-            depth = min(askDepth,bidDepth)
-            if depth == 0:
+            # gafs.image_size and gafs.pyramid_levels override the defaults when set
+            productImageSize = gafInfo[i][3] if gafInfo[i][3] is not None else imageSize
+            productLevels = gafInfo[i][4] if gafInfo[i][4] is not None else pyramidLevels
+            # skip products whose window (smoothing, image sizes) has not changed since their last image
+            windowKey = (int(window['sampleIds'][0]),len(window['sampleIds']),kernels[product].spec,productImageSize,productLevels)
+            if rendered.get(product,None) == windowKey:
                continue
-            askPriceSamples = trim_depth(ensure_length(askPriceSamples,len(midpointSamples),lambda: [0.0]*depth),depth)
-            askSizeSamples = trim_depth(ensure_length(askSizeSamples,len(midpointSamples),lambda: [0.0]*depth),depth)
-            bidPriceSamples = trim_depth(ensure_length(bidPriceSamples,len(midpointSamples),lambda: [0.0]*depth),depth)
-            bidSizeSamples = trim_depth(ensure_length(bidSizeSamples,len(midpointSamples),lambda: [0.0]*depth),depth)
-            buySamples = ensure_length(buySamples,len(midpointSamples),lambda: [0.0,0.0,0.0])
-            sellSamples = ensure_length(sellSamples,len(midpointSamples),lambda: [0.0,0.0,0.0])
-            size = len(midpointSamples)
-            if size < 21:
+            with sanitize:
+               job = prepareSamples(product,window,productImageSize,productLevels,mtfBins)
+            if job is not None:
+               job['windowKey'] = windowKey
+               jobs.append(job)
+         sanitize.observe()
+         windowKeys = { job['product']: job.pop('windowKey') for job in jobs }
+         if pool is not None:
+            with stage('render'):
+               results = pool.map(processProduct,jobs)
+         else:
+            results = renderProducts(jobs,gafBackend,fieldStates,batch,encoder,gafCheck)
+         update = StageTimer('update')
+         updated = []
+         for result in results:
+            if result is None:
                continue
-            if not askPriceSamples or not askPriceSamples[0]:
-               continue
-            try:
-               midpointFields = getMidpointFields(midpointSamples,size)
-               orderbookField = getOrderbookField(askPriceSamples,askSizeSamples,bidPriceSamples,bidSizeSamples,size)
-               buyField = getBuyField(buySamples,size)
-               sellField = getSellField(sellSamples,size)
-            except (IndexError, ZeroDivisionError) as err:
-               print(f"calculate: skipping {product} due to data shape error: {err}")
-               continue
-            midpointImages = getMidpointImages(midpointFields)
-            orderbookImage = fieldToRGB(orderbookField)
-            buyImage = fieldToRGB(buyField,permutation=[1,0,2])
-            sellImage = fieldToRGB(sellField)
-            doUpdate(conn,cur,product,size,midpointSamples[0],midpointImages,orderbookImage,buyImage,sellImage)
+            with update:
+               queued = writer.add(*result)
+            if not queued:
+               # byte-identical to the images already in crypto_gaf.gafs
+               rendered[result[0]] = windowKeys[result[0]]
+               UNCHANGED.labels(result[0]).inc()
+         with update:
+            written = writer.flush(conn,cur,owner=leases.owner if leases is not None else None)
+         for product in written:
+            rendered[product] = windowKeys[product]
+            if product not in published: updated.append(windowKeys[product][0])
+            UPDATES.labels(product).inc()
             summaryUpdates += 1
-         conn.commit()
+         update.observe()
+         with stage('commit'):
+            conn.commit()
+         if metricsPort > 0:
+            committed = time.time()
+            for product in written:
+               if product in published: recordLag(product,committed - published[product])
+            observeLag(cur,updated)
+            conn.commit()
          cur.close()
+         if firstPass:
+            elapsed = time.monotonic() - STARTED
+            FIRST_IMAGE.set(elapsed)
+            print(f"calculate: first pass committed {elapsed:.2f}s after start")
+            firstPass = False
+         if checkpointPath != '' and time.monotonic() - lastCheckpoint >= checkpointInterval:
+            saveCheckpoint(checkpointPath,checkpointSettings,writer,rendered,rings,fieldStates)
+            lastCheckpoint = time.monotonic()
          now = time.time()
          if now - summaryLast >= summaryWindow:
             if summaryUpdates > 0:
@@ -353,10 +689,24 @@ def main(args):
          currentTime = now
          iterations = iterations + 1
          sleepTime = startTime + iterations*sleepInterval - currentTime
+         if listenConn is not None or trigger == 'ring': sleepTime = cycleStart + sleepInterval - currentTime
+         DRIFT.set(-sleepTime)
          if(sleepTime < 0): sleepTime = 0
          time.sleep(sleepTime)
+      # a rollout restarts from the state the pod stopped with
+      if checkpointPath != '': saveCheckpoint(checkpointPath,checkpointSettings,writer,rendered,rings,fieldStates)
    except Exception as e:
       print(e)
+   finally:
+      # hand the products over right away instead of letting the leases expire
+      if leases is not None and len(leases.owned) > 0:
+         try:
+            conn.rollback()
+            leases.release(conn)
+         except psycopg.Error:
+            pass
+      if pool is not None: pool.shutdown()
+      if encoder is not None: encoder.shutdown()
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--pg_user', help="postgres user")
@@ -367,5 +717,29 @@ parser.add_argument('--db', help="postgres db")
 parser.add_argument('--kafka', help="kafka host")
 parser.add_argument('--sleep', help="sleep interval in seconds")
 parser.add_argument('--fetch', help="number of rows to fetch each interval")
-args = parser.parse_args()
-main(args)
+parser.add_argument('--gaf_backend', help="GAF backend: incremental, batch, pyts or lean (float32 straight to pixels)")
+parser.add_argument('--gaf_batch', help="products per batched GAF pass")
+parser.add_argument('--gaf_check', action='store_true', help="compare GAF output against the pyts reference")
+parser.add_argument('--workers', help="worker processes for compute and encode (0 runs in-process)")
+parser.add_argument('--trigger', help="poll (every sleep interval), notify (LISTEN for new samples from collect) or ring (watch the shared memory rings, TRANSPORT=shm)")
+parser.add_argument('--fallback', help="seconds between full passes in notify mode")
+parser.add_argument('--fetch_mode', help="window (re-read every window) or delta (keep windows resident, fetch new samples only)")
+parser.add_argument('--transport', help="db (read samples from PostgreSQL) or shm (read the shared memory rings collect publishes to, falling back to PostgreSQL)")
+parser.add_argument('--shm_stale', help="seconds without a beat from collect after which a shared memory ring is ignored")
+parser.add_argument('--sample_format', help="numeric (numeric[] sample columns) or packed (one bytea per sample)")
+parser.add_argument('--smoothing', help="default trade smoothing: box[:radius], gaussian[:sigma[:radius]], ema[:alpha[:radius]] or none")
+parser.add_argument('--image_size', help="default image side, reached by PAA over the window (0 keeps one pixel per sample)")
+parser.add_argument('--pyramid_levels', help="default number of extra images at half, quarter, ... the image size")
+parser.add_argument('--mtf_bins', help="quantile bins of the midpoint Markov transition field, appended to the midpoint images (0 disables)")
+parser.add_argument('--shard_mode', help="none (every replica renders every product) or lease (replicas share the products through leases)")
+parser.add_argument('--lease_ttl', help="seconds a product lease lasts without a heartbeat")
+parser.add_argument('--image_format', help="image codec: png[:level], webp[:method] (lossless) or raw")
+parser.add_argument('--image_storage', help="text (base64 columns), binary (bytea columns) or both")
+parser.add_argument('--encode_threads', help="threads for image encoding (0 encodes inline)")
+parser.add_argument('--metrics_port', help="port serving Prometheus /metrics (0 disables)")
+parser.add_argument('--checkpoint_path', help="directory for warm-state checkpoints, restored at startup (empty disables)")
+parser.add_argument('--checkpoint_interval', help="seconds between checkpoints")
+
+if __name__ == '__main__':
+   args = parser.parse_args()
+   main(args)
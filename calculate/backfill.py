@@ -0,0 +1,339 @@
+"""Offline backfill of GAF tensors over a product's sample history.
+
+   python backfill.py --product BTC-USD --output /data/btc --window 600 --stride 10 --image_size 64 --dtype uint8
+
+Samples are streamed oldest first through a server-side cursor (packed, or
+packed on the server with crypto_gaf.pack_sample() for numeric rows) and a
+window of --window samples slides forward by --stride.  Every window goes
+through the same smoothing, sanitizing and field code as the live worker, so
+a window ending at sample s holds the fields calculate would have rendered
+when s was the newest sample; the first window ends once the smoothing
+kernel has its older samples too.
+
+Windows are fanned out over --workers processes in batches, and each worker
+writes its tensors straight into the output shards, memory-mapped .npy files
+of --shard_windows windows each:
+
+   shard-00000.fields.npy   (windows, channels, size, size) uint8 or float16
+   shard-00000.meta.npy     oldest/newest sample_id, newest midpoint, valid
+   metadata.json            settings, channel names and the shard list
+
+uint8 channels are the pixels of the live images (MTF probabilities mapped
+onto the full range), float16 ones the raw fields.  Windows that cannot be
+rendered (too few samples, a shallower book than --orderbook_levels, a data
+shape error) stay zero with valid false.  Memory is bounded by --fetch_rows
+and the batches in flight, whatever the length of the range.
+"""
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import time
+import numpy as np
+import psycopg
+from concurrent.futures import ProcessPoolExecutor,FIRST_COMPLETED,wait
+from app import prepareSamples,getBatchFields,getMidpointImages,getOutputSizes
+from gaf import BatchGAF
+from images import quantize
+from samples import ORDERBOOK_KEYS,unpackSamples,smooth,head
+from smoothing import getKernel
+
+RANGE_SQL = """
+   SELECT count(*),min(sample_id),max(sample_id) FROM crypto_gaf.samples
+   WHERE product = %(product)s AND sample_id BETWEEN %(start)s AND %(end)s
+"""
+
+STREAM_SQL = """
+   SELECT sample_id,coalesce(packed,crypto_gaf.pack_sample(ask_prices,ask_sizes,bid_prices,bid_sizes,buys,midpoint,sells))
+   FROM crypto_gaf.samples
+   WHERE product = %(product)s AND sample_id BETWEEN %(start)s AND %(end)s
+   ORDER BY sample_id
+"""
+
+GAF_SQL = "SELECT max_size,smoothing,image_size FROM crypto_gaf.gafs WHERE product = %s"
+
+META_DTYPE = np.dtype([('first','<i8'),('last','<i8'),('midpoint','<f8'),('valid','?')])
+
+def getChannels(mtfBins,levels):
+   return ['gasf','gadf'] + (['mtf'] if mtfBins > 0 else []) + [ f"orderbook{k}" for k in range(levels) ] + ['buy_price','buy_size','buy_orders','sell_price','sell_size','sell_orders']
+
+def getTensor(fields,levels,dtype):
+   midpointFields,orderbookField,buyField,sellField = fields
+   rest = list(orderbookField[:levels]) + list(buyField) + list(sellField)
+   if dtype == 'float16':
+      return np.stack(list(midpointFields) + rest).astype(np.float16)
+   return np.stack(getMidpointImages(midpointFields) + [ quantize(x) for x in rest ])
+
+def concat(block,chunk):
+   # two oldest first sample blocks as one; order book columns are NaN padded to the wider of the two
+   if block is None:
+      return chunk
+   joined = {}
+   for key in block:
+      a,b = block[key],chunk[key]
+      if key in ORDERBOOK_KEYS and a.shape[1] != b.shape[1]:
+         width = max(a.shape[1],b.shape[1])
+         a = np.pad(a,((0,0),(0,width - a.shape[1])),constant_values=np.nan)
+         b = np.pad(b,((0,0),(0,width - b.shape[1])),constant_values=np.nan)
+      joined[key] = np.concatenate([a,b])
+   return joined
+
+def windowAt(block,end,rows):
+   # the rows samples of an oldest first block that end at end, newest first like getSampleWindows
+   return { key: values[end - rows + 1:end + 1][::-1] for key,values in block.items() }
+
+def createShard(output,index,windows,channels,size,dtype):
+   name = f"shard-{index:05d}"
+   shard = { 'fields': f"{name}.fields.npy", 'meta': f"{name}.meta.npy", 'windows': windows }
+   # open_memmap leaves sparse, zero filled files; the workers fill them in place
+   np.lib.format.open_memmap(os.path.join(output,shard['fields']),mode='w+',dtype=dtype,shape=(windows,channels,size,size)).flush()
+   np.lib.format.open_memmap(os.path.join(output,shard['meta']),mode='w+',dtype=META_DTYPE,shape=(windows,)).flush()
+   return shard
+
+workerState = {}
+
+def initWorker(settings):
+   workerState.update(settings)
+   workerState['kernel'] = getKernel(settings['smoothing'])
+   workerState['batch'] = BatchGAF(settings['batchProducts'])
+
+def renderWindows(block,ends,slots,fieldsPath,metaPath):
+   # renders the windows ending at ends (block rows) into shard slots; returns how many were valid
+   s = workerState
+   kernel = s['kernel']
+   fields = np.load(fieldsPath,mmap_mode='r+')
+   meta = np.load(metaPath,mmap_mode='r+')
+   jobs = []
+   for end,slot in zip(ends,slots):
+      window = head(smooth(windowAt(block,end,s['window'] + kernel.older),kernel),s['window'])
+      job = prepareSamples(s['product'],window,s['imageSize'],0,s['mtfBins'])
+      if job is None or job['imageSize'] != s['size'] or job['askPrices'].shape[1] < s['levels']:
+         continue
+      job['slot'] = slot
+      jobs.append(job)
+   valid = 0
+   for job,jobFields in getBatchFields(jobs,s['batch']):
+      fields[job['slot']] = getTensor(jobFields,s['levels'],s['dtype'])
+      meta[job['slot']] = (job['sampleIds'][-1],job['sampleIds'][0],job['midpoint'][0],True)
+      valid += 1
+   fields.flush()
+   meta.flush()
+   return valid
+
+def streamBlocks(conn,product,start,end,fetchRows):
+   # oldest first blocks of at most fetchRows samples, read through a server-side cursor
+   with conn.cursor(name='crypto_gaf_backfill',binary=True) as cur:
+      cur.itersize = fetchRows
+      cur.execute(STREAM_SQL,{ 'product': product, 'start': start, 'end': end })
+      while True:
+         rows = cur.fetchmany(fetchRows)
+         if len(rows) == 0:
+            return
+         sampleIds = np.array([ x[0] for x in rows ],dtype=np.int64)
+         lengths = np.array([ len(x[1]) for x in rows ],dtype=np.int64)
+         yield unpackSamples(sampleIds,lengths,b''.join(x[1] for x in rows))
+
+def backfill(conn,settings,output,start,end,stride,shardWindows,batchWindows,fetchRows,workers):
+   product = settings['product']
+   rows = settings['window'] + getKernel(settings['smoothing']).older
+   with conn.cursor() as cur:
+      cur.execute(RANGE_SQL,{ 'product': product, 'start': start, 'end': end })
+      count,first,last = cur.fetchone()
+   # pin the range so samples collect inserts meanwhile do not change the window count
+   total = (count - rows)//stride + 1 if count >= rows else 0
+   channels = getChannels(settings['mtfBins'],settings['levels'])
+   metadata = {
+      'product': product,
+      'first_sample_id': first,
+      'last_sample_id': last,
+      'samples': count,
+      'window': settings['window'],
+      'stride': stride,
+      'image_size': settings['size'],
+      'dtype': settings['dtype'],
+      'smoothing': settings['smoothing'],
+      'mtf_bins': settings['mtfBins'],
+      'orderbook_levels': settings['levels'],
+      'channels': channels,
+      'windows': total,
+      'shards': []
+   }
+   print(f"backfill: {product} samples {first}..{last} ({count}), {total} windows of {settings['window']} every {stride} as {len(channels)}x{settings['size']}x{settings['size']} {settings['dtype']}")
+   os.makedirs(output,exist_ok=True)
+   executor = None
+   if workers > 0:
+      context = multiprocessing.get_context('forkserver')
+      context.set_forkserver_preload(['__main__'])
+      executor = ProcessPoolExecutor(max_workers=workers,mp_context=context,initializer=initWorker,initargs=(settings,))
+      # start the workers (each imports the GAF stack once) before the clock does
+      wait([ executor.submit(os.getpid) for _ in range(workers) ])
+   else:
+      initWorker(settings)
+   pending = collections.deque()
+   valid = 0
+   done = 0
+   startTime = time.time()
+   reported = startTime
+   def collect(drain):
+      # waits while too many batches are in flight (all of them when draining)
+      nonlocal valid,done,reported
+      while len(pending) > 0 and (drain or len(pending) >= 2*max(workers,1)):
+         finished,_ = wait(list(pending),return_when=FIRST_COMPLETED)
+         for future in finished:
+            pending.remove(future)
+            valid += future.result()
+            done += future.windows
+      if time.time() - reported >= 10:
+         reported = time.time()
+         print(f"backfill: {done}/{total} windows, {done/(reported - startTime):.1f} windows/s")
+   def submit(block,ends,index):
+      nonlocal valid,done
+      shard = metadata['shards'][index//shardWindows]
+      slots = [ x % shardWindows for x in range(index,index + len(ends)) ]
+      paths = (os.path.join(output,shard['fields']),os.path.join(output,shard['meta']))
+      if executor is None:
+         valid += renderWindows(block,ends,slots,*paths)
+         done += len(ends)
+         return
+      future = executor.submit(renderWindows,block,ends,slots,*paths)
+      future.windows = len(ends)
+      pending.append(future)
+      collect(False)
+   try:
+      block = None
+      base = 0
+      nextEnd = rows - 1
+      index = 0
+      if total > 0:
+         for chunk in streamBlocks(conn,product,first,last,fetchRows):
+            block = concat(block,chunk)
+            ends = []
+            while nextEnd < base + len(block['sampleIds']) and index + len(ends) < total:
+               ends.append(nextEnd)
+               nextEnd += stride
+            while len(ends) > 0:
+               if index % shardWindows == 0:
+                  metadata['shards'].append(createShard(output,len(metadata['shards']),min(shardWindows,total - index),len(channels),settings['size'],settings['dtype']))
+               # a batch stops at the end of its shard
+               take = min(batchWindows,shardWindows - index % shardWindows,len(ends))
+               low = ends[0] - rows + 1 - base
+               high = ends[take - 1] + 1 - base
+               part = { key: values[low:high] for key,values in block.items() }
+               submit(part,[ x - base - low for x in ends[:take] ],index)
+               index += take
+               ends = ends[take:]
+            # keep only the rows the next window reaches
+            cut = max(nextEnd - rows + 1 - base,0)
+            if cut > 0:
+               block = { key: values[cut:] for key,values in block.items() }
+               base += cut
+      collect(True)
+   finally:
+      if executor is not None: executor.shutdown(cancel_futures=True)
+   seconds = time.time() - startTime
+   metadata['valid'] = valid
+   metadata['seconds'] = seconds
+   metadata['windows_per_second'] = done/seconds if seconds > 0 else None
+   with open(os.path.join(output,'metadata.json'),'w') as f:
+      json.dump(metadata,f,indent=2)
+   print(f"backfill: wrote {done} windows ({valid} valid) in {len(metadata['shards'])} shards to {output}, {metadata['windows_per_second'] or 0:.1f} windows/s")
+   return metadata
+
+def main(args):
+   postgresUser = "postgres"
+   postgresPw = None
+   postgresHost = "postgresql"
+   postgresPort = 5432
+   postgresDb = "postgres"
+   window = None
+   smoothing = None
+   imageSize = None
+   mtfBins = 0
+   if os.environ.get('POSTGRES_USER') != None: postgresUser = os.environ.get('POSTGRES_USER')
+   if os.environ.get('POSTGRES_PW') != None: postgresPw = os.environ.get('POSTGRES_PW')
+   if os.environ.get('POSTGRES_HOST') != None: postgresHost = os.environ.get('POSTGRES_HOST')
+   if os.environ.get('POSTGRES_PORT') != None: postgresPort = int(os.environ.get('POSTGRES_PORT'))
+   if os.environ.get('POSTGRES_DB') != None: postgresDb = os.environ.get('POSTGRES_DB')
+   if os.environ.get('SMOOTHING') != None: smoothing = os.environ.get('SMOOTHING')
+   if os.environ.get('IMAGE_SIZE') != None: imageSize = int(os.environ.get('IMAGE_SIZE'))
+   if os.environ.get('MTF_BINS') != None: mtfBins = int(os.environ.get('MTF_BINS'))
+   if args.pg_user != None: postgresUser = args.pg_user
+   if args.pg_pw != None: postgresPw = args.pg_pw
+   if args.pg_host != None: postgresHost = args.pg_host
+   if args.pg_port != None: postgresPort = int(args.pg_port)
+   if args.db != None: postgresDb = args.db
+   if args.window != None: window = int(args.window)
+   if args.smoothing != None: smoothing = args.smoothing
+   if args.image_size != None: imageSize = int(args.image_size)
+   if args.mtf_bins != None: mtfBins = int(args.mtf_bins)
+   if postgresPw is None and os.path.exists('/run/secrets/pg_pw'):
+      with open('/run/secrets/pg_pw') as secret:
+         postgresPw = secret.read().strip()
+   if args.dtype not in ('uint8','float16'):
+      print(f"unknown dtype {args.dtype}")
+      return
+   if args.stride < 1 or args.shard_windows < 1 or args.batch_windows < 1 or args.fetch_rows < 1:
+      print("stride, shard_windows, batch_windows and fetch_rows must be at least 1")
+      return
+   if mtfBins < 0 or mtfBins == 1:
+      print(f"MTF bins must be 0 (no MTF) or at least 2, got {mtfBins}")
+      return
+   with psycopg.connect(host=postgresHost, port=postgresPort, dbname=postgresDb, user=postgresUser, password=postgresPw) as conn:
+      # the product's gafs row supplies whatever the flags and environment leave out
+      row = conn.execute(GAF_SQL,(args.product,)).fetchone()
+      if row is None:
+         print(f"unknown product {args.product}")
+         return
+      maxSize,productSmoothing,productImageSize = row
+      if window is None: window = maxSize
+      if smoothing is None: smoothing = productSmoothing or 'box:5'
+      if imageSize is None: imageSize = productImageSize or 0
+      if window is None or window < 21:
+         print(f"window must be at least 21 samples, got {window}")
+         return
+      try:
+         getKernel(smoothing)
+      except ValueError as e:
+         print(e)
+         return
+      settings = {
+         'product': args.product,
+         'window': window,
+         'imageSize': imageSize,
+         'size': getOutputSizes(window,imageSize,0)[0],
+         'smoothing': smoothing,
+         'mtfBins': mtfBins,
+         'levels': args.orderbook_levels,
+         'dtype': args.dtype,
+         'batchProducts': args.batch_windows
+      }
+      start = args.start if args.start is not None else 0
+      end = args.end if args.end is not None else 2**63 - 1
+      backfill(conn,settings,args.output,start,end,args.stride,args.shard_windows,args.batch_windows,args.fetch_rows,args.workers)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--pg_user', help="postgres user")
+parser.add_argument('--pg_pw', help="postgres password")
+parser.add_argument('--pg_host', help="postgres host")
+parser.add_argument('--pg_port', help="postgres port")
+parser.add_argument('--db', help="postgres db")
+parser.add_argument('--product', required=True, help="product to backfill")
+parser.add_argument('--output', required=True, help="directory for the shards and metadata.json")
+parser.add_argument('--start', type=int, help="first sample_id read (defaults to the oldest)")
+parser.add_argument('--end', type=int, help="last sample_id read (defaults to the newest when the backfill starts)")
+parser.add_argument('--window', help="samples per window (defaults to the product's max_size)")
+parser.add_argument('--stride', type=int, default=1, help="samples the window moves between tensors")
+parser.add_argument('--image_size', help="tensor side, PAA reduced from the window (defaults to gafs.image_size, 0 keeps one pixel per sample)")
+parser.add_argument('--smoothing', help="trade smoothing kernel (defaults to gafs.smoothing, then box:5)")
+parser.add_argument('--mtf_bins', help="MTF quantile bins (0 leaves the MTF channel out)")
+parser.add_argument('--orderbook_levels', type=int, default=3, help="order book depth levels kept as channels; shallower windows are left invalid")
+parser.add_argument('--dtype', default='uint8', help="uint8 (image pixels) or float16 (raw fields)")
+parser.add_argument('--shard_windows', type=int, default=1024, help="windows per .npy shard")
+parser.add_argument('--batch_windows', type=int, default=64, help="windows per worker task and batched GAF pass")
+parser.add_argument('--fetch_rows', type=int, default=10000, help="samples fetched from the server-side cursor at a time")
+parser.add_argument('--workers', type=int, default=os.cpu_count(), help="processes rendering windows (0 renders in this process)")
+
+if __name__ == '__main__':
+   args = parser.parse_args()
+   main(args)
@@ -0,0 +1,143 @@
+"""Warm-state checkpoints for the calculate worker.
+
+With CHECKPOINT_PATH set the worker saves its per-product state every
+CHECKPOINT_INTERVAL seconds and maps it back in when it starts:
+
+   rings     the resident windows of FETCH_MODE=delta (ringbuffer.py), so
+             the first pass only fetches the samples written since
+   fields    the incremental GAF state (GAF_BACKEND=incremental, WORKERS=0)
+             and the newest sample_id it was built from, so the first pass
+             updates fields instead of rebuilding them
+   written   the output hashes and window of each product's last image, so
+             products whose window has not moved are neither rendered nor
+             written again
+
+Each checkpoint is a directory of .npy files plus state.json, written
+under a temporary name and renamed; the file current names the newest
+complete one and older ones are removed.  Arrays are loaded with
+np.load(mmap_mode='c'), so booting reads only the pages a pass touches
+and updates stay private to the process.  Nothing restored is trusted
+blindly: rings are checked against the table by the first delta fetch,
+the incremental fields recompute whatever does not line up, and a
+product's write state is kept only while its gafs.etag still matches.
+"""
+import json
+import os
+import shutil
+import time
+import numpy as np
+from ringbuffer import SampleRing,ORDERBOOK_KEYS
+from smoothing import getKernel
+
+RING_ARRAYS = ('sampleIds','midpoint','depths','buys','sells')
+FIELD_KEYS = ('midpointSummation','midpointDifference','orderbook','buy','sell')
+GAF_ARRAYS = ('cos','lo','hi','field')
+
+class ArrayFiles:
+   """Numbered .npy files of one checkpoint directory."""
+
+   def __init__(self,directory):
+      self.directory = directory
+      self.count = 0
+
+   def save(self,array):
+      name = f"{self.count}.npy"
+      self.count += 1
+      np.save(os.path.join(self.directory,name),np.ascontiguousarray(array))
+      return name
+
+   def load(self,name):
+      return np.load(os.path.join(self.directory,name),mmap_mode='c')
+
+def saveRing(files,ring):
+   return {
+      'maxSize': ring.maxSize,
+      'kernel': ring.kernel.spec,
+      'start': ring.start,
+      'count': ring.count,
+      'arrays': { key: files.save(getattr(ring,key)) for key in RING_ARRAYS },
+      'orderbook': { key: files.save(ring.orderbook[key]) for key in ORDERBOOK_KEYS }
+   }
+
+def loadRing(files,saved):
+   ring = SampleRing(saved['maxSize'],getKernel(saved['kernel']))
+   arrays = { key: files.load(name) for key,name in saved['arrays'].items() }
+   if len(arrays['sampleIds']) != ring.capacity:
+      return None
+   for key,array in arrays.items():
+      setattr(ring,key,array)
+   ring.orderbook = { key: files.load(name) for key,name in saved['orderbook'].items() }
+   ring.start = saved['start']
+   ring.count = saved['count']
+   return ring
+
+def saveFieldState(files,state):
+   saved = { 'lastSampleId': None if state['lastSampleId'] is None else int(state['lastSampleId']) }
+   for key in FIELD_KEYS:
+      gaf = state[key]
+      saved[key] = { name: files.save(getattr(gaf,name)) for name in GAF_ARRAYS } if gaf.field is not None else None
+   return saved
+
+def loadFieldState(files,saved,state):
+   # state comes from getFieldState, with its IncrementalGAFs already made for the right methods
+   state['lastSampleId'] = saved['lastSampleId']
+   for key in FIELD_KEYS:
+      if saved[key] is None:
+         continue
+      gaf = state[key]
+      for name,file in saved[key].items():
+         setattr(gaf,name,files.load(file))
+   return state
+
+def save(path,settings,rings,fieldStates,rendered,written):
+   # writes a new checkpoint next to the current one and switches current over to it
+   stamp = f"{time.time_ns()}"
+   staging = os.path.join(path,f".{stamp}.tmp")
+   os.makedirs(staging)
+   files = ArrayFiles(staging)
+   state = {
+      'settings': settings,
+      'rings': { product: saveRing(files,ring) for product,ring in rings.items() },
+      'fields': { product: saveFieldState(files,x) for product,x in fieldStates.items() },
+      'written': {
+         product: {
+            'digests': { artifact: digest.hex() for artifact,digest in digests.items() },
+            'size': int(size),
+            'midpoint': midpoint,
+            'imageFormat': imageFormat,
+            'windowKey': list(rendered[product])
+         }
+         for product,(digests,size,midpoint,imageFormat) in written.items() if product in rendered
+      }
+   }
+   with open(os.path.join(staging,'state.json'),'w') as f:
+      json.dump(state,f)
+   os.rename(staging,os.path.join(path,stamp))
+   with open(os.path.join(path,'current.tmp'),'w') as f:
+      f.write(stamp)
+   os.replace(os.path.join(path,'current.tmp'),os.path.join(path,'current'))
+   # an older checkpoint still mapped by this process stays readable after it is removed
+   for name in os.listdir(path):
+      if name not in (stamp,'current') and os.path.isdir(os.path.join(path,name)):
+         shutil.rmtree(os.path.join(path,name),ignore_errors=True)
+   return stamp
+
+def load(path):
+   # the newest complete checkpoint as (name, files, state.json contents), or None
+   try:
+      with open(os.path.join(path,'current')) as f:
+         stamp = f.read().strip()
+      directory = os.path.join(path,stamp)
+      with open(os.path.join(directory,'state.json')) as f:
+         state = json.load(f)
+   except (OSError, ValueError):
+      return None
+   return stamp,ArrayFiles(directory),state
+
+def writtenStates(state):
+   # product -> (OutputWriter state, windowKey) as saved
+   restored = {}
+   for product,saved in state['written'].items():
+      digests = { artifact: bytes.fromhex(x) for artifact,x in saved['digests'].items() }
+      restored[product] = ((digests,saved['size'],saved['midpoint'],saved['imageFormat']),tuple(saved['windowKey']))
+   return restored
@@ -0,0 +1,233 @@
+"""Gramian Angular Field kernels for the calculate worker.
+
+The arithmetic mirrors pyts.image.GramianAngularField (min-max rescale to
+[-1,1], then cos/sin outer products) element for element, so results are
+bit-identical to the pyts path.  paa reduces a series to a fixed image
+size the way GramianAngularField(image_size=...) does before its transform.
+"""
+import numpy as np
+
+EPS = np.finfo(np.float64).eps
+
+def rescale(series):
+   # series is (..., N); matches sklearn MinMaxScaler(feature_range=(-1,1)) per series
+   lo = series.min(axis=-1)
+   hi = series.max(axis=-1)
+   span = hi - lo
+   span[span < 10*EPS] = 1.0
+   scale = 2.0/span
+   offset = -1.0 - lo*scale
+   scaled = series*scale[...,None]
+   scaled += offset[...,None]
+   return scaled,lo,hi
+
+def segments(size,outputSize):
+   # the bounds pyts GramianAngularField(image_size=outputSize) averages over (non-overlapping PAA):
+   # linspace cut points, so windows differ by at most one sample where size does not divide
+   bounds = np.linspace(0,size,outputSize + 1).astype('int64')
+   return bounds[:-1],bounds[1:]
+
+def paa(series,outputSize):
+   # mean of every window along the last axis, summed in sample order like the pyts kernel
+   series = np.asarray(series,dtype=np.float64)
+   size = series.shape[-1]
+   if outputSize >= size:
+      return series
+   start,end = segments(size,outputSize)
+   lengths = end - start
+   out = series[...,start]
+   for k in range(1,int(lengths.max())):
+      cols = np.flatnonzero(lengths > k)
+      out[...,cols] += series[...,start[cols] + k]
+   out /= lengths
+   return out
+
+def polar(scaled):
+   # the rescaled series is cos(phi); sin(phi) follows without an arccos
+   return scaled,np.sqrt(np.clip(1 - scaled**2,0,1))
+
+class Polar:
+   """A (channels, N) series rescaled once, with the cos/sin every field of it is built from."""
+
+   def __init__(self,series):
+      series = np.asarray(series,dtype=np.float64)
+      if series.ndim == 1: series = series.reshape(1,-1)
+      self.scaled,self.lo,self.hi = rescale(series)
+      self.cos,self.sin = polar(self.scaled)
+
+def gasf(cos,sin,out,tmp):
+   np.multiply(cos[...,:,None],cos[...,None,:],out=out)
+   np.multiply(sin[...,:,None],sin[...,None,:],out=tmp)
+   np.subtract(out,tmp,out=out)
+   return out
+
+def gadf(cos,sin,out,tmp):
+   np.multiply(sin[...,:,None],cos[...,None,:],out=out)
+   np.multiply(cos[...,:,None],sin[...,None,:],out=tmp)
+   np.subtract(out,tmp,out=out)
+   return out
+
+def reference(series,method,imageSize=None):
+   # pyts path, kept as the reference the native kernels are checked against
+   from pyts.image import GramianAngularField
+   series = np.asarray(series,dtype=np.float64)
+   if imageSize is None or imageSize > series.shape[-1]: imageSize = series.shape[-1]
+   return GramianAngularField(image_size=imageSize,method=method).fit_transform(series.reshape(-1,series.shape[-1])).reshape(series.shape[:-1] + (imageSize,imageSize))
+
+def gasf_block(cos,sin,rows,cols,out,tmp):
+   np.multiply(cos[rows,None],cos[None,cols],out=out)
+   np.multiply(sin[rows,None],sin[None,cols],out=tmp)
+   np.subtract(out,tmp,out=out)
+   return out
+
+def gadf_block(cos,sin,rows,cols,out,tmp):
+   np.multiply(sin[rows,None],cos[None,cols],out=out)
+   np.multiply(cos[rows,None],sin[None,cols],out=tmp)
+   np.subtract(out,tmp,out=out)
+   return out
+
+class IncrementalGAF:
+   """Sliding-window GAF that reuses the previous matrix.
+
+   Samples arrive newest first, so when ``shift`` new samples are prepended
+   the previous field moves down and right by ``shift``.  Only rows and
+   columns whose rescaled value changed are recomputed; a channel whose
+   min/max bounds moved is rebuilt in full.
+   """
+
+   def __init__(self,method='summation'):
+      if method in ('s','summation'): self.kernel = gasf_block
+      elif method in ('d','difference'): self.kernel = gadf_block
+      else: raise ValueError(f"unknown GAF method {method}")
+      self.reset()
+
+   def reset(self):
+      self.cos = None
+      self.lo = None
+      self.hi = None
+      self.field = None
+      self.spare = None
+      self.tmp = None
+      self.rebuilds = 0
+      self.partials = 0
+
+   def update(self,samples,shift=None):
+      # samples may be a Polar shared with other fields of the same series
+      prepared = samples if isinstance(samples,Polar) else Polar(samples)
+      cos,sin,lo,hi = prepared.cos,prepared.sin,prepared.lo,prepared.hi
+      channels,size = cos.shape
+      if self.spare is None or self.spare.shape != (channels,size,size):
+         self.spare = np.empty((channels,size,size))
+         self.tmp = np.empty((size,size))
+      out = self.spare
+      prev = self.field
+      usable = prev is not None and shift is not None and 0 <= shift < size and prev.shape[0] == channels
+      full = slice(None)
+      for ch in range(channels):
+         dirty = None
+         if usable and lo[ch] == self.lo[ch] and hi[ch] == self.hi[ch]:
+            dirty = self.dirtyRows(cos[ch],self.cos[ch],shift)
+         if dirty is None or 2*len(dirty) >= size:
+            self.kernel(cos[ch],sin[ch],full,full,out[ch],self.tmp)
+            self.rebuilds += 1
+            continue
+         overlap = min(size - shift,prev.shape[1])
+         out[ch,shift:shift + overlap,shift:shift + overlap] = prev[ch,:overlap,:overlap]
+         if len(dirty) > 0:
+            count = len(dirty)
+            rows = self.tmp[:count]
+            self.kernel(cos[ch],sin[ch],dirty,full,rows,self.tmp[count:2*count])
+            out[ch][dirty,:] = rows
+            cols = self.tmp[:,:count]
+            self.kernel(cos[ch],sin[ch],full,dirty,cols,self.tmp[:,count:2*count])
+            out[ch][:,dirty] = cols
+         self.partials += 1
+      self.spare = prev if prev is not None and prev.shape == out.shape else None
+      self.field = out
+      self.cos = cos
+      self.lo = lo
+      self.hi = hi
+      return out
+
+   @staticmethod
+   def dirtyRows(cos,prevCos,shift):
+      size = len(cos)
+      overlap = min(size - shift,len(prevCos))
+      stale = np.ones(size,dtype=bool)
+      stale[shift:shift + overlap] = cos[shift:shift + overlap] != prevCos[:overlap]
+      return np.flatnonzero(stale)
+
+class BatchGAF:
+   """Full GAF rebuild for a stack of series in one broadcast pass.
+
+   ``transform`` takes a (products, channels, N) array and returns the
+   shared cos/sin vectors together with the summation field of every
+   channel and the difference field of the first ``differenceChannels``
+   channels.  Output arrays are reused between calls with the same shape,
+   so callers must consume them before the next call.
+   """
+
+   def __init__(self,maxProducts=8):
+      self.maxProducts = maxProducts
+      self.buffers = {}
+
+   def buffer(self,name,shape):
+      buf = self.buffers.get(name,None)
+      if buf is None or buf.shape != shape:
+         buf = np.empty(shape)
+         self.buffers[name] = buf
+      return buf
+
+   def transform(self,stack,differenceChannels=0):
+      stack = np.asarray(stack,dtype=np.float64)
+      scaled,lo,hi = rescale(stack)
+      cos,sin = polar(scaled)
+      fieldShape = stack.shape + stack.shape[-1:]
+      tmp = self.buffer('tmp',fieldShape)
+      result = { 'cos': cos, 'sin': sin }
+      result['summation'] = gasf(cos,sin,self.buffer('summation',fieldShape),tmp)
+      if differenceChannels > 0:
+         diffShape = stack.shape[:-2] + (differenceChannels,) + fieldShape[-2:]
+         result['difference'] = gadf(cos[...,:differenceChannels,:],sin[...,:differenceChannels,:],self.buffer('difference',diffShape),tmp[...,:differenceChannels,:,:])
+      return result
+
+class LeanGAF:
+   """float32 GAF fields written straight into uint8 pixels.
+
+   A summation field cos(phi_i + phi_j) is the rank-3 product
+   [cos, -sin, 1] @ [cos, sin, 1]^T, and a difference field sin(phi_i - phi_j)
+   is [sin, -cos, 1] @ [cos, sin, 1]^T.  The pixel scale (x + 1)*127.5 is
+   folded into the left factor, so each field is a single float32 matrix
+   product into a reused scratch buffer, truncated in place into the uint8
+   image like images.quantize.  Nothing of size N x N is kept between
+   products, and no float64 field is ever built.  Pixels can be one level
+   off the float64 path where a value sits on a truncation boundary.
+   """
+
+   def __init__(self):
+      self.buffers = {}
+
+   def buffer(self,name,shape,dtype=np.float32):
+      buf = self.buffers.get(name,None)
+      if buf is None or buf.shape != shape or buf.dtype != dtype:
+         buf = np.empty(shape,dtype=dtype)
+         self.buffers[name] = buf
+      return buf
+
+   def scratch(self,size):
+      return self.buffer('scratch',(size,size))
+
+   def pixels(self,prepared,channel,method,out):
+      # field channel of a Polar as pixels in out, a (size,size) uint8 array or channel view
+      cos,sin = prepared.cos[channel],prepared.sin[channel]
+      size = len(cos)
+      left = self.buffer('left',(size,3))
+      right = self.buffer('right',(3,size))
+      right[0],right[1],right[2] = cos,sin,1
+      if method == 'summation': left[:,0],left[:,1] = 127.5*cos,-127.5*sin
+      else: left[:,0],left[:,1] = 127.5*sin,-127.5*cos
+      left[:,2] = 127.5
+      scratch = self.scratch(size)
+      np.matmul(left,right,out=scratch)
+      np.copyto(out,scratch,casting='unsafe')
+      return out
@@ -0,0 +1,104 @@
+"""Image output codecs for the calculate worker.
+
+Fields in [-1,1] are quantized to uint8 pixels once and then encoded by the
+configured codec:
+
+   png[:level]    PNG, zlib level 0-9 (PIL default when omitted)
+   webp[:method]  lossless WebP, method 0-6 trades speed for size
+   raw            quantized pixels behind a 6 byte header: big-endian
+                  uint16 height, width and channels, then row-major uint8
+"""
+import io
+import struct
+import numpy as np
+import PIL.Image
+from concurrent.futures import ThreadPoolExecutor
+
+RAW_HEADER = struct.Struct('!HHH')
+
+def quantize(field):
+   scaled = ((field + 1)/2)*255
+   return scaled.astype(np.uint8)
+
+def toRGB(field,permutation=None):
+   channels = permutation if permutation != None else range(3)
+   return np.stack([ quantize(field[i]) for i in channels ],axis=2)
+
+class PngCodec:
+   mediaType = 'image/png'
+
+   def __init__(self,level=None):
+      if level != None and not 0 <= level <= 9:
+         raise ValueError(f"png level must be 0-9, got {level}")
+      self.level = level
+      self.name = 'png' if level is None else f"png:{level}"
+
+   def encode(self,pixels):
+      image = io.BytesIO()
+      options = {} if self.level is None else { 'compress_level': self.level }
+      PIL.Image.fromarray(pixels).save(image,'png',**options)
+      return image.getvalue()
+
+class WebpCodec:
+   mediaType = 'image/webp'
+
+   def __init__(self,method=None):
+      if method != None and not 0 <= method <= 6:
+         raise ValueError(f"webp method must be 0-6, got {method}")
+      self.method = method
+      self.name = 'webp' if method is None else f"webp:{method}"
+
+   def encode(self,pixels):
+      image = io.BytesIO()
+      options = {} if self.method is None else { 'method': self.method }
+      PIL.Image.fromarray(pixels).save(image,'webp',lossless=True,**options)
+      return image.getvalue()
+
+class RawCodec:
+   mediaType = 'application/octet-stream'
+   name = 'raw'
+
+   def __init__(self,option=None):
+      if option != None:
+         raise ValueError("raw takes no option")
+
+   def encode(self,pixels):
+      channels = pixels.shape[2] if pixels.ndim == 3 else 1
+      return RAW_HEADER.pack(pixels.shape[0],pixels.shape[1],channels) + np.ascontiguousarray(pixels).tobytes()
+
+   @staticmethod
+   def decode(data):
+      height,width,channels = RAW_HEADER.unpack_from(data)
+      pixels = np.frombuffer(data,dtype=np.uint8,offset=RAW_HEADER.size).reshape(height,width,channels)
+      return pixels[:,:,0] if channels == 1 else pixels
+
+CODECS = { 'png': PngCodec, 'webp': WebpCodec, 'raw': RawCodec }
+
+def getCodec(spec):
+   name,_,option = spec.partition(':')
+   if name not in CODECS:
+      raise ValueError(f"unknown image format {spec}")
+   try:
+      return CODECS[name](int(option)) if option != '' else CODECS[name]()
+   except ValueError as e:
+      raise ValueError(f"bad image format {spec}: {e}")
+
+class ImageEncoder:
+   """Encodes a list of pixel arrays with one codec.
+
+   With ``threads`` above 0 the images are encoded on a thread pool; the
+   PIL encoders release the GIL while compressing.
+   """
+
+   def __init__(self,codec,threads=0):
+      self.codec = codec
+      self.executor = ThreadPoolExecutor(max_workers=threads) if threads > 0 else None
+
+   def encode(self,images):
+      if self.executor is None:
+         return [ self.codec.encode(x) for x in images ]
+      return list(self.executor.map(self.codec.encode,images))
+
+   def shutdown(self):
+      if self.executor is not None:
+         self.executor.shutdown()
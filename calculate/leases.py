@@ -0,0 +1,112 @@
+"""Lease-based product sharding for calculate replicas.
+
+With SHARD_MODE=lease every replica heartbeats a row in crypto_gaf.replicas
+and holds time-limited leases on its share of the products in
+crypto_gaf.leases.  On each heartbeat (a third of LEASE_TTL) a replica
+
+   renews the leases it still holds,
+   releases any beyond its fair share, ceil(products / live replicas), so a
+   replica that joins gets work without waiting for anything to expire,
+   claims free or expired leases up to that share (FOR UPDATE SKIP LOCKED,
+   so replicas claiming at once never take the same product).
+
+A replica that dies stops renewing; its leases expire after LEASE_TTL and
+its row stops counting as live, so the others take its products over.
+Image updates are fenced on a valid lease (LEASE_FENCE_SQL), so a replica
+that stalls past its expiry cannot overwrite the new owner's images.
+"""
+import math
+import time
+
+HEARTBEAT_SQL = """
+   INSERT INTO crypto_gaf.replicas (owner,seen_at) VALUES (%(owner)s,clock_timestamp())
+   ON CONFLICT (owner) DO UPDATE SET seen_at = excluded.seen_at
+"""
+
+LIVE_SQL = """
+   SELECT count(*) FILTER (WHERE seen_at > clock_timestamp() - make_interval(secs => %(ttl)s)),
+      (SELECT count(*) FROM crypto_gaf.gafs WHERE max_size IS NOT NULL)
+   FROM crypto_gaf.replicas
+"""
+
+# replicas silent for ten lease lifetimes are forgotten
+FORGET_SQL = """
+   DELETE FROM crypto_gaf.replicas WHERE seen_at < clock_timestamp() - make_interval(secs => 10*%(ttl)s)
+"""
+
+SEED_SQL = """
+   INSERT INTO crypto_gaf.leases (product)
+   SELECT product FROM crypto_gaf.gafs WHERE max_size IS NOT NULL
+   ON CONFLICT (product) DO NOTHING
+"""
+
+RENEW_SQL = """
+   UPDATE crypto_gaf.leases SET expires_at = clock_timestamp() + make_interval(secs => %(ttl)s)
+   WHERE owner = %(owner)s AND expires_at > clock_timestamp()
+   RETURNING product
+"""
+
+RELEASE_SQL = """
+   UPDATE crypto_gaf.leases SET owner = NULL,expires_at = NULL
+   WHERE owner = %(owner)s AND product = ANY(%(products)s::text[])
+"""
+
+CLAIM_SQL = """
+   UPDATE crypto_gaf.leases SET owner = %(owner)s,expires_at = clock_timestamp() + make_interval(secs => %(ttl)s)
+   WHERE product IN (
+      SELECT product FROM crypto_gaf.leases
+      WHERE owner IS NULL OR expires_at IS NULL OR expires_at <= clock_timestamp()
+      ORDER BY expires_at NULLS FIRST,product
+      LIMIT %(count)s
+      FOR UPDATE SKIP LOCKED
+   )
+   RETURNING product
+"""
+
+LEASE_FENCE_SQL = """
+   EXISTS (
+      SELECT 1 FROM crypto_gaf.leases l
+      WHERE l.product = crypto_gaf.gafs.product AND l.owner = %(owner)s AND l.expires_at > clock_timestamp()
+   )
+"""
+
+class LeaseManager:
+   def __init__(self,owner,ttl=15):
+      self.owner = owner
+      self.ttl = ttl
+      self.heartbeat = ttl/3
+      self.owned = set()
+      self.last = None
+
+   def due(self):
+      return self.last is None or time.monotonic() - self.last >= self.heartbeat
+
+   def refresh(self,conn):
+      # returns the products held after this heartbeat; the lease work is committed on its own
+      self.last = time.monotonic()
+      params = { 'owner': self.owner, 'ttl': self.ttl }
+      with conn.cursor() as cur:
+         cur.execute(HEARTBEAT_SQL,params)
+         cur.execute(FORGET_SQL,params)
+         cur.execute(SEED_SQL)
+         cur.execute(LIVE_SQL,params)
+         replicas,products = cur.fetchone()
+         share = math.ceil(products/max(replicas,1))
+         cur.execute(RENEW_SQL,params)
+         owned = sorted(x[0] for x in cur.fetchall())
+         if len(owned) > share:
+            cur.execute(RELEASE_SQL,dict(params,products=owned[share:]))
+            owned = owned[:share]
+         elif len(owned) < share:
+            cur.execute(CLAIM_SQL,dict(params,count=share - len(owned)))
+            owned += [ x[0] for x in cur.fetchall() ]
+      conn.commit()
+      self.owned = set(owned)
+      return self.owned
+
+   def release(self,conn):
+      with conn.cursor() as cur:
+         cur.execute(RELEASE_SQL,{ 'owner': self.owner, 'products': sorted(self.owned) })
+         cur.execute("DELETE FROM crypto_gaf.replicas WHERE owner = %s",(self.owner,))
+      conn.commit()
+      self.owned = set()
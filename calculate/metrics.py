@@ -0,0 +1,76 @@
+"""Prometheus metrics for the calculate worker.
+
+With METRICS_PORT set, /metrics is served on that port from a background
+thread (prometheus_client's exposition server).  Stages are timed per pass:
+
+   fetch       reading sample windows
+   sanitize    prepareSamples for every product
+   compute     GAF fields
+   encode      quantizing and encoding images
+   render      compute and encode together, when they run in the process pool
+   update      hashing the images and writing the changed ones to crypto_gaf.gafs
+   commit      committing the pass
+   checkpoint  saving the warm state (CHECKPOINT_PATH)
+
+Lag is the time from a product's newest sample being inserted to the commit
+of the images made from it, measured by the database clock; for a window
+read from a shared memory ring it is measured from the sample's publication
+by collect instead.  Time to first image is the time from the process
+starting (before its imports) to the commit of its first pass, when every
+product's images are current again.
+"""
+import time
+from prometheus_client import Counter,Gauge,Histogram,start_http_server
+
+LAG_BUCKETS = (0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,120,300)
+
+STAGE_SECONDS = Histogram('crypto_gaf_calculate_stage_seconds','Time spent in each stage of a calculate pass',['stage'])
+LAG_SECONDS = Histogram('crypto_gaf_calculate_lag_seconds','Sample insert to image update lag',['product'],buckets=LAG_BUCKETS)
+LAST_LAG = Gauge('crypto_gaf_calculate_last_lag_seconds','Lag of the latest image update',['product'])
+UPDATES = Counter('crypto_gaf_calculate_updates_total','Image updates written to crypto_gaf.gafs',['product'])
+UNCHANGED = Counter('crypto_gaf_calculate_unchanged_total','Rendered products not written because their images matched the last write',['product'])
+SKIPPED = Counter('crypto_gaf_calculate_skipped_total','Products skipped for a data shape error',['product'])
+DRIFT = Gauge('crypto_gaf_calculate_schedule_drift_seconds','How far the last pass ended past its scheduled time')
+LEASED = Gauge('crypto_gaf_calculate_leased_products','Products this replica holds a lease on (SHARD_MODE=lease)')
+FIRST_IMAGE = Gauge('crypto_gaf_calculate_first_image_seconds','Process start to the commit of the first pass')
+SHARED = Gauge('crypto_gaf_calculate_shared_products','Products the last pass read from the shared memory rings (TRANSPORT=shm)')
+
+# newest samples of the products just updated; inserted_at defaults to the inserting transaction's start
+LAG_SQL = """
+   SELECT product,extract(epoch FROM clock_timestamp() - inserted_at)::float8
+   FROM crypto_gaf.samples WHERE sample_id = ANY(%s) AND inserted_at IS NOT NULL
+"""
+
+def serve(port):
+   if port > 0: start_http_server(port)
+
+def stage(name):
+   return STAGE_SECONDS.labels(name).time()
+
+class StageTimer:
+   """Adds up the time of several steps (one per product, say) and observes it once as one stage."""
+
+   def __init__(self,name):
+      self.name = name
+      self.spent = 0.0
+
+   def __enter__(self):
+      self.start = time.perf_counter()
+      return self
+
+   def __exit__(self,*exc):
+      self.spent += time.perf_counter() - self.start
+
+   def observe(self):
+      STAGE_SECONDS.labels(self.name).observe(self.spent)
+
+def observeLag(cur,sampleIds):
+   if len(sampleIds) == 0:
+      return
+   cur.execute(LAG_SQL,(sampleIds,))
+   for product,lag in cur.fetchall():
+      recordLag(product,lag)
+
+def recordLag(product,lag):
+   LAG_SECONDS.labels(product).observe(lag)
+   LAST_LAG.labels(product).set(lag)
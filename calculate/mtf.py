@@ -0,0 +1,61 @@
+"""Markov Transition Field for the calculate worker.
+
+Follows pyts.image.MarkovTransitionField (quantile bins, row-normalized
+first-order transition counts, MTF[i,j] = W[bin(i),bin(j)], block means
+down to the image size) but never builds the full samples x samples field:
+with C the per-segment bin counts, the block means are C W C^T divided by
+the segment sizes.  Binning and transitions are computed once per window
+and reused for every image size, pyramid levels included.
+"""
+import numpy as np
+from gaf import segments
+
+def quantileBins(series,bins):
+   # pyts KBinsDiscretizer(strategy='quantile'): percentile edges, an edge within 1e-8 of the next is dropped
+   edges = np.percentile(series,np.linspace(0,100,bins + 1)[1:-1])
+   keep = np.append(~np.isclose(0,np.diff(edges),rtol=0,atol=1e-8),True)
+   return np.searchsorted(edges[keep],series,side='left')
+
+def transitionMatrix(binned,bins):
+   counts = np.bincount(binned[:-1]*bins + binned[1:],minlength=bins*bins).reshape(bins,bins).astype(np.float64)
+   sums = counts.sum(axis=1)
+   sums[sums == 0] = 1
+   counts /= sums[:,None]
+   return counts
+
+class MarkovTransition:
+   """Quantile bins and transition probabilities of one series."""
+
+   def __init__(self,series,bins=8):
+      self.bins = bins
+      self.binned = quantileBins(np.asarray(series,dtype=np.float64).reshape(-1),bins)
+      self.transitions = transitionMatrix(self.binned,bins)
+
+   def counts(self,imageSize):
+      # bin counts of every PAA segment and the segment lengths
+      start,end = segments(len(self.binned),imageSize)
+      lengths = end - start
+      segment = np.repeat(np.arange(imageSize),lengths)
+      counts = np.bincount(segment*self.bins + self.binned,minlength=imageSize*self.bins).reshape(imageSize,self.bins).astype(np.float64)
+      return counts,lengths
+
+   def field(self,imageSize):
+      # probabilities in [0,1], imageSize x imageSize
+      if imageSize >= len(self.binned):
+         return self.transitions[self.binned[:,None],self.binned[None,:]]
+      counts,lengths = self.counts(imageSize)
+      out = counts @ self.transitions @ counts.T
+      out /= np.outer(lengths,lengths)
+      return out
+
+   def pixels(self,imageSize,out,scratch):
+      # the field times 255 (the pixels of its [-1,1] image) truncated into the uint8 out, through a float32 scratch
+      weights = self.transitions*255
+      if imageSize >= len(self.binned):
+         np.take(weights[self.binned].astype(np.float32),self.binned,axis=1,out=scratch)
+      else:
+         counts,lengths = self.counts(imageSize)
+         shares = counts/lengths[:,None]
+         np.matmul((shares @ weights).astype(np.float32),shares.T.astype(np.float32),out=scratch)
+      np.copyto(out,scratch,casting='unsafe')
+      return out
@@ -0,0 +1,34 @@
+"""LISTEN side of the sample notifications sent by collect.
+
+collect raises a NOTIFY on SAMPLE_CHANNEL for every inserted sample with a
+JSON payload {"product": ..., "sample_id": ...}; notifications are only
+delivered once its transaction commits.
+"""
+import json
+import psycopg
+
+SAMPLE_CHANNEL = 'crypto_gaf_samples'
+
+def listen(**connectArgs):
+   conn = psycopg.connect(autocommit=True,**connectArgs)
+   conn.execute(f"LISTEN {SAMPLE_CHANNEL}")
+   return conn
+
+def drain(conn,latest,timeout,stopAfter=None):
+   for notify in conn.notifies(timeout=timeout,stop_after=stopAfter):
+      try:
+         payload = json.loads(notify.payload)
+         product = payload['product']
+         sampleId = int(payload['sample_id'])
+      except (ValueError, KeyError, TypeError):
+         continue
+      latest[product] = max(sampleId,latest.get(product,sampleId))
+
+def waitForSamples(conn,timeout,coalesce):
+   # block until the first notification (or timeout), then merge the rest of the burst for coalesce seconds;
+   # returns {product: newest sample_id}, empty when the wait timed out
+   latest = {}
+   drain(conn,latest,timeout,stopAfter=1)
+   if len(latest) > 0:
+      drain(conn,latest,coalesce)
+   return latest
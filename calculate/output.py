@@ -0,0 +1,136 @@
+"""Batched, content-hashed image writes for the calculate worker.
+
+Every encoded artifact of a product (the midpoint images, orderbook, buy and
+sell images, and the pyramid levels) is hashed with BLAKE2b and compared
+with what the worker last wrote for that product:
+
+   nothing changed          the product is not written at all
+   some artifacts changed   only their columns get new values; the others
+                            are set to themselves, so their TOASTed values
+                            are carried over rather than rewritten
+
+The rows of a pass go out as one pipelined executemany.  Each write bumps
+gafs.version and sets gafs.etag to the hash of the product's whole output,
+so readers can check for a change without loading the images.  The hashes
+are kept in memory (and in the worker's checkpoint, see checkpoint.py); a
+product this worker has no hashes for (after a restart without one, or a
+lease takeover) is written in full.
+"""
+import base64
+import hashlib
+from leases import LEASE_FENCE_SQL
+
+ARTIFACTS = ['midpoint_images','orderbook_image','buy_image','sell_image','pyramid_images']
+TEXT_IMAGE_COLUMNS = ['midpoint_images','orderbook_image','buy_image','sell_image','pyramid_images']
+BINARY_IMAGE_COLUMNS = ['midpoint_image_data','orderbook_image_data','buy_image_data','sell_image_data','pyramid_image_data']
+
+def textImage(data):
+   return base64.b64encode(data).decode()
+
+def digest(value):
+   # bytes or a list of bytes; element lengths go into the hash so [ab,c] and [a,bc] differ
+   h = hashlib.blake2b(digest_size=16)
+   if value is None:
+      h.update(b'\x00')
+   elif isinstance(value,list):
+      h.update(b'\x01')
+      for x in value:
+         h.update(len(x).to_bytes(8,'big'))
+         h.update(x)
+   else:
+      h.update(b'\x02')
+      h.update(value)
+   return h.digest()
+
+def etag(digests,size,imageFormat):
+   h = hashlib.blake2b(digest_size=16)
+   h.update(f"{size}:{imageFormat}".encode())
+   for artifact in ARTIFACTS:
+      h.update(digests[artifact])
+   return h.hexdigest()
+
+def assignment(column,artifact):
+   # an unchanged artifact is sent as NULL and its column keeps its value
+   return f"{column} = CASE WHEN %({artifact}_changed)s THEN %({column})s ELSE {column} END"
+
+def updateSql(storage,fence=''):
+   # text keeps the base64 text columns, binary writes bytea columns instead (clearing the text ones), both writes both
+   assignments = ['midpoint = %(midpoint)s','size = %(size)s']
+   if storage in ('text','both'):
+      assignments += [ assignment(x,y) for x,y in zip(TEXT_IMAGE_COLUMNS,ARTIFACTS) ]
+   else:
+      assignments += [ f"{x} = NULL" for x in TEXT_IMAGE_COLUMNS ]
+   if storage in ('binary','both'):
+      assignments += [ assignment(x,y) for x,y in zip(BINARY_IMAGE_COLUMNS,ARTIFACTS) ]
+   # the codec of whichever columns were written, so the API can decode them
+   assignments += ['image_format = %(image_format)s','version = coalesce(version,0) + 1','etag = %(etag)s']
+   return f"""
+      UPDATE crypto_gaf.gafs SET {','.join(assignments)} WHERE product = %(product)s {fence}
+      RETURNING product
+   """
+
+class OutputWriter:
+   def __init__(self,storage='text',imageFormat='png'):
+      if storage not in ('text','binary','both'):
+         raise ValueError(f"unknown image storage {storage}")
+      self.storage = storage
+      self.imageFormat = imageFormat
+      self.written = {}
+      self.rows = []
+
+   def add(self,product,size,midpoint,midpointImages,orderbookImage,buyImage,sellImage,pyramidImages=None):
+      # queues a renderProduct result; False when it matches the last write and nothing was queued
+      if not pyramidImages: pyramidImages = None
+      images = dict(zip(ARTIFACTS,[midpointImages,orderbookImage,buyImage,sellImage,pyramidImages]))
+      digests = { x: digest(images[x]) for x in ARTIFACTS }
+      state = (digests,size,midpoint,self.imageFormat)
+      last = self.written.get(product,None)
+      if last == state:
+         return False
+      # a new size or codec rewrites every image column
+      lastDigests = last[0] if last is not None and last[1] == size and last[3] == self.imageFormat else {}
+      params = { 'product': product, 'size': size, 'midpoint': midpoint, 'image_format': self.imageFormat, 'etag': etag(digests,size,self.imageFormat) }
+      for artifact,text,binary in zip(ARTIFACTS,TEXT_IMAGE_COLUMNS,BINARY_IMAGE_COLUMNS):
+         changed = lastDigests.get(artifact,None) != digests[artifact]
+         image = images[artifact] if changed else None
+         params[f"{artifact}_changed"] = changed
+         params[binary] = image
+         if self.storage == 'binary' or image is None:
+            params[text] = None
+         elif isinstance(image,list):
+            params[text] = [ textImage(x) for x in image ]
+         else:
+            params[text] = textImage(image)
+      self.rows.append((product,state,params))
+      return True
+
+   def flush(self,conn,cur,owner=None):
+      # writes the queued rows in one pipeline; returns the products written.
+      # With an owner a row is only written while that owner holds a valid lease on it
+      rows = self.rows
+      self.rows = []
+      if len(rows) == 0:
+         return []
+      sql = updateSql(self.storage,f"AND {LEASE_FENCE_SQL}" if owner is not None else '')
+      with conn.pipeline():
+         cur.executemany(sql,[ dict(x[2],owner=owner) for x in rows ],returning=True)
+      written = set()
+      while True:
+         row = cur.fetchone()
+         if row is not None: written.add(row[0])
+         if not cur.nextset(): break
+      for product,state,params in rows:
+         if product in written: self.written[product] = state
+         else: self.written.pop(product,None)
+      return [ x[0] for x in rows if x[0] in written ]
+
+   def restore(self,product,state,current):
+      # a checkpointed write state is kept only while gafs.etag (current) shows the table still holds that write
+      digests,size,midpoint,imageFormat = state
+      if imageFormat != self.imageFormat or current != etag(digests,size,imageFormat):
+         return False
+      self.written[product] = state
+      return True
+
+   def forget(self,product):
+      self.written.pop(product,None)
@@ -0,0 +1,92 @@
+"""Process pool for the per-product compute-and-encode stage.
+
+Sample arrays are copied once into a shared memory arena owned by the main
+process; workers get only the arena name and per-array offsets, so nothing
+large is pickled on the way in.  Each product is pinned to one worker so
+that per-product state (e.g. incremental GAF fields) stays warm.
+"""
+import zlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+ALIGN = 64
+
+class SharedArena:
+   def __init__(self):
+      self.shm = None
+      self.offset = 0
+
+   def reserve(self,nbytes):
+      nbytes = max(nbytes,ALIGN)
+      if self.shm is None or self.shm.size < nbytes:
+         self.close()
+         self.shm = shared_memory.SharedMemory(create=True,size=2*nbytes)
+      self.offset = 0
+
+   def put(self,array):
+      array = np.ascontiguousarray(array)
+      view = np.ndarray(array.shape,dtype=array.dtype,buffer=self.shm.buf,offset=self.offset)
+      view[...] = array
+      spec = (self.offset,array.shape,array.dtype.str)
+      self.offset += -(-array.nbytes//ALIGN)*ALIGN
+      return spec
+
+   def pack(self,job):
+      arrays = {}
+      scalars = {}
+      for key,value in job.items():
+         if isinstance(value,np.ndarray): arrays[key] = self.put(value)
+         else: scalars[key] = value
+      return arrays,scalars
+
+   def close(self):
+      if self.shm is not None:
+         self.shm.close()
+         self.shm.unlink()
+         self.shm = None
+
+def packedSize(jobs):
+   return sum(-(-value.nbytes//ALIGN)*ALIGN for job in jobs for value in job.values() if isinstance(value,np.ndarray))
+
+attached = {}
+
+def unpack(name,packed):
+   shm = attached.get(name,None)
+   if shm is None:
+      for old in attached.values():
+         old.close()
+      attached.clear()
+      # the workers share the main process's resource tracker, which already tracks the block for its owner
+      shm = shared_memory.SharedMemory(name=name)
+      attached[name] = shm
+   arrays,scalars = packed
+   job = dict(scalars)
+   for key,(offset,shape,dtype) in arrays.items():
+      job[key] = np.ndarray(shape,dtype=np.dtype(dtype),buffer=shm.buf,offset=offset)
+   return job
+
+class ProductPool:
+   def __init__(self,workers,initializer=None,initargs=()):
+      context = multiprocessing.get_context('forkserver')
+      # workers start from a clean server that has already imported the main module
+      context.set_forkserver_preload(['__main__'])
+      self.slots = [ ProcessPoolExecutor(max_workers=1,mp_context=context,initializer=initializer,initargs=initargs) for _ in range(workers) ]
+      self.arena = SharedArena()
+
+   def slot(self,product):
+      return self.slots[zlib.crc32(product.encode()) % len(self.slots)]
+
+   def map(self,fn,jobs):
+      # results come back in job order; the arena is reused on the next call
+      if len(jobs) == 0:
+         return []
+      self.arena.reserve(packedSize(jobs))
+      futures = [ self.slot(job['product']).submit(fn,self.arena.shm.name,self.arena.pack(job)) for job in jobs ]
+      return [ future.result() for future in futures ]
+
+   def shutdown(self):
+      for slot in self.slots:
+         slot.shutdown()
+      self.arena.close()
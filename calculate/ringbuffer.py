@@ -0,0 +1,133 @@
+"""Resident per-product sample windows for the calculate worker.
+
+Each product keeps its newest samples in a fixed-capacity ring.  A cycle
+only fetches rows newer than the ring's newest sample_id and checks that the
+rows it already holds are still in the table; anything that does not line up
+(pruned holes, a late commit, a new max_size) falls back to a full reload of
+that product.  Trades are stored raw and smoothed with the product's kernel
+when the window is read, so the ring also holds the older samples the
+kernel reaches.
+"""
+import numpy as np
+from samples import getSampleWindows,getSampleDeltas
+from smoothing import BOX
+
+ORDERBOOK_KEYS = ('askPrices','askSizes','bidPrices','bidSizes')
+
+class SampleRing:
+   """Newest ``maxSize`` samples of one product plus the older samples ``kernel`` reaches.
+
+   Rows are written oldest to newest at ``(start + k) % capacity``; the
+   oldest ones are overwritten once the ring is full.  Order book columns
+   grow (NaN padded) when a wider book shows up.
+   """
+
+   def __init__(self,maxSize,kernel=BOX):
+      self.maxSize = maxSize
+      self.kernel = kernel
+      self.capacity = maxSize + kernel.older
+      self.start = 0
+      self.count = 0
+      self.sampleIds = np.zeros(self.capacity,dtype=np.int64)
+      self.midpoint = np.full(self.capacity,np.nan)
+      self.orderbook = { key: np.full((self.capacity,0),np.nan) for key in ORDERBOOK_KEYS }
+      self.depths = np.zeros((self.capacity,len(ORDERBOOK_KEYS)),dtype=np.int64)
+      self.buys = np.full((self.capacity,3),np.nan)
+      self.sells = np.full((self.capacity,3),np.nan)
+
+   def order(self):
+      # storage positions, newest first
+      return (self.start + np.arange(self.count - 1,-1,-1)) % self.capacity
+
+   def oldest(self):
+      return int(self.sampleIds[self.start])
+
+   def newest(self):
+      return int(self.sampleIds[(self.start + self.count - 1) % self.capacity])
+
+   def append(self,window):
+      # window is in getSampleWindows form (newest first) and only holds rows newer than newest()
+      keep = min(len(window['sampleIds']),self.capacity)
+      at = (self.start + self.count + np.arange(keep)) % self.capacity
+      def newest(values):
+         # the newest keep rows, oldest first
+         return values[:keep][::-1]
+      self.sampleIds[at] = newest(window['sampleIds'])
+      self.midpoint[at] = newest(window['midpoint'])
+      for key in ORDERBOOK_KEYS:
+         values = newest(window[key])
+         stored = self.orderbook[key]
+         if values.shape[1] > stored.shape[1]:
+            stored = np.pad(stored,((0,0),(0,values.shape[1] - stored.shape[1])),constant_values=np.nan)
+            self.orderbook[key] = stored
+         stored[at,:values.shape[1]] = values
+         stored[at,values.shape[1]:] = np.nan
+      self.depths[at] = newest(window['depths'])
+      self.buys[at] = newest(window['buys'])
+      self.sells[at] = newest(window['sells'])
+      overflow = max(self.count + keep - self.capacity,0)
+      self.start = (self.start + overflow) % self.capacity
+      self.count = min(self.count + keep,self.capacity)
+
+   def drop(self,rows):
+      # forget the oldest rows
+      rows = min(rows,self.count)
+      self.start = (self.start + rows) % self.capacity
+      self.count -= rows
+
+   def retain(self,retained,retainedFrom):
+      # drop what collect has pruned; False when the rows left differ from what the table still holds
+      if retained == 0:
+         self.drop(self.count)
+         return False
+      held = self.sampleIds[self.order()[::-1]]
+      self.drop(int(np.searchsorted(held,retainedFrom)))
+      return self.count == retained
+
+   def window(self):
+      order = self.order()
+      newest = order[:self.maxSize]
+      depths = self.depths[newest].max(axis=0) if len(newest) > 0 else np.zeros(len(ORDERBOOK_KEYS),dtype=np.int64)
+      window = {
+         'sampleIds': self.sampleIds[newest],
+         'midpoint': self.midpoint[newest],
+         'depths': self.depths[newest]
+      }
+      for key,depth in zip(ORDERBOOK_KEYS,depths):
+         window[key] = self.orderbook[key][newest,:depth]
+      window['buys'] = self.kernel.apply(self.buys[order])[:self.maxSize]
+      window['sells'] = self.kernel.apply(self.sells[order])[:self.maxSize]
+      return window
+
+def getRingWindows(conn,rings,maxSizes,products=None,sampleFormat='numeric',kernels=None):
+   # same result as getSampleWindows(conn,products,kernels), served from rings that are brought up to date in place
+   if kernels is None: kernels = {}
+   for product in [ x for x in rings if x not in maxSizes ]:
+      del rings[product]
+   wanted = [ x for x in maxSizes if products is None or x in products ]
+   cold = []
+   cursors = {}
+   for product in wanted:
+      ring = rings.get(product,None)
+      if ring is None or ring.maxSize != maxSizes[product] or ring.kernel.spec != kernels.get(product,BOX).spec or ring.count == 0:
+         cold.append(product)
+      else:
+         cursors[product] = (ring.oldest(),ring.newest())
+   for product,(retained,retainedFrom,fresh) in getSampleDeltas(conn,cursors,sampleFormat).items():
+      ring = rings[product]
+      if not ring.retain(retained,retainedFrom):
+         cold.append(product)
+      elif fresh is not None:
+         ring.append(fresh)
+   if len(cold) > 0:
+      margin = max(kernels.get(x,BOX).older for x in cold)
+      loaded = getSampleWindows(conn,cold,extra=margin,sampleFormat=sampleFormat,smoothed=False)
+      for product in cold:
+         rings.pop(product,None)
+         window = loaded.get(product,None)
+         if window is None:
+            continue
+         ring = SampleRing(maxSizes[product],kernels.get(product,BOX))
+         ring.append(window)
+         rings[product] = ring
+   return { product: rings[product].window() for product in wanted if product in rings }
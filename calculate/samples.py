@@ -0,0 +1,280 @@
+"""Columnar sample fetch for the calculate worker.
+
+All products are read in one statement, one row per product, with each
+column aggregated into a float8/int8 array.  The binary array payloads are
+decoded straight into NumPy arrays, so there is no per-row Python work.
+NULL values (and ragged order book depth) arrive as NaN.  Each product's
+newest samples are a plain range read off the (product, sample_id) index,
+and trades are smoothed afterwards in NumPy (see smoothing.py).
+
+With the packed sample format each product instead comes back as one bytea
+holding its packed samples back to back, which is viewed in place with
+np.frombuffer (see packedDtype).
+"""
+import struct
+import numpy as np
+from smoothing import BOX
+from psycopg.adapt import Loader
+from psycopg.pq import Format
+
+FLOAT8_ARRAY_OID = 1022
+INT8_ARRAY_OID = 1016
+
+class NumpyArrayLoader(Loader):
+   format = Format.BINARY
+   dtype = None
+
+   def load(self,data):
+      ndim,flags = struct.unpack_from('!ii',data)
+      if ndim == 0:
+         return np.empty(0,dtype=self.dtype.newbyteorder('='))
+      if flags != 0:
+         raise ValueError("array with NULL elements cannot be loaded into numpy")
+      dims = struct.unpack_from('!' + 'ii'*ndim,data,12)[0::2]
+      records = np.frombuffer(data,dtype=[('len','>i4'),('value',self.dtype)],offset=12 + 8*ndim)
+      return records['value'].astype(self.dtype.newbyteorder('=')).reshape(dims)
+
+class Float8ArrayLoader(NumpyArrayLoader):
+   dtype = np.dtype('>f8')
+
+class Int8ArrayLoader(NumpyArrayLoader):
+   dtype = np.dtype('>i8')
+
+def register(adapters):
+   adapters.register_loader(FLOAT8_ARRAY_OID,Float8ArrayLoader)
+   adapters.register_loader(INT8_ARRAY_OID,Int8ArrayLoader)
+
+ORDERBOOK_COLUMNS = ('ask_prices','ask_sizes','bid_prices','bid_sizes')
+ORDERBOOK_KEYS = ('askPrices','askSizes','bidPrices','bidSizes')
+
+def padded(column):
+   return f"""array_replace(coalesce({column}::float8[],'{{}}') || array_fill('NaN'::float8,ARRAY[{column}_depth - coalesce(cardinality({column}),0)]),NULL,'NaN')"""
+
+def trades(side):
+   names = ('price','size','orders')
+   return ','.join(f"s.{side}s[{i + 1}] AS {side}_{name}" for i,name in enumerate(names))
+
+DEPTH_COLUMNS = ',\n'.join(f"max(coalesce(cardinality({column}),0)) OVER p AS {column}_depth" for column in ORDERBOOK_COLUMNS)
+
+AGGREGATES = f"""
+      max(ask_prices_depth)::int,max(ask_sizes_depth)::int,max(bid_prices_depth)::int,max(bid_sizes_depth)::int,
+      array_agg(sample_id ORDER BY sample_id desc),
+      array_agg(coalesce(midpoint::float8,'NaN') ORDER BY sample_id desc),
+      array_agg({padded('ask_prices')} || 'NaN'::float8 ORDER BY sample_id desc),
+      array_agg({padded('ask_sizes')} || 'NaN'::float8 ORDER BY sample_id desc),
+      array_agg({padded('bid_prices')} || 'NaN'::float8 ORDER BY sample_id desc),
+      array_agg({padded('bid_sizes')} || 'NaN'::float8 ORDER BY sample_id desc),
+      array_agg(ARRAY[coalesce(buy_price::float8,'NaN'),coalesce(buy_size::float8,'NaN'),coalesce(buy_orders::float8,'NaN')] ORDER BY sample_id desc),
+      array_agg(ARRAY[coalesce(sell_price::float8,'NaN'),coalesce(sell_size::float8,'NaN'),coalesce(sell_orders::float8,'NaN')] ORDER BY sample_id desc),
+      array_agg(ARRAY[{','.join(f"coalesce(cardinality({column}),0)" for column in ORDERBOOK_COLUMNS)}]::int8[] ORDER BY sample_id desc)
+"""
+
+# the newest max_size + extra rows of each product, read backwards off the (product, sample_id) index
+RECENT_SAMPLES_SQL = """
+      FROM crypto_gaf.gafs g CROSS JOIN LATERAL (
+         SELECT * FROM crypto_gaf.samples
+         WHERE product = g.product
+         ORDER BY sample_id desc
+         LIMIT g.max_size + %(extra)s
+      ) s
+      WHERE g.max_size IS NOT NULL AND (%(products)s::text[] IS NULL OR g.product = ANY(%(products)s::text[]))
+"""
+
+SAMPLE_WINDOWS_SQL = f"""
+   WITH recent AS (
+      SELECT
+         g.product,g.max_size,s.sample_id,s.midpoint,s.ask_prices,s.ask_sizes,s.bid_prices,s.bid_sizes,
+         {trades('buy')},
+         {trades('sell')}
+      {RECENT_SAMPLES_SQL}
+   ),
+   windowed AS (
+      SELECT *,{DEPTH_COLUMNS}
+      FROM recent
+      WINDOW p AS (PARTITION BY product)
+   )
+   SELECT product,max(max_size),{AGGREGATES}
+   FROM windowed GROUP BY product
+"""
+
+# rows newer than each product's cursor, plus how many of the rows the caller
+# already holds (oldest..newest) are still in the table and the oldest of them
+SAMPLE_DELTAS_SQL = f"""
+   WITH cursors AS (
+      SELECT * FROM unnest(%(products)s::text[],%(oldest)s::int8[],%(newest)s::int8[]) AS c(product,oldest,newest)
+   ),
+   retained AS (
+      SELECT c.product,count(s.sample_id)::int AS retained,min(s.sample_id) AS retained_from
+      FROM cursors c LEFT JOIN crypto_gaf.samples s ON s.product = c.product AND s.sample_id BETWEEN c.oldest AND c.newest
+      GROUP BY c.product
+   ),
+   fresh AS (
+      SELECT
+         s.product,s.sample_id,s.midpoint,s.ask_prices,s.ask_sizes,s.bid_prices,s.bid_sizes,
+         {trades('buy')},
+         {trades('sell')}
+      FROM crypto_gaf.samples s JOIN cursors c ON c.product = s.product AND s.sample_id > c.newest
+   ),
+   windowed AS (
+      SELECT *,{DEPTH_COLUMNS}
+      FROM fresh
+      WINDOW p AS (PARTITION BY product)
+   )
+   SELECT r.product,r.retained,r.retained_from,{AGGREGATES}
+   FROM retained r JOIN windowed f ON f.product = r.product
+   GROUP BY r.product,r.retained,r.retained_from
+   UNION ALL
+   SELECT r.product,r.retained,r.retained_from,0,0,0,0,NULL,NULL,NULL,NULL,NULL,NULL,NULL,NULL,NULL
+   FROM retained r WHERE NOT EXISTS (SELECT 1 FROM fresh f WHERE f.product = r.product)
+"""
+
+# packed sample layout, big-endian like float8send: int2 cardinality of ask_prices, ask_sizes, bid_prices,
+# bid_sizes, then float8 midpoint, buys[3], sells[3] and the four order book columns, each NaN padded to the
+# same depth.  NULLs are NaN.
+PACKED_HEADER = 8
+PACKED_FIXED = 7
+
+def packedDtype(length):
+   return np.dtype([('counts','>i2',(4,)),('values','>f8',((length - PACKED_HEADER)//8,))])
+
+def unpackSamples(sampleIds,lengths,blob):
+   # packed samples in getSampleWindows form, raw trades
+   count = len(lengths)
+   if count > 0 and (lengths == lengths[0]).all():
+      records = np.frombuffer(blob,dtype=packedDtype(int(lengths[0])))
+      counts = records['counts']
+      values = records['values']
+   else:
+      # the depth changed inside the window: copy each group of records into one common layout
+      slots = (int(lengths.max()) - PACKED_HEADER)//8 if count > 0 else PACKED_FIXED
+      depth = (slots - PACKED_FIXED)//4
+      counts = np.zeros((count,4),dtype=np.int64)
+      values = np.full((count,slots),np.nan)
+      starts = np.cumsum(lengths) - lengths
+      raw = np.frombuffer(blob,dtype=np.uint8)
+      for length in np.unique(lengths):
+         at = np.flatnonzero(lengths == length)
+         records = raw[starts[at,None] + np.arange(length)].view(packedDtype(int(length))).reshape(len(at))
+         width = (records['values'].shape[1] - PACKED_FIXED)//4
+         counts[at] = records['counts']
+         values[at,:PACKED_FIXED] = records['values'][:,:PACKED_FIXED]
+         for k in range(4):
+            values[at,PACKED_FIXED + k*depth:PACKED_FIXED + k*depth + width] = records['values'][:,PACKED_FIXED + k*width:PACKED_FIXED + (k + 1)*width]
+   depth = (values.shape[1] - PACKED_FIXED)//4
+   counts = counts.astype(np.int64)
+   widths = counts.max(axis=0) if len(counts) > 0 else np.zeros(4,dtype=np.int64)
+   window = {
+      'sampleIds': sampleIds,
+      'midpoint': values[:,0],
+      'buys': values[:,1:4],
+      'sells': values[:,4:7],
+      'depths': counts
+   }
+   for k,key in enumerate(ORDERBOOK_KEYS):
+      window[key] = values[:,PACKED_FIXED + k*depth:PACKED_FIXED + k*depth + widths[k]]
+   return window
+
+PACKED_WINDOWS_SQL = f"""
+   WITH recent AS (
+      SELECT g.product,g.max_size,s.sample_id,s.packed
+      {RECENT_SAMPLES_SQL}
+   )
+   SELECT product,max(max_size),
+      array_agg(sample_id ORDER BY sample_id desc),
+      array_agg(length(packed)::int8 ORDER BY sample_id desc),
+      string_agg(packed,''::bytea ORDER BY sample_id desc)
+   FROM recent WHERE packed IS NOT NULL
+   GROUP BY product
+"""
+
+PACKED_DELTAS_SQL = """
+   WITH cursors AS (
+      SELECT * FROM unnest(%(products)s::text[],%(oldest)s::int8[],%(newest)s::int8[]) AS c(product,oldest,newest)
+   ),
+   retained AS (
+      SELECT c.product,count(s.sample_id)::int AS retained,min(s.sample_id) AS retained_from
+      FROM cursors c LEFT JOIN crypto_gaf.samples s ON s.product = c.product AND s.sample_id BETWEEN c.oldest AND c.newest AND s.packed IS NOT NULL
+      GROUP BY c.product
+   ),
+   fresh AS (
+      SELECT s.product,s.sample_id,s.packed
+      FROM crypto_gaf.samples s JOIN cursors c ON c.product = s.product AND s.sample_id > c.newest
+      WHERE s.packed IS NOT NULL
+   )
+   SELECT r.product,r.retained,r.retained_from,
+      array_agg(f.sample_id ORDER BY f.sample_id desc) FILTER (WHERE f.sample_id IS NOT NULL),
+      array_agg(length(f.packed)::int8 ORDER BY f.sample_id desc) FILTER (WHERE f.sample_id IS NOT NULL),
+      string_agg(f.packed,''::bytea ORDER BY f.sample_id desc)
+   FROM retained r LEFT JOIN fresh f ON f.product = r.product
+   GROUP BY r.product,r.retained,r.retained_from
+"""
+
+def windowFromRow(row):
+   askPriceDepth,askSizeDepth,bidPriceDepth,bidSizeDepth = row[:4]
+   # every order book row carries one trailing NaN so depth 0 still aggregates
+   return {
+      'sampleIds': row[4],
+      'midpoint': row[5],
+      'askPrices': row[6][:,:askPriceDepth],
+      'askSizes': row[7][:,:askSizeDepth],
+      'bidPrices': row[8][:,:bidPriceDepth],
+      'bidSizes': row[9][:,:bidSizeDepth],
+      'buys': row[10],
+      'sells': row[11],
+      'depths': row[12]
+   }
+
+def head(window,rows):
+   # the newest rows samples of a window, order book columns cut to their depth
+   window = { key: values[:rows] for key,values in window.items() }
+   widths = window['depths'].max(axis=0) if len(window['depths']) > 0 else np.zeros(len(ORDERBOOK_KEYS),dtype=np.int64)
+   for key,width in zip(ORDERBOOK_KEYS,widths):
+      window[key] = window[key][:,:width]
+   return window
+
+def smooth(window,kernel):
+   window['buys'] = kernel.apply(window['buys'])
+   window['sells'] = kernel.apply(window['sells'])
+   return window
+
+def getSampleWindows(conn,products=None,kernels=None,extra=0,sampleFormat='numeric',smoothed=True):
+   # one snapshot of the newest max_size (+ extra) samples of every product (or only the given ones), newest first;
+   # buys/sells are smoothed with the product's kernel (box:5 when kernels has none) unless smoothed is False.
+   # the older rows a kernel reaches are fetched as well so the oldest samples smooth the same as the rest
+   if kernels is None: kernels = {}
+   margin = max([BOX.older] + [ x.older for x in kernels.values() ]) if smoothed else 0
+   windows = {}
+   with conn.cursor(binary=True) as cur:
+      register(cur.adapters)
+      if sampleFormat == 'packed':
+         cur.execute(PACKED_WINDOWS_SQL,{ 'products': products, 'extra': extra + margin })
+         rows = [ (product,maxSize,unpackSamples(sampleIds,lengths,blob)) for product,maxSize,sampleIds,lengths,blob in cur.fetchall() ]
+      else:
+         cur.execute(SAMPLE_WINDOWS_SQL,{ 'products': products, 'extra': extra + margin })
+         rows = [ (row[0],row[1],windowFromRow(row[2:])) for row in cur.fetchall() ]
+   for product,maxSize,window in rows:
+      if smoothed: window = smooth(window,kernels.get(product,BOX))
+      windows[product] = head(window,maxSize + extra) if margin > 0 else window
+   return windows
+
+def getSampleDeltas(conn,cursors,sampleFormat='numeric'):
+   # cursors maps product -> (oldest,newest) sample_id held by the caller;
+   # returns product -> (retained,retainedFrom,window of newer raw rows or None)
+   deltas = {}
+   if len(cursors) == 0:
+      return deltas
+   products = list(cursors)
+   with conn.cursor(binary=True) as cur:
+      register(cur.adapters)
+      cur.execute(PACKED_DELTAS_SQL if sampleFormat == 'packed' else SAMPLE_DELTAS_SQL,{
+         'products': products,
+         'oldest': [ cursors[x][0] for x in products ],
+         'newest': [ cursors[x][1] for x in products ]
+      })
+      for row in cur.fetchall():
+         if sampleFormat == 'packed':
+            window = unpackSamples(row[3],row[4],row[5]) if row[3] is not None else None
+         else:
+            window = windowFromRow(row[3:]) if row[7] is not None else None
+         deltas[row[0]] = (row[1],row[2],window)
+   return deltas
@@ -0,0 +1,95 @@
+"""Vectorized sample sanitization for the calculate worker.
+
+Series are (samples x depth) float arrays, newest sample first, with a mask
+marking NULL/invalid cells (NaN when no mask is given).  Invalid cells take
+the last valid value of their column, or 0.0 before the first one.
+"""
+import numpy as np
+
+def invalid_mask(values,mask=None):
+   if isinstance(values,np.ma.MaskedArray):
+      mask = np.ma.getmaskarray(values)
+      values = values.data
+   values = np.asarray(values,dtype=np.float64)
+   if mask is None:
+      mask = np.isnan(values)
+   return values,np.asarray(mask,dtype=bool)
+
+def to_masked(rows,depth=None):
+   # ragged row lists (None, short rows, unparsable cells) -> masked (samples x depth)
+   rows = rows or []
+   if depth is None:
+      depth = max([ len(row) for row in rows if row ] or [0])
+   values = np.zeros((len(rows),depth))
+   mask = np.ones((len(rows),depth),dtype=bool)
+   for i,row in enumerate(rows):
+      for j,value in enumerate((row or [])[:depth]):
+         if value is None:
+            continue
+         try:
+            values[i,j] = float(value)
+            mask[i,j] = False
+         except (TypeError, ValueError):
+            pass
+   return np.ma.MaskedArray(values,mask)
+
+def forward_fill(values,mask=None):
+   values,mask = invalid_mask(values,mask)
+   if values.size == 0:
+      return values.copy()
+   flat = values.ndim == 1
+   if flat:
+      values = values[:,None]
+      mask = mask[:,None]
+   index = np.where(mask,-1,np.arange(values.shape[0])[:,None])
+   np.maximum.accumulate(index,axis=0,out=index)
+   filled = np.take_along_axis(values,np.maximum(index,0),axis=0)
+   filled[index < 0] = 0.0
+   return filled[:,0] if flat else filled
+
+def fit_depth(values,depth,mask=None):
+   # pad missing columns as invalid, drop columns past depth
+   values,mask = invalid_mask(values,mask)
+   have = values.shape[1]
+   if have >= depth:
+      return values[:,:depth],mask[:,:depth]
+   padding = ((0,0),(0,depth - have))
+   return np.pad(values,padding),np.pad(mask,padding,constant_values=True)
+
+def fit_length(values,length,width):
+   # repeat the last row up to length, or trim to it; an empty series starts from zeros
+   if len(values) == 0:
+      values = np.zeros((1,width) if values.ndim == 2 else 1)
+   if len(values) >= length:
+      return values[:length]
+   fill = np.repeat(values[-1:],length - len(values),axis=0)
+   return np.concatenate([values,fill])
+
+def sanitize_midpoints(midpoints,mask=None):
+   if midpoints is None:
+      return np.empty(0)
+   return forward_fill(midpoints,mask)
+
+def sanitize_orderbook(prices,sizes,priceMask=None,sizeMask=None,expected_depth=None):
+   prices,priceMask = invalid_mask(prices if prices is not None else np.empty((0,0)),priceMask)
+   sizes,sizeMask = invalid_mask(sizes if sizes is not None else np.empty((0,0)),sizeMask)
+   depth = max(expected_depth or 0,prices.shape[1],sizes.shape[1])
+   if depth == 0:
+      return np.empty((0,0)),np.empty((0,0)),0
+   total = max(len(prices),len(sizes))
+   cleaned = []
+   for values,mask in ((prices,priceMask),(sizes,sizeMask)):
+      values,mask = fit_depth(values,depth,mask)
+      missing = total - len(values)
+      values = np.pad(values,((0,missing),(0,0)))
+      mask = np.pad(mask,((0,missing),(0,0)),constant_values=True)
+      cleaned.append(forward_fill(values,mask))
+   return cleaned[0],cleaned[1],depth
+
+def sanitize_trades(trades,mask=None,expected_len=3):
+   trades,mask = invalid_mask(trades if trades is not None else np.empty((0,expected_len)),mask)
+   trades,mask = fit_depth(trades,expected_len,mask)
+   cleaned = forward_fill(trades,mask)
+   if len(cleaned) == 0:
+      cleaned = np.zeros((1,expected_len))
+   return cleaned
@@ -0,0 +1,147 @@
+"""Shared memory sample rings, the reading side (TRANSPORT=shm).
+
+collect (SHM_RING_SIZE > 0) publishes every polled sample into a shared
+memory segment per product; see collect/shmring.py for the layout, which
+is repeated here.  A window is the newest max_size samples plus the older
+ones the smoothing kernel reaches, copied out of the ring slot by slot
+under the seqlock and returned in getSampleWindows form, with the ring's
+sequence numbers as sampleIds.  A product is left to the database when
+its segment is missing or retired, collect has not beaten for SHM_STALE
+seconds (so a stopped collect never freezes the images), or the ring does
+not hold a whole window yet.
+"""
+import re
+import time
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+from samples import ORDERBOOK_KEYS,head,smooth
+from smoothing import BOX
+
+MAGIC = b'CGAFRNG1'
+LIVE = 1
+HEADER = np.dtype({
+   'names': ['magic','state','depth','capacity','base','head','beat','pid'],
+   'formats': ['S8','<u4','<u4','<u8','<u8','<u8','<f8','<u8'],
+   'offsets': [0,8,12,16,24,32,40,48],
+   'itemsize': 64
+})
+RING_POLL = 0.002
+
+def recordDtype(depth):
+   return np.dtype([('lock','<u8'),('seq','<u8'),('published','<f8'),('counts','<i2',(4,)),('values','<f8',(7 + 4*depth,))])
+
+def ringName(product):
+   return 'crypto_gaf_' + re.sub(r'[^A-Za-z0-9_.-]','_',product)
+
+class RingReader:
+   def __init__(self,product):
+      self.product = product
+      self.shm = shared_memory.SharedMemory(name=ringName(product))
+      # collect owns the segment
+      resource_tracker.unregister(self.shm._name,'shared_memory')
+      self.header = np.ndarray(1,dtype=HEADER,buffer=self.shm.buf)
+      if self.header['magic'][0] != MAGIC:
+         self.close()
+         raise FileNotFoundError(f"{ringName(product)} is not a sample ring")
+      self.depth = int(self.header['depth'][0])
+      self.capacity = int(self.header['capacity'][0])
+      self.base = int(self.header['base'][0])
+      self.records = np.ndarray(self.capacity,dtype=recordDtype(self.depth),buffer=self.shm.buf,offset=HEADER.itemsize)
+
+   def live(self,now,staleAfter):
+      return self.header['state'][0] == LIVE and now - float(self.header['beat'][0]) <= staleAfter
+
+   def head(self):
+      return int(self.header['head'][0])
+
+   def read(self,count,retries=3):
+      # the newest count samples, newest first; None when the ring holds fewer or keeps changing under the copy
+      for _ in range(retries):
+         newest = self.head()
+         if newest - self.base + 1 < count or count > self.capacity:
+            return None
+         seqs = newest - np.arange(count,dtype=np.uint64)
+         slots = seqs % np.uint64(self.capacity)
+         before = self.records['lock'][slots]
+         records = self.records[slots]
+         after = self.records['lock'][slots]
+         if ((before == 2*seqs) & (after == before)).all():
+            return records
+      return None
+
+   def close(self):
+      self.records = None
+      self.header = None
+      self.shm.close()
+
+def windowFromRecords(records):
+   # ring records in getSampleWindows form, raw trades
+   values = records['values']
+   depth = (values.shape[1] - 7)//4
+   counts = records['counts'].astype(np.int64)
+   widths = counts.max(axis=0) if len(counts) > 0 else np.zeros(4,dtype=np.int64)
+   window = {
+      'sampleIds': records['seq'].astype(np.int64),
+      'midpoint': values[:,0],
+      'buys': values[:,1:4],
+      'sells': values[:,4:7],
+      'depths': counts
+   }
+   for k,key in enumerate(ORDERBOOK_KEYS):
+      window[key] = values[:,7 + k*depth:7 + k*depth + widths[k]]
+   return window
+
+def attachReader(readers,product,now,staleAfter):
+   # the product's reader, (re)attached when its segment was replaced; None without a live segment
+   reader = readers.get(product,None)
+   if reader is not None and reader.header['state'][0] != LIVE:
+      reader.close()
+      reader = None
+      del readers[product]
+   if reader is None:
+      try:
+         reader = RingReader(product)
+      except (FileNotFoundError, ValueError):
+         return None
+      readers[product] = reader
+   return reader if reader.live(now,staleAfter) else None
+
+def getSharedWindows(readers,maxSizes,products=None,kernels=None,staleAfter=10):
+   # the windows getSampleWindows(conn,products,kernels) would give, for the products whose rings can serve them;
+   # returns the windows and the time each newest sample was published
+   if kernels is None: kernels = {}
+   for product in [ x for x in readers if x not in maxSizes ]:
+      readers.pop(product).close()
+   now = time.time()
+   windows = {}
+   published = {}
+   for product,maxSize in maxSizes.items():
+      if maxSize is None or (products is not None and product not in products):
+         continue
+      reader = attachReader(readers,product,now,staleAfter)
+      if reader is None:
+         continue
+      kernel = kernels.get(product,BOX)
+      records = reader.read(maxSize + kernel.older)
+      if records is None:
+         continue
+      windows[product] = head(smooth(windowFromRecords(records),kernel),maxSize)
+      published[product] = float(records['published'][0])
+   return windows,published
+
+def waitForRings(readers,heads,timeout,coalesce):
+   # block until the head of a ring moves (or timeout), then merge the rest of the burst for coalesce seconds;
+   # heads holds the heads seen so far and is updated; returns the products whose rings moved
+   moved = set()
+   deadline = time.monotonic() + timeout
+   while True:
+      for product,reader in readers.items():
+         newest = reader.head()
+         if heads.get(product,None) != newest:
+            heads[product] = newest
+            moved.add(product)
+      now = time.monotonic()
+      if len(moved) > 0 and deadline > now + coalesce: deadline = now + coalesce
+      if now >= deadline:
+         return moved
+      time.sleep(min(RING_POLL,deadline - now))
@@ -0,0 +1,82 @@
+"""Client-side trade smoothing for the calculate worker.
+
+Samples are fetched raw, newest first, and buys/sells are smoothed here with
+a kernel chosen per product (gafs.smoothing, falling back to SMOOTHING):
+
+   box[:radius]               mean of the radius newer and radius older samples
+                              (box:5, the default, is the 11 sample window the
+                              SQL query used to apply)
+   gaussian[:sigma[:radius]]  Gaussian weights, radius defaults to ceil(3 sigma)
+   ema[:alpha[:radius]]       weights alpha*(1 - alpha)^k over the sample and the
+                              k older ones, cut off below 0.1% of the first
+   none
+
+As with SQL avg() OVER (ROWS BETWEEN ...), NaN samples and rows past either
+end of the series are left out and the remaining weights renormalized, so
+the newest samples are averaged over fewer rows.
+"""
+import functools
+import math
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+SMOOTHING_RADIUS = 5
+
+class Kernel:
+   """Weights over ``newer`` newer samples, the sample itself and ``older`` older ones, newest first."""
+
+   def __init__(self,spec,weights,newer):
+      self.spec = spec
+      self.weights = np.asarray(weights,dtype=np.float64)
+      self.newer = newer
+      self.older = len(self.weights) - newer - 1
+
+   def apply(self,values):
+      # smooth along axis 0 of a newest first array
+      values = np.asarray(values,dtype=np.float64)
+      if len(self.weights) == 1 or len(values) == 0:
+         return values.copy()
+      valid = ~np.isnan(values)
+      padding = ((self.newer,self.older),) + ((0,0),)*(values.ndim - 1)
+      sums = sliding_window_view(np.pad(np.where(valid,values,0.0),padding),len(self.weights),axis=0) @ self.weights
+      weights = sliding_window_view(np.pad(valid.astype(np.float64),padding),len(self.weights),axis=0) @ self.weights
+      return np.divide(sums,weights,out=np.full(sums.shape,np.nan),where=weights > 0)
+
+def box(spec,radius=SMOOTHING_RADIUS):
+   radius = int(radius)
+   if radius < 0:
+      raise ValueError("radius must not be negative")
+   return Kernel(spec,np.ones(2*radius + 1),radius)
+
+def gaussian(spec,sigma=2.0,radius=None):
+   sigma = float(sigma)
+   if sigma <= 0:
+      raise ValueError("sigma must be positive")
+   radius = math.ceil(3*sigma) if radius is None else int(radius)
+   offsets = np.arange(-radius,radius + 1)
+   return Kernel(spec,np.exp(-0.5*(offsets/sigma)**2),radius)
+
+def ema(spec,alpha=0.3,radius=None):
+   alpha = float(alpha)
+   if not 0 < alpha <= 1:
+      raise ValueError("alpha must be in (0,1]")
+   if radius is None:
+      radius = math.ceil(math.log(1e-3)/math.log(1 - alpha)) if alpha < 1 else 0
+   return Kernel(spec,alpha*(1 - alpha)**np.arange(int(radius) + 1),0)
+
+def none(spec):
+   return Kernel(spec,[1.0],0)
+
+KERNELS = { 'box': box, 'gaussian': gaussian, 'ema': ema, 'none': none }
+
+@functools.lru_cache(maxsize=None)
+def getKernel(spec):
+   name,*options = spec.split(':')
+   if name not in KERNELS:
+      raise ValueError(f"unknown smoothing {spec}")
+   try:
+      return KERNELS[name](spec,*options)
+   except (TypeError,ValueError) as e:
+      raise ValueError(f"bad smoothing {spec}: {e}")
+
+BOX = getKernel(f"box:{SMOOTHING_RADIUS}")
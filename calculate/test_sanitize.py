@@ -0,0 +1,187 @@
+"""Property test: the vectorized sanitizer against the list-based one it replaced.
+
+The reference functions below are the previous implementations from
+calculate/app.py, kept verbatim.  Random inputs cover ragged depth, None
+rows and cells, unparsable strings, empty and short series, and depth
+padding and trimming.  Run with python -m pytest calculate.
+"""
+import random
+import numpy as np
+import sanitize
+
+def reference_sanitize_midpoints(midpoints):
+   cleaned = []
+   last = 0.0
+   if midpoints is None:
+      return cleaned
+   for value in midpoints:
+      if value is None:
+         cleaned.append(last)
+         continue
+      try:
+         last = float(value)
+      except (TypeError, ValueError):
+         cleaned.append(last)
+         continue
+      cleaned.append(last)
+   return cleaned
+
+def reference_sanitize_orderbook(price_samples,size_samples,expected_depth=None):
+   price_samples = price_samples or []
+   size_samples = size_samples or []
+   depth = expected_depth or 0
+   for row in price_samples:
+      if row:
+         depth = max(depth,len(row))
+   for row in size_samples:
+      if row:
+         depth = max(depth,len(row))
+   if depth == 0:
+      return [],[],0
+   total = max(len(price_samples),len(size_samples))
+   cleaned_price = []
+   cleaned_size = []
+   last_price = [0.0]*depth
+   last_size = [0.0]*depth
+   for idx in range(total):
+      price_row = price_samples[idx] if idx < len(price_samples) else None
+      size_row = size_samples[idx] if idx < len(size_samples) else None
+      price_values = []
+      size_values = []
+      for depth_index in range(depth):
+         value = last_price[depth_index]
+         if price_row and depth_index < len(price_row) and price_row[depth_index] is not None:
+            try:
+               value = float(price_row[depth_index])
+            except (TypeError, ValueError):
+               value = last_price[depth_index]
+         price_values.append(value)
+         value = last_size[depth_index]
+         if size_row and depth_index < len(size_row) and size_row[depth_index] is not None:
+            try:
+               value = float(size_row[depth_index])
+            except (TypeError, ValueError):
+               value = last_size[depth_index]
+         size_values.append(value)
+      cleaned_price.append(price_values)
+      cleaned_size.append(size_values)
+      last_price = price_values
+      last_size = size_values
+   return cleaned_price,cleaned_size,depth
+
+def reference_sanitize_trades(trade_samples,expected_len=3):
+   trade_samples = trade_samples or []
+   cleaned = []
+   last = [0.0]*expected_len
+   for row in trade_samples:
+      values = []
+      for idx in range(expected_len):
+         value = last[idx]
+         if row and idx < len(row) and row[idx] is not None:
+            try:
+               value = float(row[idx])
+            except (TypeError, ValueError):
+               value = last[idx]
+         values.append(value)
+      cleaned.append(values)
+      last = values
+   if len(cleaned) == 0:
+      cleaned.append(last)
+   return cleaned
+
+def reference_ensure_length(series,target,template):
+   series = series or []
+   result = []
+   for item in series:
+      if isinstance(item,(list,tuple)):
+         result.append(list(item))
+      else:
+         result.append(item)
+   if len(result) == 0:
+      result.append(template())
+   last = result[-1]
+   while len(result) < target:
+      result.append(list(last) if isinstance(last,list) else last)
+   if len(result) > target:
+      result = result[:target]
+   return result
+
+def reference_trim_depth(series,depth):
+   trimmed = []
+   for row in series:
+      trimmed.append([ float(x) for x in row[:depth] ])
+   return trimmed
+
+ROUNDS = 2000
+
+def randomCell(rnd):
+   r = rnd.random()
+   if r < 0.1: return None
+   if r < 0.15: return 'garbage'
+   if r < 0.18: return ''
+   if r < 0.2: return str(rnd.uniform(-10,10))
+   return rnd.uniform(-10,10)
+
+def randomRows(rnd,count,depth):
+   # None rows, short and long (ragged) rows among full ones
+   rows = []
+   for _ in range(count):
+      r = rnd.random()
+      if r < 0.1: rows.append(None)
+      elif r < 0.25: rows.append([ randomCell(rnd) for _ in range(rnd.randint(0,depth + 2)) ])
+      else: rows.append([ randomCell(rnd) for _ in range(depth) ])
+   return rows
+
+def same(expected,actual):
+   expected = np.asarray(expected,dtype=np.float64)
+   actual = np.asarray(actual,dtype=np.float64)
+   return expected.shape == actual.shape and np.array_equal(expected,actual,equal_nan=True)
+
+def test_midpoints():
+   rnd = random.Random(1)
+   assert same(reference_sanitize_midpoints(None),sanitize.sanitize_midpoints(None))
+   for _ in range(ROUNDS):
+      midpoints = [ randomCell(rnd) for _ in range(rnd.randint(0,12)) ]
+      series = sanitize.to_masked([ [x] for x in midpoints ],1)[:,0]
+      assert same(reference_sanitize_midpoints(midpoints),sanitize.sanitize_midpoints(series)),midpoints
+
+def test_orderbook():
+   rnd = random.Random(2)
+   for _ in range(ROUNDS):
+      depth = rnd.randint(0,4)
+      prices = randomRows(rnd,rnd.randint(0,12),depth)
+      sizes = randomRows(rnd,rnd.randint(0,12),depth)
+      # an expected depth past the widest row pads with invalid columns
+      expected = rnd.choice([None,0,depth,depth + 2])
+      price,size,width = reference_sanitize_orderbook(prices,sizes,expected)
+      cleanedPrice,cleanedSize,cleanedWidth = sanitize.sanitize_orderbook(sanitize.to_masked(prices),sanitize.to_masked(sizes),expected_depth=expected)
+      assert width == cleanedWidth,(prices,sizes,expected)
+      if width == 0:
+         assert cleanedPrice.size == 0 and cleanedSize.size == 0
+         continue
+      # no rows at all comes back as [] from the reference and as (0,width) here
+      assert same(np.reshape(price,(-1,width)),cleanedPrice),(prices,sizes,expected)
+      assert same(np.reshape(size,(-1,width)),cleanedSize),(prices,sizes,expected)
+
+def test_trades():
+   rnd = random.Random(3)
+   assert same(reference_sanitize_trades(None),sanitize.sanitize_trades(None))
+   for _ in range(ROUNDS):
+      trades = randomRows(rnd,rnd.randint(0,12),3)
+      assert same(reference_sanitize_trades(trades),sanitize.sanitize_trades(sanitize.to_masked(trades,3))),trades
+
+def test_fit_length():
+   rnd = random.Random(4)
+   for _ in range(ROUNDS):
+      depth = rnd.randint(1,4)
+      prices = randomRows(rnd,rnd.randint(0,12),depth)
+      price,_,width = reference_sanitize_orderbook(prices,[],depth)
+      cleaned,_,_ = sanitize.sanitize_orderbook(sanitize.to_masked(prices),None,expected_depth=depth)
+      # short series are padded with their last row (zeros when empty), long ones cut, and depth trimmed
+      target = rnd.randint(1,15)
+      keep = rnd.randint(1,width)
+      expected = reference_trim_depth(reference_ensure_length(price,target,lambda: [0.0]*width),keep)
+      assert same(expected,sanitize.fit_length(cleaned.reshape(-1,width),target,width)[:,:keep]),(prices,target,keep)
+      midpoints = reference_sanitize_midpoints([ randomCell(rnd) for _ in range(rnd.randint(0,12)) ])
+      expected = reference_ensure_length(midpoints,target,lambda: 0.0)
+      assert same(expected,sanitize.fit_length(np.asarray(midpoints,dtype=np.float64),target,1))
@@ -5,6 +5,13 @@ import psycopg
 import time
 import requests
 from urllib.parse import urljoin
+from poll import getSession,Poller
+from ingest import SAMPLE_CHANNEL,INSERT_SQL,SampleBuffer,sampleRow,migrate
+from retention import Pruner
+from record import Recorder,RecordingSession
+from schedule import POLICIES,Scheduler
+from shmring import SampleRings
+from metrics import SAMPLES,SKIPPED,PRUNED,BACKOFFS,MISSED,DRIFT,serve,stage,timedGet
 
 COINBASE_URL = os.environ.get('COINBASE_URL', 'http://coinbase-local:4201')
 
@@ -12,8 +19,8 @@ def _coinbase_path(path):
    base = COINBASE_URL if COINBASE_URL.endswith('/') else COINBASE_URL + '/'
    return urljoin(base, path.lstrip('/'))
 
-def getOrderbookInfo(product,aggregation,depth,timeout):
-   res = requests.get(_coinbase_path('/api/orderBook/interval'),params={ 'product':product, 'aggregation':aggregation, 'depth':depth },timeout=timeout)
+def getOrderbookInfo(product,aggregation,depth,timeout,session=requests):
+   res = timedGet(session,'orderbook',_coinbase_path('/api/orderBook/interval'),params={ 'product':product, 'aggregation':aggregation, 'depth':depth },timeout=timeout)
    if res.status_code == 200:
       parsed = res.json()
       if parsed != None and parsed.get('midpoint',None) != None and parsed.get('asks',None) != None and parsed.get('bids',None) != None:
@@ -24,8 +31,8 @@ def getOrderbookInfo(product,aggregation,depth,timeout):
       print("null respond from coinbase-local")
    return None,None,None
 
-def getMarketOrderInfo(product,since,timeout):
-   res = requests.get(_coinbase_path('/api/orderBook/marketOrders'),params={ 'product':product, 'since':since },timeout=timeout)
+def getMarketOrderInfo(product,since,timeout,session=requests):
+   res = timedGet(session,'marketOrders',_coinbase_path('/api/orderBook/marketOrders'),params={ 'product':product, 'since':since },timeout=timeout)
    if res.status_code == 200:
       parsed = res.json()
       if parsed != None and parsed.get('sequence',None) != None and parsed.get('buy',None) != None and parsed.get('sell',None) != None:
@@ -39,41 +46,62 @@ def getMarketOrderInfo(product,since,timeout):
 
 def getGafInfo(conn,cur):
    cur.execute( """
-      SELECT product,max_size FROM crypto_gaf.gafs
+      SELECT product,max_size,poll_interval,aggregation,depth,missed_ticks FROM crypto_gaf.gafs
       """)
    rows = cur.fetchall()
-   return [ [x[0],x[1]] for x in rows ]
+   return [ [x[0],x[1],x[2],x[3],x[4],x[5]] for x in rows ]
 
 def doInsert(conn,cur,asks,bids,buy,midpoint,product,sell):
-   sql = """
-      INSERT INTO crypto_gaf.samples (ask_prices,ask_sizes,bid_prices,bid_sizes,buys,midpoint,product,sells)
-      VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
-   """
-   cur.execute(sql,(
-      [ float(x[0]) for x in asks ],
-      [ float(x[1]) for x in asks ],
-      [ float(x[0]) for x in bids ],
-      [ float(x[1]) for x in bids ],
-      [ float(buy['price']), float(buy['size']), float(buy['numOrders']) ],
-      float(midpoint),
-      product,
-      [ float(sell['price']), float(sell['size']), float(sell['numOrders']) ]
-   ))
-   #conn.commit()
-   #cur.close()
+   cur.execute(INSERT_SQL,sampleRow(asks,bids,buy,midpoint,product,sell) + (SAMPLE_CHANNEL,))
 
-def doDelete(conn,cur,product,maxSize):
-   sql = """
-      WITH id_list AS
-      ( 
-         SELECT sample_id
-         FROM crypto_gaf.samples WHERE product = %s 
-         ORDER BY sample_id DESC
-         LIMIT %s
-      ) 
-      DELETE FROM crypto_gaf.samples WHERE sample_id NOT IN (SELECT * from id_list)
-   """
-   cur.execute(sql,(product,maxSize))
+def addSample(buffer,sequences,product,book,orders,error,publish=None):
+   # queues one product's sample (and hands it to publish); False when the poll failed and the product should back off
+   if error is None and (book[0] is None or orders[0] is None): error = "no sample"
+   if error is not None:
+      print(f"{product}: skipped, {error}")
+      SKIPPED.labels(product).inc()
+      return False
+   midpoint,asks,bids = book
+   sequence,buy,sell = orders
+   try:
+      row = sampleRow(asks,bids,buy,midpoint,product,sell)
+      buffer.add(row)
+   except (TypeError, ValueError, KeyError) as e:
+      print(f"{product}: skipped, {e}")
+      SKIPPED.labels(product).inc()
+      return False
+   sequences[product] = sequence
+   if publish is not None: publish(product,row)
+   return True
+
+def collectConcurrent(due,poller,session,buffer,sequences,timeout,deadline,publish=None):
+   # fan out the due products' requests, then queue a sample for each product that answered
+   calls = {}
+   for schedule in due:
+      product = schedule.product
+      calls[(product,'orderbook')] = (getOrderbookInfo,(product,schedule.aggregation,schedule.depth,timeout,session))
+      calls[(product,'marketOrders')] = (getMarketOrderInfo,(product,sequences.get(product,None),timeout,session))
+   results = poller.poll(calls,deadline)
+   polled = {}
+   for schedule in due:
+      product = schedule.product
+      book,bookError = results[(product,'orderbook')]
+      orders,ordersError = results[(product,'marketOrders')]
+      polled[product] = addSample(buffer,sequences,product,book,orders,bookError or ordersError,publish)
+   return polled
+
+def collectSequential(due,session,buffer,sequences,timeout,publish=None):
+   polled = {}
+   for schedule in due:
+      product = schedule.product
+      book,orders,error = None,None,None
+      try:
+         book = getOrderbookInfo(product,schedule.aggregation,schedule.depth,timeout,session)
+         orders = getMarketOrderInfo(product,sequences.get(product,None),timeout,session)
+      except (requests.RequestException, ValueError) as e:
+         error = e
+      polled[product] = addSample(buffer,sequences,product,book,orders,error,publish)
+   return polled
 
 def backoff(btime):
    print("backoff {0} seconds".format(btime))
@@ -92,61 +120,175 @@ def main(args):
    aggregation = 10
    depth = 3
    httpTimeout = 10
+   missedTicks = 'skip'
    conn = None
-   startTime = None
-   iterations = None
+   refreshed = None
    done = False
    btime = 5
    sequences = {}
+   pollMode = 'sequential'
+   pollThreads = 16
+   cycleDeadline = 0
+   poller = None
+   ingestMode = 'row'
+   flushRows = 1
+   flushLatency = 0
+   retentionInterval = 10
+   retentionBatch = 1000
+   retentionMaxBatches = 20
+   smoothing = 'box:5'
+   sampleFormat = 'numeric'
+   migrated = False
+   metricsPort = 0
+   recordPath = None
+   recorder = None
+   shmRingSize = 0
+   rings = None
+   publish = None
+   maxSizes = {}
    if os.environ.get('POSTGRES_USER') != None: postgresUser = os.environ.get('POSTGRES_USER')
    if os.environ.get('POSTGRES_PW') != None: postgresPw = os.environ.get('POSTGRES_PW')
    if os.environ.get('POSTGRES_HOST') != None: postgresHost = os.environ.get('POSTGRES_HOST')
    if os.environ.get('POSTGRES_PORT') != None: postgresPort = int(os.environ.get('POSTGRES_PORT'))
    if os.environ.get('POSTGRES_DB') != None: postgresDb = os.environ.get('POSTGRES_DB')
    if os.environ.get('SLEEP_INTERVAL') != None: sleepInterval = float(os.environ.get('SLEEP_INTERVAL'))
+   if os.environ.get('AGGREGATION') != None: aggregation = int(os.environ.get('AGGREGATION'))
+   if os.environ.get('DEPTH') != None: depth = int(os.environ.get('DEPTH'))
+   if os.environ.get('MISSED_TICKS') != None: missedTicks = os.environ.get('MISSED_TICKS')
    if os.environ.get('HTTP_TIMEOUT') != None: httpTimeout = float(os.environ.get('HTTP_TIMEOUT'))
+   if os.environ.get('POLL_MODE') != None: pollMode = os.environ.get('POLL_MODE')
+   if os.environ.get('POLL_THREADS') != None: pollThreads = int(os.environ.get('POLL_THREADS'))
+   if os.environ.get('CYCLE_DEADLINE') != None: cycleDeadline = float(os.environ.get('CYCLE_DEADLINE'))
+   if os.environ.get('INGEST_MODE') != None: ingestMode = os.environ.get('INGEST_MODE')
+   if os.environ.get('FLUSH_ROWS') != None: flushRows = int(os.environ.get('FLUSH_ROWS'))
+   if os.environ.get('FLUSH_LATENCY') != None: flushLatency = float(os.environ.get('FLUSH_LATENCY'))
+   if os.environ.get('RETENTION_INTERVAL') != None: retentionInterval = float(os.environ.get('RETENTION_INTERVAL'))
+   if os.environ.get('RETENTION_BATCH') != None: retentionBatch = int(os.environ.get('RETENTION_BATCH'))
+   if os.environ.get('RETENTION_MAX_BATCHES') != None: retentionMaxBatches = int(os.environ.get('RETENTION_MAX_BATCHES'))
+   if os.environ.get('SMOOTHING') != None: smoothing = os.environ.get('SMOOTHING')
+   if os.environ.get('SAMPLE_FORMAT') != None: sampleFormat = os.environ.get('SAMPLE_FORMAT')
+   if os.environ.get('METRICS_PORT') != None: metricsPort = int(os.environ.get('METRICS_PORT'))
+   if os.environ.get('RECORD_PATH') != None: recordPath = os.environ.get('RECORD_PATH')
+   if os.environ.get('SHM_RING_SIZE') != None: shmRingSize = int(os.environ.get('SHM_RING_SIZE'))
    if args.pg_user != None: postgresUser = args.pg_user
    if args.pg_pw != None: postgresPw = args.pg_pw
    if args.pg_host != None: postgresHost = args.pg_host
    if args.pg_port != None: postgresPort = int(args.pg_port)
    if args.db != None: postgresDb = args.db
    if args.sleep != None: sleepInterval = float(args.sleep)
+   if args.aggregation != None: aggregation = int(args.aggregation)
+   if args.depth != None: depth = int(args.depth)
+   if args.missed_ticks != None: missedTicks = args.missed_ticks
+   if args.poll_mode != None: pollMode = args.poll_mode
+   if args.poll_threads != None: pollThreads = int(args.poll_threads)
+   if args.deadline != None: cycleDeadline = float(args.deadline)
+   if args.ingest_mode != None: ingestMode = args.ingest_mode
+   if args.flush_rows != None: flushRows = int(args.flush_rows)
+   if args.flush_latency != None: flushLatency = float(args.flush_latency)
+   if args.retention_interval != None: retentionInterval = float(args.retention_interval)
+   if args.retention_batch != None: retentionBatch = int(args.retention_batch)
+   if args.retention_max_batches != None: retentionMaxBatches = int(args.retention_max_batches)
+   if args.smoothing != None: smoothing = args.smoothing
+   if args.sample_format != None: sampleFormat = args.sample_format
+   if args.metrics_port != None: metricsPort = int(args.metrics_port)
+   if args.record != None: recordPath = args.record
+   if args.shm_ring_size != None: shmRingSize = int(args.shm_ring_size)
    if postgresPw is None and os.path.exists('/run/secrets/pg_pw'):
       with open('/run/secrets/pg_pw') as secret:
          postgresPw = secret.read().strip()
+   if pollMode not in ('sequential','concurrent'):
+      print(f"unknown poll mode {pollMode}")
+      return
+   if missedTicks not in POLICIES:
+      print(f"unknown missed tick policy {missedTicks}")
+      return
+   scheduler = Scheduler(sleepInterval,aggregation,depth,missedTicks)
+   try:
+      buffer = SampleBuffer(ingestMode,flushRows,flushLatency,sampleFormat,depth)
+   except ValueError as e:
+      print(e)
+      return
+   session = getSession(pollThreads)
+   if recordPath:
+      recorder = Recorder(recordPath)
+      session = RecordingSession(session,recorder)
+      print(f"collect: recording coinbase-local responses to {recordPath}")
+   if pollMode == 'concurrent': poller = Poller(pollThreads)
+   if shmRingSize > 0:
+      rings = SampleRings(shmRingSize)
+      # samples go to the rings at poll time, ahead of the buffered insert
+      publish = lambda product,row: rings.publish(product,row,maxSizes.get(product,None),scheduler.products[product].depth)
+      print(f"collect: publishing samples to shared memory rings of at least {shmRingSize} samples")
+   try:
+      pruner = Pruner(retentionInterval,retentionBatch,retentionMaxBatches,smoothing)
+   except ValueError as e:
+      print(e)
+      return
+   serve(metricsPort)
    while not done:
-      if startTime == None: startTime = time.time()
-      if iterations == None: iterations = 0
       try:
          if conn is None: conn = psycopg.connect(host=postgresHost, port=postgresPort, dbname=postgresDb, user=postgresUser, password=postgresPw)
+         if sampleFormat != 'numeric' and not migrated:
+            print(f"collect: packed {migrate(conn)} existing samples")
+            migrated = True
          cur = conn.cursor()
-         gafInfo = getGafInfo(conn,cur)
-         for i in range(len(gafInfo)):
-            product = gafInfo[i][0]
-            sequence = sequences.get(product,None)
-            midpoint,asks,bids = getOrderbookInfo(product,aggregation,depth,httpTimeout)
-            sequences[product],buy,sell = getMarketOrderInfo(product,sequence,httpTimeout)
-            doInsert(conn,cur,asks,bids,buy,midpoint,product,sell)
-            doDelete(conn,cur,product,gafInfo[i][1])
-         conn.commit()
+         # per-product settings are re-read once a sleep interval
+         now = time.monotonic()
+         if refreshed is None or now - refreshed >= sleepInterval:
+            gafInfo = getGafInfo(conn,cur)
+            scheduler.configure([ [x[0]] + x[2:] for x in gafInfo ],now)
+            maxSizes = { x[0]: x[1] for x in gafInfo }
+            if rings is not None: rings.retain(maxSizes)
+            refreshed = now
+         due = scheduler.popDue(now)
+         if len(due) > 0:
+            DRIFT.set(max(now - x.due for x in due))
+            with stage('fetch'):
+               if poller is not None:
+                  # the fetch stage of a concurrent poll gives up after the deadline (the shortest due interval by default)
+                  deadline = cycleDeadline if cycleDeadline > 0 else min(x.interval for x in due)
+                  polled = collectConcurrent(due,poller,session,buffer,sequences,min(httpTimeout,deadline),deadline,publish)
+               else:
+                  polled = collectSequential(due,session,buffer,sequences,httpTimeout,publish)
+            now = time.monotonic()
+            for schedule in due:
+               if not polled[schedule.product]: BACKOFFS.labels('http').inc()
+               missed = scheduler.done(schedule,now,polled[schedule.product])
+               if missed > 0: MISSED.labels(schedule.product,schedule.policy).inc(missed)
+         if rings is not None: rings.beat()
+         if buffer.due():
+            with stage('insert'):
+               SAMPLES.inc(buffer.flush(conn,cur,isolate=poller is not None))
+         with stage('commit'):
+            conn.commit()
          cur.close()
-         currentTime = time.time()
-         iterations = iterations + 1
-         sleepTime = startTime + iterations*sleepInterval - currentTime
-         if(sleepTime < 0): sleepTime = 0
+         if pruner.due():
+            with stage('delete'):
+               pruned = pruner.run(conn)
+            for product in pruned:
+               PRUNED.labels(product).inc(pruned[product])
+            if len(pruned) > 0:
+               print(f"collect: pruned {sum(pruned.values())} samples ({', '.join(f'{x} {pruned[x]}' for x in sorted(pruned))})")
          btime = 5
-         time.sleep(sleepTime)
+         # sleep until the next product is due, the settings are re-read or the buffer must flush
+         wake = refreshed + sleepInterval
+         nextDue = scheduler.nextDue()
+         if nextDue is not None: wake = min(wake,nextDue)
+         if buffer.oldest is not None: wake = min(wake,buffer.oldest + flushLatency)
+         sleepTime = wake - time.monotonic()
+         if sleepTime > 0: time.sleep(sleepTime)
       except (psycopg.OperationalError, psycopg.DatabaseError) as e:
          print(e)
          conn = None
-         btime = backoff(btime)
-      except requests.RequestException as e:
-         print(e)
-         conn.rollback()
+         scheduler.requeue()
+         BACKOFFS.labels('database').inc()
          btime = backoff(btime)
       except Exception as e:
          print(e)
          done = True
+   if poller is not None: poller.shutdown()
+   if recorder is not None: recorder.close()
+   if rings is not None: rings.close()
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--pg_user', help="postgres user")
@@ -155,7 +297,24 @@ parser.add_argument('--pg_host', help="postgres host")
 parser.add_argument('--pg_port', help="postgres port")
 parser.add_argument('--db', help="postgres db")
 parser.add_argument('--kafka', help="kafka host")
-parser.add_argument('--sleep', help="sleep interval in seconds")
+parser.add_argument('--sleep', help="default poll interval in seconds, overridden per product by crypto_gaf.gafs.poll_interval")
 parser.add_argument('--fetch', help="number of rows to fetch each interval")
+parser.add_argument('--aggregation', help="default order book aggregation, overridden per product by crypto_gaf.gafs.aggregation")
+parser.add_argument('--depth', help="default order book depth, overridden per product by crypto_gaf.gafs.depth")
+parser.add_argument('--missed_ticks', help="default missed tick policy: skip, coalesce or catchup (crypto_gaf.gafs.missed_ticks per product)")
+parser.add_argument('--poll_mode', help="sequential (one request at a time) or concurrent (all products at once)")
+parser.add_argument('--poll_threads', help="threads and pooled connections for concurrent polling")
+parser.add_argument('--deadline', help="seconds the concurrent fetch stage waits each cycle (defaults to the shortest interval among the products polled)")
+parser.add_argument('--ingest_mode', help="row (INSERT per sample), pipeline (INSERTs in pipeline mode) or copy (binary COPY)")
+parser.add_argument('--flush_rows', help="samples buffered before a flush")
+parser.add_argument('--flush_latency', help="seconds the oldest buffered sample may wait before a flush")
+parser.add_argument('--sample_format', help="numeric (numeric[] columns), packed (one bytea per sample) or both")
+parser.add_argument('--retention_interval', help="seconds between retention runs")
+parser.add_argument('--retention_batch', help="rows deleted per retention batch")
+parser.add_argument('--retention_max_batches', help="most retention batches deleted per run; the rest waits for the next run")
+parser.add_argument('--smoothing', help="calculate's default trade smoothing (its SMOOTHING); retention keeps the older samples it reads")
+parser.add_argument('--record', help="append every coinbase-local response to this gzip JSON lines log")
+parser.add_argument('--shm_ring_size', help="samples kept per product in shared memory rings for a co-located calculate (0 disables)")
+parser.add_argument('--metrics_port', help="port serving Prometheus /metrics (0 disables)")
 args = parser.parse_args()
 main(args)
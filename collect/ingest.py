@@ -0,0 +1,175 @@
+"""Buffered sample ingestion for the collect worker.
+
+Samples are queued as they are polled and written once the buffer holds
+FLUSH_ROWS samples or its oldest sample is FLUSH_LATENCY seconds old:
+
+   row       one INSERT (and NOTIFY) per sample, the original path
+   pipeline  the same INSERTs sent back to back in pipeline mode
+   copy      one binary COPY, then a single NOTIFY statement per flush
+
+Values are rounded to 15 significant digits on the way in, which is what
+the server's float8 to numeric cast does for the INSERT paths, so all
+three modes store identical numbers.
+
+SAMPLE_FORMAT picks the columns written: the numeric[] columns (numeric),
+one packed bytea per sample (packed) or both.  A packed sample is
+big-endian like float8send: int2 cardinality of ask_prices, ask_sizes,
+bid_prices and bid_sizes, then float8 midpoint, buys[3], sells[3] and the
+four order book columns, each NaN padded to the same depth.
+"""
+import time
+from contextlib import nullcontext
+from decimal import Decimal
+import numpy as np
+import psycopg
+
+SAMPLE_CHANNEL = 'crypto_gaf_samples'
+SAMPLE_COLUMNS = ['ask_prices','ask_sizes','bid_prices','bid_sizes','buys','midpoint','product','sells']
+SAMPLE_TYPES = ['numeric[]','numeric[]','numeric[]','numeric[]','numeric[]','numeric','text','numeric[]']
+COLUMN_TYPES = dict(zip(SAMPLE_COLUMNS,SAMPLE_TYPES),packed='bytea')
+FORMAT_COLUMNS = {
+   'numeric': SAMPLE_COLUMNS,
+   'packed': ['product','packed'],
+   'both': SAMPLE_COLUMNS + ['packed']
+}
+
+def insertSql(columns):
+   # calculate LISTENs on SAMPLE_CHANNEL; the notification is delivered when the cycle commits
+   return f"""
+      WITH inserted AS
+      (
+         INSERT INTO crypto_gaf.samples ({','.join(columns)})
+         VALUES ({','.join(['%s']*len(columns))})
+         RETURNING product,sample_id
+      )
+      SELECT pg_notify(%s,json_build_object('product',product,'sample_id',sample_id)::text) FROM inserted
+   """
+
+def copySql(columns):
+   return f"COPY crypto_gaf.samples ({','.join(columns)}) FROM STDIN (FORMAT BINARY)"
+
+INSERT_SQL = insertSql(SAMPLE_COLUMNS)
+
+# the newest sample of each product is found with a backward scan of the primary key
+NOTIFY_SQL = """
+   SELECT pg_notify(%s,json_build_object('product',p,'sample_id',(SELECT max(sample_id) FROM crypto_gaf.samples WHERE product = p))::text)
+   FROM unnest(%s::text[]) AS p
+"""
+
+def levels(book):
+   # [[price,size,...],...] as given by coinbase-local -> price and size columns
+   if len(book) == 0:
+      return [],[]
+   values = np.asarray([ level[:2] for level in book ],dtype=np.float64)
+   return values[:,0].tolist(),values[:,1].tolist()
+
+def sampleRow(asks,bids,buy,midpoint,product,sell):
+   askPrices,askSizes = levels(asks)
+   bidPrices,bidSizes = levels(bids)
+   return (
+      askPrices,
+      askSizes,
+      bidPrices,
+      bidSizes,
+      [ float(buy['price']), float(buy['size']), float(buy['numOrders']) ],
+      float(midpoint),
+      product,
+      [ float(sell['price']), float(sell['size']), float(sell['numOrders']) ]
+   )
+
+def packSample(row,depth=0):
+   # NULL (None) columns and values pack as NaN, like crypto_gaf.pack_sample()
+   askPrices,askSizes,bidPrices,bidSizes,buys,midpoint,product,sells = row
+   book = [ np.array(x if x is not None else [],dtype=np.float64) for x in (askPrices,askSizes,bidPrices,bidSizes) ]
+   depth = max([depth] + [ len(x) for x in book ])
+   values = np.full(7 + 4*depth,np.nan,dtype='>f8')
+   if midpoint is not None: values[0] = midpoint
+   if buys is not None: values[1:4] = np.array(buys,dtype=np.float64)
+   if sells is not None: values[4:7] = np.array(sells,dtype=np.float64)
+   for k,column in enumerate(book):
+      values[7 + k*depth:7 + k*depth + len(column)] = column
+   return np.array([ len(x) for x in book ],dtype='>i2').tobytes() + values.tobytes()
+
+# fills the packed column of rows written before the switch, using the schema's crypto_gaf.pack_sample()
+MIGRATE_SQL = """
+   UPDATE crypto_gaf.samples
+   SET packed = crypto_gaf.pack_sample(ask_prices,ask_sizes,bid_prices,bid_sizes,buys,midpoint,sells)
+   WHERE sample_id IN (SELECT sample_id FROM crypto_gaf.samples WHERE packed IS NULL LIMIT %s)
+"""
+
+def migrate(conn,batch=1000):
+   migrated = 0
+   with conn.cursor() as cur:
+      while True:
+         cur.execute(MIGRATE_SQL,(batch,))
+         conn.commit()
+         migrated += cur.rowcount
+         if cur.rowcount < batch:
+            return migrated
+
+def numeric(value):
+   if isinstance(value,list):
+      return [ numeric(x) for x in value ]
+   if isinstance(value,float):
+      return Decimal(f"{value:.15g}")
+   return value
+
+class SampleBuffer:
+   def __init__(self,mode='row',maxRows=1,maxLatency=0,sampleFormat='numeric',depth=0):
+      if mode not in ('row','pipeline','copy'):
+         raise ValueError(f"unknown ingest mode {mode}")
+      if sampleFormat not in FORMAT_COLUMNS:
+         raise ValueError(f"unknown sample format {sampleFormat}")
+      self.mode = mode
+      self.sampleFormat = sampleFormat
+      self.depth = depth
+      self.columns = FORMAT_COLUMNS[sampleFormat]
+      self.product = self.columns.index('product')
+      self.insertSql = insertSql(self.columns)
+      self.maxRows = maxRows
+      self.maxLatency = maxLatency
+      self.rows = []
+      self.oldest = None
+
+   def add(self,row):
+      if self.oldest is None: self.oldest = time.monotonic()
+      if self.sampleFormat == 'packed': row = (row[6],packSample(row,self.depth))
+      elif self.sampleFormat == 'both': row = row + (packSample(row,self.depth),)
+      self.rows.append(row)
+
+   def due(self):
+      if len(self.rows) == 0:
+         return False
+      return len(self.rows) >= self.maxRows or time.monotonic() - self.oldest >= self.maxLatency
+
+   def flush(self,conn,cur,isolate=False):
+      # returns the samples written; a failed batch is dropped rather than retried.
+      # with isolate, row mode writes each sample in its own savepoint and skips the ones the server rejects
+      rows = self.rows
+      self.rows = []
+      self.oldest = None
+      if self.mode == 'row':
+         return self.flushRows(conn,cur,rows,isolate)
+      if self.mode == 'copy':
+         with cur.copy(copySql(self.columns)) as copy:
+            copy.set_types([ COLUMN_TYPES[x] for x in self.columns ])
+            for row in rows:
+               copy.write_row(numeric(list(row)))
+         cur.execute(NOTIFY_SQL,(SAMPLE_CHANNEL,list(dict.fromkeys(row[self.product] for row in rows))))
+      else:
+         with conn.pipeline():
+            cur.executemany(self.insertSql,[ row + (SAMPLE_CHANNEL,) for row in rows ])
+      return len(rows)
+
+   def flushRows(self,conn,cur,rows,isolate):
+      written = 0
+      for row in rows:
+         try:
+            with conn.transaction() if isolate else nullcontext():
+               cur.execute(self.insertSql,row + (SAMPLE_CHANNEL,))
+         except (psycopg.DataError, psycopg.IntegrityError) as e:
+            if not isolate: raise
+            print(f"{row[self.product]}: skipped, {e}")
+            continue
+         written += 1
+      return written
@@ -0,0 +1,34 @@
+"""Prometheus metrics for the collect worker.
+
+With METRICS_PORT set, /metrics is served on that port from a background
+thread (prometheus_client's exposition server).  Stages are timed per cycle:
+
+   fetch    polling coinbase-local for the products due
+   insert   flushing buffered samples
+   delete   a retention run
+   commit   committing the cycle
+"""
+import time
+from prometheus_client import Counter,Gauge,Histogram,start_http_server
+
+STAGE_SECONDS = Histogram('crypto_gaf_collect_stage_seconds','Time spent in each stage of a collect cycle',['stage'])
+HTTP_SECONDS = Histogram('crypto_gaf_collect_http_request_seconds','coinbase-local request latency',['endpoint'])
+SAMPLES = Counter('crypto_gaf_collect_samples_total','Samples written to crypto_gaf.samples')
+SKIPPED = Counter('crypto_gaf_collect_skipped_total','Product samples skipped in a cycle',['product'])
+PRUNED = Counter('crypto_gaf_collect_pruned_rows_total','Samples deleted by retention',['product'])
+BACKOFFS = Counter('crypto_gaf_collect_backoffs_total','Backoffs after a failed cycle (database) or product poll (http)',['reason'])
+MISSED = Counter('crypto_gaf_collect_missed_ticks_total','Poll ticks that went by while a product was polled late',['product','policy'])
+DRIFT = Gauge('crypto_gaf_collect_schedule_drift_seconds','How far past its due time the latest product poll started')
+
+def serve(port):
+   if port > 0: start_http_server(port)
+
+def stage(name):
+   return STAGE_SECONDS.labels(name).time()
+
+def timedGet(session,endpoint,url,**kwargs):
+   start = time.perf_counter()
+   try:
+      return session.get(url,**kwargs)
+   finally:
+      HTTP_SECONDS.labels(endpoint).observe(time.perf_counter() - start)
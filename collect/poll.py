@@ -0,0 +1,40 @@
+"""Concurrent coinbase-local polling for the collect worker.
+
+Every product's order book and market order requests go out at once on a
+thread pool that shares one keep-alive session.  Requests that have not
+answered by the cycle deadline are reported as timed out; the rest come
+back as usual, so one slow or failing market does not hold up the others.
+"""
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, wait
+
+def getSession(connections=10):
+   session = requests.Session()
+   adapter = HTTPAdapter(pool_connections=1,pool_maxsize=connections)
+   session.mount('http://',adapter)
+   session.mount('https://',adapter)
+   return session
+
+class Poller:
+   def __init__(self,threads):
+      self.executor = ThreadPoolExecutor(max_workers=threads)
+
+   def poll(self,calls,deadline):
+      # calls maps key -> (fn,args); returns key -> (result,error) with exactly one of them None
+      futures = { self.executor.submit(fn,*args): key for key,(fn,args) in calls.items() }
+      done,pending = wait(futures,timeout=deadline)
+      results = {}
+      for future,key in futures.items():
+         if future in done and future.exception() is None:
+            results[key] = (future.result(),None)
+         elif future in done:
+            results[key] = (None,future.exception())
+         else:
+            # a running request is left to its own timeout; its answer is dropped
+            future.cancel()
+            results[key] = (None,TimeoutError(f"no answer within the {deadline}s deadline"))
+      return results
+
+   def shutdown(self):
+      self.executor.shutdown(wait=False,cancel_futures=True)
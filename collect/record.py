@@ -0,0 +1,64 @@
+"""Record mode for the collect worker.
+
+With RECORD_PATH set every coinbase-local answer is appended to a gzip
+compressed JSON lines log, one object per response:
+
+   {"t":1718000000.25,"path":"/api/orderBook/interval","product":"BTC-USD","status":200,"body":"{...}"}
+
+body is the response text as received.  The log is flushed every few
+seconds, so a killed worker loses at most that much; readLog stops at a
+truncated tail.  bench/standin.py serves logs back at any speed.
+"""
+import gzip
+import json
+import threading
+import time
+from urllib.parse import urlparse
+
+class Recorder:
+   def __init__(self,path,flushInterval=5):
+      self.file = gzip.open(path,'at')
+      self.lock = threading.Lock()
+      self.flushInterval = flushInterval
+      self.flushed = time.monotonic()
+
+   def record(self,url,params,res):
+      entry = {
+         't': time.time(),
+         'path': urlparse(url).path,
+         'product': (params or {}).get('product',None),
+         'status': res.status_code,
+         'body': res.text
+      }
+      line = json.dumps(entry,separators=(',',':'))
+      # the concurrent poller records from several threads
+      with self.lock:
+         self.file.write(line + '\n')
+         if time.monotonic() - self.flushed >= self.flushInterval:
+            self.file.flush()
+            self.flushed = time.monotonic()
+
+   def close(self):
+      with self.lock:
+         self.file.close()
+
+class RecordingSession:
+   """A requests session stand-in that records every GET answer."""
+
+   def __init__(self,session,recorder):
+      self.session = session
+      self.recorder = recorder
+
+   def get(self,url,params=None,**kwargs):
+      res = self.session.get(url,params=params,**kwargs)
+      self.recorder.record(url,params,res)
+      return res
+
+def readLog(path):
+   # recorded entries in file order
+   with gzip.open(path,'rt') as f:
+      try:
+         for line in f:
+            yield json.loads(line)
+      except (EOFError, ValueError):
+         return
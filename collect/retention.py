@@ -0,0 +1,102 @@
+"""Watermark retention for crypto_gaf.samples.
+
+Every RETENTION_INTERVAL seconds the cutoff of each product is read off
+the (product, sample_id) index: the sample_id of its (max_size + margin +
+1)-th newest sample, where margin is the number of older samples calculate
+reads to smooth the oldest trades of a window with the product's kernel
+(gafs.smoothing, or SMOOTHING when NULL or invalid, as in calculate).
+Keeping them means a prune never changes the images of a window.  Rows at
+or below the cutoff are deleted in batches of
+RETENTION_BATCH, round robin over the products, with at most
+RETENTION_MAX_BATCHES batches per run so a backlog never stalls a tick;
+what is left over is picked up by the next run.
+"""
+import math
+import time
+
+SMOOTHING_RADIUS = 5
+
+GAFS_SQL = """
+   SELECT product,max_size,smoothing FROM crypto_gaf.gafs WHERE max_size IS NOT NULL
+"""
+
+WATERMARK_SQL = """
+   SELECT w.product,(
+      SELECT s.sample_id FROM crypto_gaf.samples s
+      WHERE s.product = w.product
+      ORDER BY s.sample_id DESC
+      OFFSET w.keep LIMIT 1
+   )
+   FROM unnest(%(products)s::text[],%(keep)s::int[]) AS w(product,keep)
+"""
+
+PRUNE_SQL = """
+   DELETE FROM crypto_gaf.samples WHERE sample_id IN
+   (
+      SELECT sample_id FROM crypto_gaf.samples
+      WHERE product = %(product)s AND sample_id <= %(cutoff)s
+      ORDER BY sample_id
+      LIMIT %(batch)s
+   )
+"""
+
+def smoothingMargin(spec):
+   # older samples the kernel named by spec reaches (Kernel.older in calculate/smoothing.py, repeated here)
+   name,*options = spec.split(':')
+   try:
+      if name == 'box' and len(options) <= 1:
+         radius = int(options[0]) if options else SMOOTHING_RADIUS
+         if radius >= 0: return radius
+      elif name == 'gaussian' and len(options) <= 2:
+         sigma = float(options[0]) if options else 2.0
+         if sigma > 0: return max(int(options[1]) if len(options) > 1 else math.ceil(3*sigma),0)
+      elif name == 'ema' and len(options) <= 2:
+         alpha = float(options[0]) if options else 0.3
+         if 0 < alpha <= 1:
+            if len(options) > 1: return max(int(options[1]),0)
+            return math.ceil(math.log(1e-3)/math.log(1 - alpha)) if alpha < 1 else 0
+      elif name == 'none' and len(options) == 0:
+         return 0
+   except ValueError:
+      pass
+   raise ValueError(f"bad smoothing {spec}")
+
+class Pruner:
+   def __init__(self,interval=10,batchSize=1000,maxBatches=20,smoothing=f"box:{SMOOTHING_RADIUS}"):
+      self.interval = interval
+      self.batchSize = batchSize
+      self.maxBatches = maxBatches
+      self.margin = smoothingMargin(smoothing)
+      self.last = None
+
+   def keep(self,maxSize,spec):
+      # rows of a product that survive a prune: its window and the older samples its smoothing reads
+      try:
+         return maxSize + (smoothingMargin(spec) if spec is not None else self.margin)
+      except ValueError:
+         return maxSize + self.margin
+
+   def due(self):
+      return self.last is None or time.monotonic() - self.last >= self.interval
+
+   def run(self,conn):
+      # returns {product: rows pruned}; each round of batches is committed on its own
+      self.last = time.monotonic()
+      pruned = {}
+      with conn.cursor() as cur:
+         cur.execute(GAFS_SQL)
+         keep = { product: self.keep(maxSize,spec) for product,maxSize,spec in cur.fetchall() }
+         cur.execute(WATERMARK_SQL,{ 'products': list(keep), 'keep': list(keep.values()) })
+         pending = { product: cutoff for product,cutoff in cur.fetchall() if cutoff is not None }
+         conn.commit()
+         batches = 0
+         while len(pending) > 0 and batches < self.maxBatches:
+            for product in list(pending):
+               if batches >= self.maxBatches:
+                  break
+               cur.execute(PRUNE_SQL,{ 'product': product, 'cutoff': pending[product], 'batch': self.batchSize })
+               batches += 1
+               if cur.rowcount > 0: pruned[product] = pruned.get(product,0) + cur.rowcount
+               if cur.rowcount < self.batchSize: del pending[product]
+            conn.commit()
+      return pruned
@@ -0,0 +1,117 @@
+"""Per-product poll scheduling for the collect worker.
+
+Every product in crypto_gaf.gafs is polled on its own cadence
+(gafs.poll_interval, SLEEP_INTERVAL when NULL) with its own aggregation and
+depth; due times are kept in a heap, so the worker sleeps until the next
+product is due.  When a poll ends after the product's following tick, the
+product's missed-tick policy (gafs.missed_ticks, MISSED_TICKS when NULL)
+decides what happens to the ticks that went by:
+
+   skip      drop them and stay on the original grid (the next tick after now)
+   coalesce  poll once right away and restart the grid from there
+   catchup   poll every missed tick back to back until the grid is reached
+
+A product whose poll fails backs off on its own, 5 s doubling up to 60 s,
+while the others keep their cadence.
+"""
+import heapq
+import math
+
+POLICIES = ('skip','coalesce','catchup')
+
+class ProductSchedule:
+   def __init__(self,product,interval,aggregation,depth,policy,due):
+      self.product = product
+      self.interval = interval
+      self.aggregation = aggregation
+      self.depth = depth
+      self.policy = policy
+      self.due = due
+      self.failures = 0
+
+class Scheduler:
+   def __init__(self,interval=1,aggregation=10,depth=3,policy='skip',backoffStart=5,backoffMax=60):
+      if policy not in POLICIES:
+         raise ValueError(f"unknown missed tick policy {policy}")
+      self.interval = interval
+      self.aggregation = aggregation
+      self.depth = depth
+      self.policy = policy
+      self.backoffStart = backoffStart
+      self.backoffMax = backoffMax
+      self.products = {}
+      self.heap = []
+      self.pending = set()
+
+   def push(self,schedule):
+      heapq.heappush(self.heap,(schedule.due,schedule.product))
+
+   def configure(self,rows,now):
+      # rows of (product,interval,aggregation,depth,policy), None taking the default; new products are due now
+      seen = set()
+      for product,interval,aggregation,depth,policy in rows:
+         seen.add(product)
+         interval = interval if interval is not None and interval > 0 else self.interval
+         aggregation = aggregation if aggregation is not None else self.aggregation
+         depth = depth if depth is not None else self.depth
+         if policy not in POLICIES:
+            if policy is not None: print(f"{product}: unknown missed tick policy {policy}, using {self.policy}")
+            policy = self.policy
+         schedule = self.products.get(product,None)
+         if schedule is None:
+            schedule = ProductSchedule(product,interval,aggregation,depth,policy,now)
+            self.products[product] = schedule
+            self.push(schedule)
+            continue
+         if interval < schedule.interval and schedule.failures == 0 and schedule.product not in self.pending and schedule.due > now + interval:
+            # a faster cadence starts within one new interval rather than after the old one
+            schedule.due = now + interval
+            self.push(schedule)
+         schedule.interval,schedule.aggregation,schedule.depth,schedule.policy = interval,aggregation,depth,policy
+      for product in [ x for x in self.products if x not in seen ]:
+         del self.products[product]
+
+   def nextDue(self):
+      # heap entries of removed or rescheduled products are dropped lazily
+      while len(self.heap) > 0:
+         due,product = self.heap[0]
+         schedule = self.products.get(product,None)
+         if schedule is not None and schedule.due == due:
+            return due
+         heapq.heappop(self.heap)
+      return None
+
+   def popDue(self,now):
+      # every product returned is pending until done() (or requeue()) schedules it again
+      due = []
+      while self.nextDue() is not None and self.heap[0][0] <= now:
+         schedule = self.products[heapq.heappop(self.heap)[1]]
+         self.pending.add(schedule.product)
+         due.append(schedule)
+      return due
+
+   def requeue(self):
+      # products popped by a cycle that failed before done() stay due
+      for product in self.pending:
+         if product in self.products: self.push(self.products[product])
+      self.pending = set()
+
+   def done(self,schedule,now,ok):
+      # reschedules a polled product; returns how many of its ticks went by unpolled
+      self.pending.discard(schedule.product)
+      if schedule.product not in self.products:
+         return 0
+      missed = 0
+      if not ok:
+         schedule.failures += 1
+         schedule.due = now + min(self.backoffStart*2**(schedule.failures - 1),self.backoffMax)
+      else:
+         schedule.failures = 0
+         due = schedule.due + schedule.interval
+         if due <= now:
+            missed = math.floor((now - due)/schedule.interval) + 1
+            if schedule.policy == 'skip': due += missed*schedule.interval
+            elif schedule.policy == 'coalesce': due = now
+         schedule.due = due
+      self.push(schedule)
+      return missed
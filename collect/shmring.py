@@ -0,0 +1,174 @@
+"""Shared memory sample rings, the writing side.
+
+With SHM_RING_SIZE above 0 every polled sample is also published, before
+it is inserted, into a named shared memory segment per product
+(/dev/shm/crypto_gaf_<product>), so a calculate worker on the same host
+(TRANSPORT=shm) can read windows without a database round trip.  The
+layout is fixed and shared with calculate/shmring.py, little-endian:
+
+   header (64 bytes)  magic 'CGAFRNG1', state (1 live, 2 retired), depth,
+                      capacity, base (sequence number of the first slot
+                      written), head (newest published), beat (wall clock
+                      time of the writer's last cycle), pid
+   record per slot    lock, seq, published (wall clock), int16 cardinality
+                      of ask_prices, ask_sizes, bid_prices and bid_sizes,
+                      then float8 midpoint, buys[3], sells[3] and the four
+                      order book columns NaN padded to depth
+
+Each slot is a seqlock: the writer sets lock to 2*seq - 1 before filling
+the slot and to 2*seq after, then moves head, so a reader that sees the
+same even lock before and after copying a slot has a consistent sample.
+The sample at seq lives in slot seq % capacity.  Sequence numbers start
+from the creation time in microseconds, so they keep growing when a
+segment is recreated.  A segment that outgrows its depth or capacity is
+marked retired and replaced by an empty one.  Segments outlive the
+process, so a restarted writer carries on where it stopped.
+"""
+import os
+import re
+import time
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+MAGIC = b'CGAFRNG1'
+LIVE = 1
+RETIRED = 2
+HEADER = np.dtype({
+   'names': ['magic','state','depth','capacity','base','head','beat','pid'],
+   'formats': ['S8','<u4','<u4','<u8','<u8','<u8','<f8','<u8'],
+   'offsets': [0,8,12,16,24,32,40,48],
+   'itemsize': 64
+})
+
+def recordDtype(depth):
+   return np.dtype([('lock','<u8'),('seq','<u8'),('published','<f8'),('counts','<i2',(4,)),('values','<f8',(7 + 4*depth,))])
+
+def ringName(product):
+   return 'crypto_gaf_' + re.sub(r'[^A-Za-z0-9_.-]','_',product)
+
+def attach(name):
+   shm = shared_memory.SharedMemory(name=name)
+   # segments are unlinked on purpose only; keep the resource tracker from removing them at exit
+   resource_tracker.unregister(shm._name,'shared_memory')
+   return shm
+
+class RingWriter:
+   def __init__(self,product,depth,capacity):
+      self.product = product
+      self.name = ringName(product)
+      self.shm = None
+      base = time.time_ns()//1000
+      try:
+         shm = attach(self.name)
+         header = np.ndarray(1,dtype=HEADER,buffer=shm.buf)[0].copy() if shm.size >= HEADER.itemsize else None
+         if header is not None and header['magic'] == MAGIC and header['state'] == LIVE and header['depth'] >= depth and header['capacity'] >= capacity:
+            self.open(shm)
+            return
+         if header is not None and header['magic'] == MAGIC: base = max(base,int(header['head']) + 1)
+         self.retire(shm)
+      except FileNotFoundError:
+         pass
+      size = HEADER.itemsize + capacity*recordDtype(depth).itemsize
+      shm = shared_memory.SharedMemory(name=self.name,create=True,size=size)
+      resource_tracker.unregister(shm._name,'shared_memory')
+      header = np.ndarray(1,dtype=HEADER,buffer=shm.buf)
+      header[0] = (MAGIC,0,depth,capacity,base,base - 1,time.time(),os.getpid())
+      records = np.ndarray(capacity,dtype=recordDtype(depth),buffer=shm.buf,offset=HEADER.itemsize)
+      records['lock'] = 0
+      # published last, so a reader never attaches to a half initialised segment
+      header['state'] = LIVE
+      self.open(shm)
+
+   def open(self,shm):
+      self.shm = shm
+      self.header = np.ndarray(1,dtype=HEADER,buffer=shm.buf)
+      self.depth = int(self.header['depth'][0])
+      self.capacity = int(self.header['capacity'][0])
+      self.records = np.ndarray(self.capacity,dtype=recordDtype(self.depth),buffer=shm.buf,offset=HEADER.itemsize)
+      self.header['pid'] = os.getpid()
+
+   @staticmethod
+   def retire(shm):
+      # readers still attached see the retired state and attach to the replacement
+      header = np.ndarray(1,dtype=HEADER,buffer=shm.buf)
+      header['state'] = RETIRED
+      del header
+      shm.close()
+      # unlink() unregisters the segment from the resource tracker, so register it back first
+      resource_tracker.register(shm._name,'shared_memory')
+      shm.unlink()
+
+   def fits(self,depth,capacity):
+      return self.depth >= depth and self.capacity >= capacity
+
+   def publish(self,row,now):
+      # row is a sampleRow tuple; None columns and values are NaN, as in packSample
+      askPrices,askSizes,bidPrices,bidSizes,buys,midpoint,product,sells = row
+      book = [ x if x is not None else [] for x in (askPrices,askSizes,bidPrices,bidSizes) ]
+      seq = int(self.header['head'][0]) + 1
+      record = self.records[seq % self.capacity]
+      record['lock'] = 2*seq - 1
+      record['seq'] = seq
+      record['published'] = now
+      record['counts'] = [ len(x) for x in book ]
+      values = record['values']
+      values[:] = np.nan
+      if midpoint is not None: values[0] = midpoint
+      if buys is not None: values[1:4] = buys
+      if sells is not None: values[4:7] = sells
+      for k,column in enumerate(book):
+         values[7 + k*self.depth:7 + k*self.depth + len(column)] = column
+      record['lock'] = 2*seq
+      self.header['head'] = seq
+      self.header['beat'] = now
+
+   def beat(self,now):
+      self.header['beat'] = now
+
+   def close(self,unlink=False):
+      if self.shm is None:
+         return
+      self.records = None
+      self.header = None
+      if unlink: self.retire(self.shm)
+      else: self.shm.close()
+      self.shm = None
+
+class SampleRings:
+   """One RingWriter per product; a ring holds SHM_RING_SIZE samples or twice the product's max_size, whichever is more."""
+
+   def __init__(self,size):
+      self.size = size
+      self.rings = {}
+
+   def publish(self,product,row,maxSize,depth):
+      depth = max([depth] + [ len(x) for x in row[:4] if x is not None ])
+      capacity = max(self.size,2*(maxSize or 0))
+      ring = self.rings.get(product,None)
+      if ring is None or not ring.fits(depth,capacity):
+         if ring is not None:
+            print(f"{product}: shared memory ring grows to depth {depth} and {capacity} samples")
+            self.rings.pop(product).close(unlink=True)
+         try:
+            ring = RingWriter(product,depth,capacity)
+         except OSError as e:
+            # the database path carries on without the ring (calculate falls back to it)
+            print(f"{product}: no shared memory ring, {e}")
+            return
+         self.rings[product] = ring
+      ring.publish(row,time.time())
+
+   def beat(self):
+      now = time.time()
+      for ring in self.rings.values():
+         ring.beat(now)
+
+   def retain(self,products):
+      # products no longer in crypto_gaf.gafs lose their segment
+      for product in [ x for x in self.rings if x not in products ]:
+         self.rings.pop(product).close(unlink=True)
+
+   def close(self):
+      for ring in self.rings.values():
+         ring.close()
+      self.rings = {}